@@ -1,7 +1,28 @@
-from flask import Flask, redirect, url_for, render_template, session, request, flash, send_file
-from authlib.integrations.flask_client import OAuth
+import time
+BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, redirect, url_for, render_template, session, request, flash, send_file, jsonify, Response, stream_with_context, make_response
+import hmac
+import logging
 import os
+import threading
 from datetime import datetime
+import database
+import grading
+import http_cache
+import instrumentation
+import jobs
+import marks_import
+import metrics
+import preset_cache
+import preset_copy
+import reports
+import roster
+import spreadsheets
+import auth
+import backups
+import cache_bus
+import oauth_client
 from database import create_connection
 try:
     from dotenv import load_dotenv
@@ -13,21 +34,58 @@ app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev-secret")
 DEV_MODE = os.getenv("DEV_MODE", "false").lower() == "true"
 
-# Ensure database tables are created
-from database import create_tables
-create_tables()
-
-oauth = OAuth(app)
-
-google = oauth.register(
-    name='google',
-    client_id=os.getenv('GOOGLE_CLIENT_ID'),
-    client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    client_kwargs={
-        'scope': 'openid email profile'
-    }
-)
+_boot_lock = threading.Lock()
+
+
+def _boot():
+    """Make sure the schema exists and recover orphaned jobs, once per process."""
+    with _boot_lock:
+        if app.extensions.get('cgpa_ready'):
+            return
+        # Apply pending schema migrations unless this database file is already current
+        applied = database.bootstrap()
+        # Jobs left queued or running by workers that are gone will never finish
+        jobs.recover_orphans()
+
+        app.extensions['cgpa_ready'] = True
+        boot_seconds = time.perf_counter() - BOOT_STARTED
+        metrics.record_boot(boot_seconds)
+        if app.logger.level == logging.NOTSET:
+            app.logger.setLevel(logging.INFO)
+        app.logger.info("Boot: pid %s ready in %.0f ms (schema %s)", os.getpid(), boot_seconds * 1000,
+                        f"migrated to v{applied[-1][0]}" if applied else "up to date")
+
+
+@app.before_request
+def ensure_booted():
+    # Served without create_app() (`gunicorn app:app`, `flask run`, a script
+    # importing `app`): boot on the first request instead
+    if not app.extensions.get('cgpa_ready'):
+        _boot()
+
+
+# Pooled connections are returned at the end of every request
+database.init_app(app)
+# Request latency/DB time histograms for /metrics, shared across workers
+metrics.init_app(app)
+# Per-request SQL counts and N+1 detection (see /admin/perf)
+instrumentation.init_app(app, headers=DEV_MODE, timing=metrics.ENABLED)
+
+
+def create_app(config=None):
+    """The app, booted: schema migrated and orphaned jobs recovered.
+
+    Routes and request hooks are registered on the module-level `app` at
+    import, which touches no database; `app` boots itself on its first
+    request if nothing called this. The WSGI entry point (`app:create_app()`,
+    see gunicorn.conf.py) calls it so that, with preload_app, the boot runs
+    once in the gunicorn master and workers fork ready to serve. `config` is
+    applied to app.config first, e.g. TESTING for a test client.
+    """
+    if config:
+        app.config.update(config)
+    _boot()
+    return app
 
 
 
@@ -36,19 +94,25 @@ google = oauth.register(
 def index():
     if 'user' in session:
         user_info = session['user']
+        if auth.current_role() == 'admin':
+            return redirect(url_for('admin_dashboard'))
+
+        # Profile completeness is checked once and remembered in the session
+        if user_info.get('profile_complete'):
+            return redirect(url_for('student_dashboard'))
+
         conn = create_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM users WHERE email = ?", (user_info['email'],))
         user = cursor.fetchone()
         conn.close()
 
-        admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-        if user_info['email'] in admin_emails:
-            return redirect(url_for('admin_dashboard'))
-
         # Check if user exists and has all required fields (Name, Roll, Enrollment, Dept, Academic Year, Current Year)
         # Indexes: 2:name, 3:roll, 4:email (skip), 5:dept, 6:ac_year, 7:current_year
         if user and user[2] and user[3] and user[4] and user[5] and user[6] and user[7]:
+             user_info['id'] = user[0]
+             user_info['profile_complete'] = True
+             session.modified = True
              return redirect(url_for('student_dashboard'))
         else:
              return redirect(url_for('additional_info'))
@@ -69,30 +133,28 @@ def inject_now():
 
 @app.route('/login')
 def login():
+    google = oauth_client.google(app)
     return google.authorize_redirect(url_for('authorize', _external=True))
 
 @app.route('/authorize')
 def authorize():
     try:
+        google = oauth_client.google(app)
         token = google.authorize_access_token()
         user_info = google.get(google.server_metadata.get('userinfo_endpoint')).json()
         
         # Strict Domain Check
         email = user_info['email']
-        # Load admin emails for bypass check
-        admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
+        # Admins (ADMIN_EMAILS or the admins table) bypass the domain check
+        is_admin_email = auth.is_admin_email(email)
         
-        if not email.endswith('@tsecmumbai.in') and email not in admin_emails:
+        if not email.endswith('@tsecmumbai.in') and not is_admin_email:
             # Revoke/Clear session immediately
             session.pop('user', None)
             return render_template('unauthorized.html')
 
-        session['user'] = user_info
-
         conn = create_connection()
         cursor = conn.cursor()
-        # Admin Logic from ENV (List supported)
-        is_admin_email = email in admin_emails
 
         # Strict Domain Check for Students
         if not is_admin_email and not email.endswith('@tsecmumbai.in'):
@@ -109,7 +171,9 @@ def authorize():
                 (user_info['email'], user_info.get('name', 'Unknown'), is_admin)
             )
             conn.commit()
+            user_id = cursor.lastrowid
         else:
+            user_id = user[0]
             # Update Admin Status if changed
             current_is_admin = user[8] # Ensure index is correct based on schema
             expected_is_admin = 1 if is_admin_email else 0
@@ -121,15 +185,13 @@ def authorize():
                 )
                 conn.commit()
 
-        # Name Consistency: Update session with DB name (in case user edited it locally)
-        # Re-fetch name from DB to be sure
-        cursor.execute("SELECT name FROM users WHERE email=?", (user_info['email'],))
-        db_name = cursor.fetchone()[0]
-        if db_name:
-            session['user']['name'] = db_name
-            session.modified = True
+            # Name Consistency: use the DB name (in case user edited it locally)
+            if user[2]:
+                user_info['name'] = user[2]
 
         conn.close()
+        # Caches the user id and role in the session
+        auth.login_user(user_info, user_id)
         return redirect('/')
 
     except Exception as e:
@@ -196,23 +258,21 @@ def view_profile():
 
 
 @app.route('/admin/db/download')
+@auth.admin_required
 def download_db():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-    
     try:
-        return send_file('database.db', as_attachment=True)
+        # A consistent hot copy, never the live file (see backups.py). It is
+        # not kept in the store, so downloads leave retention alone
+        name = f"database_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db.gz"
+        return send_file(backups.export_live(), as_attachment=True,
+                         download_name=name, mimetype='application/gzip')
     except Exception as e:
         flash(f"Error downloading database: {str(e)}", "error")
         return redirect(url_for('admin_dashboard'))
 
 @app.route('/admin/db/upload', methods=['POST'])
+@auth.admin_required
 def upload_db():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-    
     if 'db_file' not in request.files:
         flash('No file part', 'error')
         return redirect(url_for('admin_dashboard'))
@@ -225,22 +285,48 @@ def upload_db():
     
     if file:
         try:
-            # Save the file, overwriting the existing database.db
+            # Validated in a temp file, then swapped in atomically
             # Warning: This is a destructive operation!
-            file.save('database.db')
-            flash('Database restored successfully! Please refresh or restart if needed.', 'success')
+            before = backups.restore_upload(file.stream)
+            flash(f'Database restored successfully! The previous one is kept as snapshot {before}.', 'success')
+        except backups.RestoreError as e:
+            flash(f"Restore rejected: {str(e)}", "error")
         except Exception as e:
             flash(f"Error restoring database: {str(e)}", "error")
             
     return redirect(url_for('admin_dashboard'))
 
 
+def run_migration(job, temp_old_db):
+    import sys
+
+    temp_migrated_db = f'{temp_old_db}.migrated'
+    try:
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'migration_tools'))
+        from migrate_database import migrate_database
+
+        job.progress(0.1, 'Migrating uploaded database', force=True)
+        if not migrate_database(temp_old_db, temp_migrated_db):
+            raise RuntimeError('Migration failed. Please check the uploaded file.')
+        job.check_cancelled()
+
+        # Back up the current database and swap in the migrated one;
+        # carry this job's row over to the new data
+        job.progress(0.7, 'Backing up current database and applying', force=True)
+        this_job = jobs.get_job(job.job_id)
+        backup_id = backups.restore(temp_migrated_db, label='before_migration')
+        jobs.reclaim(this_job)
+
+        return {'backup': backup_id}
+    finally:
+        for path in (temp_old_db, temp_migrated_db):
+            if os.path.exists(path):
+                os.remove(path)
+
+
 @app.route('/admin/db/migrate', methods=['POST'])
+@auth.admin_required
 def migrate_db():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-    
     if 'db_file' not in request.files:
         flash('No file part', 'error')
         return redirect(url_for('admin_dashboard'))
@@ -252,73 +338,62 @@ def migrate_db():
         return redirect(url_for('admin_dashboard'))
     
     if file:
-        try:
-            import os
-            import sys
-            
-            # Save uploaded file temporarily
-            temp_old_db = 'temp_old_backup.db'
-            file.save(temp_old_db)
-            
-            # Import migration function
-            sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'migration_tools'))
-            from migrate_database import migrate_database
-            
-            # Run migration
-            temp_migrated_db = 'temp_migrated.db'
-            success = migrate_database(temp_old_db, temp_migrated_db)
-            
-            if success:
-                # Backup current database
-                import shutil
-                from datetime import datetime
-                backup_name = f'backup_before_migration_{datetime.now().strftime("%Y%m%d_%H%M%S")}.db'
-                if os.path.exists('database.db'):
-                    shutil.copy('database.db', backup_name)
-                
-                # Replace with migrated database
-                shutil.move(temp_migrated_db, 'database.db')
-                
-                # Cleanup
-                if os.path.exists(temp_old_db):
-                    os.remove(temp_old_db)
-                
-                flash(f'Database migrated successfully! Old database backed up as {backup_name}', 'success')
-            else:
-                flash('Migration failed. Please check the uploaded file.', 'error')
-                
-        except Exception as e:
-            flash(f"Error during migration: {str(e)}", "error")
-            import traceback
-            print(traceback.format_exc())
-        finally:
-            # Cleanup temp files
-            if os.path.exists('temp_old_backup.db'):
-                os.remove('temp_old_backup.db')
-            if os.path.exists('temp_migrated.db'):
-                os.remove('temp_migrated.db')
-            
+        # Save uploaded file now; the migration itself runs as a background job
+        temp_old_db = f'temp_old_backup_{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}.db'
+        file.save(temp_old_db)
+        job_id = jobs.submit('migrate_db', run_migration, temp_old_db,
+                             created_by=session['user']['email'], message=f'Migrating {file.filename}')
+        flash(f'Migration started as job #{job_id}. Track it on the Jobs page.', 'success')
+
     return redirect(url_for('admin_dashboard'))
 
 
+@app.route('/admin/backups', methods=['GET', 'POST'])
+@auth.admin_required
+def manage_backups():
+    if request.method == 'POST':
+        snap = backups.snapshot('manual')
+        flash(f"Snapshot {snap['id']} taken in {snap['seconds']}s: {snap['new_chunks']} of "
+              f"{len(snap['chunks'])} chunks were new.", "success")
+        return redirect(url_for('manage_backups'))
+
+    return render_template('admin_backups.html', snapshots=backups.list_snapshots(),
+                           stats=backups.store_stats(), retention=backups.RETENTION)
+
+
+@app.route('/admin/backups/<snapshot_id>/download')
+@auth.admin_required
+def download_snapshot(snapshot_id):
+    try:
+        return send_file(backups.export(snapshot_id), as_attachment=True,
+                         download_name=f"{snapshot_id}.db.gz", mimetype='application/gzip')
+    except KeyError:
+        flash("No such snapshot.", "error")
+    except backups.RestoreError as e:
+        flash(str(e), "error")
+    return redirect(url_for('manage_backups'))
+
+
+@app.route('/admin/backups/<snapshot_id>/restore', methods=['POST'])
+@auth.admin_required
+def restore_snapshot(snapshot_id):
+    try:
+        before = backups.restore_snapshot(snapshot_id)
+        flash(f"Restored snapshot {snapshot_id}. The previous database is kept as snapshot {before}.", "success")
+    except KeyError:
+        flash("No such snapshot.", "error")
+    except backups.RestoreError as e:
+        flash(f"Restore rejected: {str(e)}", "error")
+    return redirect(url_for('manage_backups'))
+
+
 @app.route('/admin/presets/delete/<int:preset_id>')
+@auth.admin_required
 def delete_preset(preset_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
 
-    # Cascade delete (Subjects -> Components) handled? No, SQLite FK default is NO ACTION often unless ON DELETE CASCADE set.
-    # Manual cleanup is safer.
-    cursor.execute("SELECT id FROM subjects WHERE preset_id=?", (preset_id,))
-    subjects = cursor.fetchall()
-    
-    for subj in subjects:
-        cursor.execute("DELETE FROM components WHERE subject_id=?", (subj[0],))
-    
-    cursor.execute("DELETE FROM subjects WHERE preset_id=?", (preset_id,))
+    # Subjects, components, marks and results go with it (ON DELETE CASCADE)
     cursor.execute("DELETE FROM presets WHERE id=?", (preset_id,))
 
     conn.commit()
@@ -329,11 +404,8 @@ def delete_preset(preset_id):
 
 
 @app.route('/admin/presets/edit/<int:preset_id>', methods=['POST'])
+@auth.admin_required
 def edit_preset(preset_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     academic_year = request.form['academic_year']
     course = request.form['course']
     department = request.form['department'] # New Field
@@ -355,68 +427,69 @@ def edit_preset(preset_id):
 
 
 @app.route('/admin/presets/duplicate/<int:preset_id>', methods=['POST'])
+@auth.admin_required
 def duplicate_preset(preset_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
-    # 1. Create the NEW Preset
-    academic_year = request.form['academic_year']
-    course = request.form['course']
-    department = request.form['department'] # New Field
-    year = request.form['year']
-    division = request.form['division']
-    semester = request.form['semester']
+    fields = {name: request.form[name] for name in preset_copy.PRESET_FIELDS}
 
     conn = create_connection()
     cursor = conn.cursor()
-    
-    cursor.execute(
-        "INSERT INTO presets (academic_year, course, department, year, division, semester) VALUES (?, ?, ?, ?, ?, ?)",
-        (academic_year, course, department, year, division, semester)
-    )
-    new_preset_id = cursor.lastrowid
-
-    # 2. Fetch Original Subjects
-    cursor.execute("SELECT * FROM subjects WHERE preset_id=?", (preset_id,))
-    original_subjects = cursor.fetchall()
 
-    # 3. Copy Subjects & Components
-    for subj in original_subjects:
-        # subj: (id, preset_id, name, code, credits)
-        cursor.execute(
-            "INSERT INTO subjects (preset_id, name, code, credits) VALUES (?, ?, ?, ?)",
-            (new_preset_id, subj[2], subj[3], subj[4])
-        )
-        new_subject_id = cursor.lastrowid
-        
-        # Fetch Components for this subject
-        cursor.execute("SELECT * FROM components WHERE subject_id=?", (subj[0],))
-        components = cursor.fetchall()
-        
-        # Copy Components
-        for comp in components:
-            # comp: (id, subject_id, name, max_marks)
-            cursor.execute(
-                "INSERT INTO components (subject_id, name, max_marks) VALUES (?, ?, ?)",
-                (new_subject_id, comp[2], comp[3])
-            )
+    # New preset, subjects and components in three set-based statements
+    _, subjects, components = preset_copy.clone_presets(cursor, [(preset_id, fields)])
 
     conn.commit()
     conn.close()
 
-    flash(f'Preset cloned successfully! Created {len(original_subjects)} subjects.', 'success')
+    flash(f'Preset cloned successfully! Created {subjects} subjects and {components} components.', 'success')
     return redirect(url_for('admin_dashboard'))
 
 
+@app.route('/admin/rollover', methods=['GET', 'POST'])
+@auth.admin_required
+def rollover_year():
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT academic_year FROM presets ORDER BY academic_year DESC")
+    years = [row[0] for row in cursor.fetchall()]
+
+    from_year = request.values.get('from_year') or (years[0] if years else '')
+    to_year = (request.values.get('to_year') or '').strip() or preset_copy.next_academic_year(from_year) or ''
+    departments = request.form.getlist('departments')
+    cursor.execute("SELECT DISTINCT COALESCE(department, '') FROM presets WHERE academic_year=? ORDER BY 1",
+                   (from_year,))
+    all_departments = [row[0] for row in cursor.fetchall()]
+
+    plan = None
+    if request.method == 'POST':
+        if not to_year or to_year == from_year:
+            flash("Choose a new academic year different from the one being copied.", "error")
+        elif request.form.get('action') == 'apply':
+            conn.close()
+            job_id = jobs.submit('rollover', run_rollover, from_year, to_year, departments,
+                                 created_by=session['user']['email'],
+                                 message=f'Rolling presets over from {from_year} to {to_year}')
+            flash(f"Rollover from {from_year} to {to_year} started as job #{job_id}.", "success")
+            return redirect(url_for('admin_jobs'))
+        else:
+            plan = preset_copy.rollover_plan(cursor, from_year, to_year, departments)
+    conn.close()
+
+    return render_template('admin_rollover.html', years=years, from_year=from_year, to_year=to_year,
+                           all_departments=all_departments, departments=departments, plan=plan)
+
+
+def run_rollover(job, from_year, to_year, departments):
+    conn = create_connection()
+    try:
+        job.check_cancelled()
+        return preset_copy.roll_over(conn, from_year, to_year, departments)
+    finally:
+        conn.close()
+
+
 @app.route('/admin')
+@auth.admin_required
 def admin_dashboard():
-    # Admin Logic from ENV (List supported)
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM presets")
@@ -424,11 +497,8 @@ def admin_dashboard():
     conn.close()
     return render_template('admin.html', presets=presets)
 @app.route('/admin/presets/add', methods=['POST'])
+@auth.admin_required
 def add_preset():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     academic_year = request.form['academic_year']
     department = request.form['department'] # New Field
     course = 'BE' # Hardcoded
@@ -482,21 +552,13 @@ def student_dashboard():
                 flash("Please select a class.", "error")
                 return redirect(url_for('student_dashboard'))
                 
-            cursor.execute("SELECT * FROM presets WHERE id=?", (preset_id,))
-            preset = cursor.fetchone()
+            # Preset, subjects and components come from the in-process cache
+            tree = preset_cache.get_tree(cursor, preset_id) if preset_id.isdigit() else None
 
-            if not preset:
+            if not tree:
                 flash("Selected class not found.", "error")
                 return redirect(url_for('student_dashboard'))
 
-            cursor.execute("SELECT * FROM subjects WHERE preset_id=?", (preset_id,))
-            subjects = cursor.fetchall()
-
-            subject_components = {}
-            for s in subjects:
-                cursor.execute("SELECT * FROM components WHERE subject_id=?", (s[0],))
-                subject_components[s[0]] = cursor.fetchall()
-            
             # Fetch existing marks for this user and preset
             # We want to map component_id -> marks_obtained
             marks_map = {}
@@ -527,9 +589,9 @@ def student_dashboard():
             return render_template(
                 'student.html',
                 presets=presets,
-                selected_preset=preset,
-                subjects=subjects,
-                subject_components=subject_components,
+                selected_preset=tree.preset,
+                subjects=tree.subjects,
+                subject_components=tree.components,
                 marks_map=marks_map, # Pass marks to template
                 user=user
             )
@@ -542,18 +604,30 @@ def student_dashboard():
                      flash("No subjects selected/found.", "error")
                      return redirect(url_for('student_dashboard'))
 
+                # 1. The preset tree (subjects + components), from the cache.
+                # Subjects outside the posted preset are ignored below.
+                preset_id = request.form.get('preset_id', '')
+                if not preset_id.isdigit() and subject_ids[0].isdigit():
+                    cursor.execute("SELECT preset_id FROM subjects WHERE id = ?", (subject_ids[0],))
+                    row = cursor.fetchone()
+                    preset_id = str(row[0]) if row else ''
+                tree = preset_cache.get_tree(cursor, preset_id) if preset_id.isdigit() else None
+                grading_map = tree.grading if tree else {}
+
+                # 2. Compiled grading rules (cached until an admin edits them)
+                rules = grading.load_rules(cursor)
+
+                # 3. Compute everything in memory
+                marks_rows = []
+                result_rows = []
                 total_credits = 0
                 total_weighted_points = 0
-                
-                for subject_id in subject_ids:
-                    cursor.execute("SELECT credits FROM subjects WHERE id=?", (subject_id,))
-                    res_credits = cursor.fetchone()
-                    if not res_credits: 
-                        continue 
-                    credits = res_credits[0]
 
-                    cursor.execute("SELECT id, max_marks FROM components WHERE subject_id=?", (subject_id,))
-                    components = cursor.fetchall()
+                for subject_id in subject_ids:
+                    subject = grading_map.get(int(subject_id)) if subject_id.isdigit() else None
+                    if not subject:
+                        continue
+                    credits, components = subject
 
                     total_obtained = 0
                     total_max = 0
@@ -566,40 +640,33 @@ def student_dashboard():
                         if not marks_str.replace('.', '', 1).isdigit():
                             marks_str = '0'
                         marks = float(marks_str)
-                        
+
                         total_obtained += marks
                         total_max += max_marks
+                        marks_rows.append((user_id, comp_id, marks))
 
-                        cursor.execute(
-                            "INSERT OR REPLACE INTO student_marks (user_id, component_id, marks_obtained) VALUES (?, ?, ?)",
-                            (user_id, comp_id, marks)
-                        )
-                    
                     if total_max > 0:
                         percentage = (total_obtained / total_max) * 100
                     else:
                         percentage = 0
 
-                    # Find new grade from rules
-                    cursor.execute("SELECT min_percentage, max_percentage, grade, grade_point FROM grading_rules")
-                    rules = cursor.fetchall()
-                    
-                    grade, grade_point = 'F', 0.0
-                    for min_p, max_p, g, p in rules:
-                        if percentage >= min_p and percentage <= max_p:
-                            grade, grade_point = g, p
-                            break
+                    grade, grade_point = rules.grade(percentage)
 
                     total_credits += credits
                     total_weighted_points += grade_point * credits
-
-                    cursor.execute(
-                        "INSERT OR REPLACE INTO subject_results (user_id, subject_id, total_obtained_marks, total_max_marks, percentage, grade, grade_point) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (user_id, subject_id, total_obtained, total_max, percentage, grade, grade_point)
-                    )
+                    result_rows.append((user_id, int(subject_id), total_obtained, total_max, percentage, grade, grade_point))
 
                 cgpa = total_weighted_points / total_credits if total_credits else 0
 
+                # 4. Write back in batches
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO student_marks (user_id, component_id, marks_obtained) VALUES (?, ?, ?)",
+                    marks_rows
+                )
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO subject_results (user_id, subject_id, total_obtained_marks, total_max_marks, percentage, grade, grade_point) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    result_rows
+                )
                 cursor.execute(
                     "INSERT OR REPLACE INTO cgpa (user_id, cgpa) VALUES (?, ?)",
                     (user_id, cgpa)
@@ -639,27 +706,49 @@ def view_result():
     if 'user' not in session:
         return redirect(url_for('index'))
 
+    user_id = auth.user_id()
+    if user_id is None:
+        session.pop('user', None)
+        flash("Session expired or user not found. Please log in again.", "error")
+        return redirect(url_for('login'))
+
+    # Unchanged since the browser's copy: answer before touching the results
+    etag, last_modified = http_cache.validators(f'user:{user_id}', 'presets')
+    cached = http_cache.not_modified(etag, last_modified)
+    if cached:
+        return cached
+
     conn = create_connection()
     cursor = conn.cursor()
 
     try:
-        cursor.execute("SELECT id FROM users WHERE email=?", (session['user']['email'],))
-        user_res = cursor.fetchone()
-        
-        if not user_res:
-            session.pop('user', None)
-            flash("Session expired or user not found. Please log in again.", "error")
-            return redirect(url_for('login'))
-            
-        user_id = user_res[0]
+        # Semesters with their stored totals and SGPA (see semester_results)
+        cursor.execute("""
+            SELECT sem.preset_id, p.course, p.year, p.semester, sem.total_credits, sem.total_points, sem.sgpa
+            FROM semester_results sem
+            JOIN presets p ON p.id = sem.preset_id
+            WHERE sem.user_id = ?
+            ORDER BY p.year DESC, p.semester DESC
+        """, (user_id,))
 
-        # Fetch subject results joined with subject and preset info
+        # Group results by preset (Semester)
+        grouped_results = {}
+        # Structure: { preset_id: { 'details': preset_details, 'subjects': [], 'sgpa': 0.0 } }
+        for row in cursor.fetchall():
+            grouped_results[row[0]] = {
+                'course': row[1],
+                'year': row[2],
+                'semester': row[3],
+                'subjects': [],
+                'total_credits': row[4],
+                'total_points': row[5],
+                'sgpa': round(row[6], 2)
+            }
+
+        # Fetch subject results for each semester
         cursor.execute("""
             SELECT 
-                p.id as preset_id,
-                p.course,
-                p.year,
-                p.semester,
+                s.preset_id,
                 s.name as subject_name, 
                 sr.total_obtained_marks, 
                 sr.total_max_marks, 
@@ -669,53 +758,26 @@ def view_result():
                 s.credits
             FROM subject_results sr
             JOIN subjects s ON sr.subject_id = s.id
-            JOIN presets p ON s.preset_id = p.id
             WHERE sr.user_id = ?
-            ORDER BY p.year DESC, p.semester DESC
+            ORDER BY s.id
         """, (user_id,))
-        
-        raw_results = cursor.fetchall()
-        
-        # Group results by preset (Semester)
-        grouped_results = {}
-        # Structure: { preset_id: { 'details': preset_details, 'subjects': [], 'sgpa': 0.0 } }
-        
-        for row in raw_results:
-            preset_id = row[0]
-            if preset_id not in grouped_results:
-                grouped_results[preset_id] = {
-                    'course': row[1],
-                    'year': row[2],
-                    'semester': row[3],
-                    'subjects': [],
-                    'total_credits': 0,
-                    'total_points': 0
-                }
-            
-            # Add subject info
-            grouped_results[preset_id]['subjects'].append({
-                'name': row[4],
-                'obtained': row[5],
-                'max': row[6],
-                'percentage': row[7],
-                'grade': row[8],
-                'point': row[9],
-                'credits': row[10]
+
+        for row in cursor.fetchall():
+            if row[0] not in grouped_results:
+                continue
+            grouped_results[row[0]]['subjects'].append({
+                'name': row[1],
+                'obtained': row[2],
+                'max': row[3],
+                'percentage': row[4],
+                'grade': row[5],
+                'point': row[6],
+                'credits': row[7]
             })
-            
-            # Accumulate for SGPA
-            grouped_results[preset_id]['total_credits'] += row[10]
-            grouped_results[preset_id]['total_points'] += (row[9] * row[10]) # grade_point * credits
-
-        # Calculate SGPA for each group
-        for pid, data in grouped_results.items():
-            if data['total_credits'] > 0:
-                data['sgpa'] = round(data['total_points'] / data['total_credits'], 2)
-            else:
-                data['sgpa'] = 0.0
 
         conn.close()
-        return render_template('result.html', grouped_results=grouped_results)
+        return http_cache.add_validators(
+            make_response(render_template('result.html', grouped_results=grouped_results)), etag, last_modified)
         
     except Exception as e:
         import traceback
@@ -728,11 +790,8 @@ def view_result():
 
 
 @app.route('/admin/students')
+@auth.admin_required
 def view_students():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT id, name, roll_number, email, enrollment_number, department, academic_year, current_year FROM users WHERE is_admin=0")
@@ -742,12 +801,22 @@ def view_students():
     return render_template('view_students.html', students=students)
 
 
+def run_regrade(job):
+    conn = create_connection()
+    try:
+        cursor = conn.cursor()
+        job.progress(0.1, 'Regrading results', force=True)
+        stats = grading.regrade_all(cursor, grading.load_rules(cursor))
+        job.check_cancelled()
+        conn.commit()
+        return stats
+    finally:
+        conn.close()
+
+
 @app.route('/admin/grading_rules', methods=['GET', 'POST'])
+@auth.admin_required
 def manage_grading_rules():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
 
@@ -773,40 +842,12 @@ def manage_grading_rules():
             except (ValueError, IndexError):
                 continue
 
-        # Recalculate all grades and CGPA since rules changed
-        cursor.execute("SELECT min_percentage, max_percentage, grade, grade_point FROM grading_rules")
-        current_rules = cursor.fetchall()
-
-        cursor.execute("PRAGMA table_info(subject_results)")
-        columns = [col[1] for col in cursor.fetchall()]
-        obt_col = 'total_obtained_marks' if 'total_obtained_marks' in columns else 'total_obtained'
-        max_col = 'total_max_marks' if 'total_max_marks' in columns else 'total_max'
-
-        cursor.execute(f"SELECT id, user_id, {obt_col}, {max_col} FROM subject_results")
-        all_results = cursor.fetchall()
-
-        for res_id, u_id, obt, mx in all_results:
-            perc = (obt / mx * 100) if mx and mx > 0 else 0
-            new_g, new_p = 'F', 0.0
-            for r_min, r_max, r_g, r_p in current_rules:
-                if perc >= r_min and perc <= r_max:
-                    new_g, new_p = r_g, r_p
-                    break
-            cursor.execute("UPDATE subject_results SET percentage=?, grade=?, grade_point=? WHERE id=?", (perc, new_g, new_p, res_id))
-
-        # Update CGPAs
-        cursor.execute("SELECT DISTINCT user_id FROM subject_results")
-        u_ids = cursor.fetchall()
-        for (u_id,) in u_ids:
-            cursor.execute("SELECT sr.grade_point, s.credits FROM subject_results sr JOIN subjects s ON sr.subject_id = s.id WHERE sr.user_id=?", (u_id,))
-            marks = cursor.fetchall()
-            t_cred = sum(m[1] for m in marks)
-            t_pts = sum(m[0] * m[1] for m in marks)
-            new_cgpa = t_pts / t_cred if t_cred > 0 else 0
-            cursor.execute("INSERT OR REPLACE INTO cgpa (user_id, cgpa) VALUES (?, ?)", (u_id, new_cgpa))
-
         conn.commit()
-        flash("Grading rules updated and all student records recalculated!", "success")
+
+        # Recalculate all grades and CGPA in the background since rules changed
+        job_id = jobs.submit('regrade', run_regrade, created_by=session['user']['email'],
+                             message='Regrading all results')
+        flash(f"Grading rules updated! Recalculating all student records as job #{job_id}.", "success")
 
     cursor.execute("SELECT * FROM grading_rules")
     rules = cursor.fetchall()
@@ -816,11 +857,8 @@ def manage_grading_rules():
 
 
 @app.route('/admin/subjects/edit/<int:subject_id>', methods=['GET', 'POST'])
+@auth.admin_required
 def edit_subject(subject_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
 
@@ -852,11 +890,8 @@ def edit_subject(subject_id):
     return render_template('edit_subject.html', subject=subject)
 
 @app.route('/admin/subjects/<int:preset_id>', methods=['GET'])
+@auth.admin_required
 def manage_subjects(preset_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
 
@@ -882,11 +917,8 @@ def manage_subjects(preset_id):
 
 
 @app.route('/admin/presets/<int:preset_id>/subjects/add', methods=['POST'])
+@auth.admin_required
 def add_subject(preset_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     name = request.form['name']
     code = request.form['code']
     credits = request.form['credits']
@@ -915,19 +947,83 @@ def add_subject(preset_id):
     return redirect(url_for('manage_subjects', preset_id=preset_id))
 
 
+@app.route('/admin/presets/<int:preset_id>/marks/template')
+@auth.admin_required
+def marks_template(preset_id):
+    """CSV with the import header and the class roster, ready to fill in."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT department, year FROM presets WHERE id=?", (preset_id,))
+    preset = cursor.fetchone()
+    if not preset:
+        conn.close()
+        flash("Preset not found.", "error")
+        return redirect(url_for('admin_dashboard'))
+
+    header = marks_import.template_header(marks_import.load_components(cursor, preset_id))
+    cursor.execute("""
+        SELECT roll_number, name FROM users
+        WHERE current_year = ? AND department = ? AND is_admin = 0
+        ORDER BY roll_number
+    """, (preset[1], preset[0]))
+    rows = [header] + [[roll or '', name or ''] + [''] * (len(header) - 2) for roll, name in cursor.fetchall()]
+    conn.close()
+
+    response = Response(''.join(reports.csv_chunks(rows)), mimetype='text/csv')
+    response.headers["Content-Disposition"] = f"attachment; filename=marks_preset_{preset_id}.csv"
+    return response
+
+
+@app.route('/admin/presets/<int:preset_id>/marks/import', methods=['POST'])
+@auth.admin_required
+def import_marks(preset_id):
+    file = request.files.get('marks_file')
+    if not file or file.filename == '':
+        flash('No selected file', 'error')
+        return redirect(url_for('manage_subjects', preset_id=preset_id))
+
+    dry_run = bool(request.form.get('dry_run'))
+    conn = create_connection()
+    try:
+        report = marks_import.import_marks(conn, preset_id, file.filename, file.stream, dry_run=dry_run)
+    except spreadsheets.SpreadsheetError as e:
+        flash(f"Import rejected: {str(e)}", "error")
+        return redirect(url_for('manage_subjects', preset_id=preset_id))
+    except Exception as e:
+        flash(f"Error importing marks: {str(e)}", "error")
+        return redirect(url_for('manage_subjects', preset_id=preset_id))
+    finally:
+        conn.close()
+
+    summary = f"{report['marks']} marks for {report['students']} students ({report['rows']} rows)"
+    if report['ignored_columns']:
+        flash(f"Ignored columns: {', '.join(report['ignored_columns'])}", "info")
+    if report['error_count']:
+        flash(f"Nothing imported: {report['error_count']} problem(s) in {summary}.", "error")
+        for message in report['errors'][:10]:
+            flash(message, "error")
+        if report['error_count'] > 10:
+            flash(f"...and {report['error_count'] - 10} more.", "error")
+    elif report['imported']:
+        flash(f"Imported {summary}; {report['results']} subject results updated "
+              f"in {report['elapsed']:.2f}s.", "success")
+    elif dry_run:
+        flash(f"File is valid: {summary}. Nothing was written.", "success")
+    else:
+        flash("No marks found in the file.", "info")
+    return redirect(url_for('manage_subjects', preset_id=preset_id))
+
+
 @app.route('/admin/subjects/delete/<int:subject_id>')
+@auth.admin_required
 def delete_subject(subject_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
 
     cursor.execute("SELECT preset_id FROM subjects WHERE id=?", (subject_id,))
     preset_id = cursor.fetchone()[0]
 
-    cursor.execute("DELETE FROM components WHERE subject_id=?", (subject_id,))
+    # Components, marks and results go with it (ON DELETE CASCADE)
     cursor.execute("DELETE FROM subjects WHERE id=?", (subject_id,))
 
     conn.commit()
@@ -938,11 +1034,8 @@ def delete_subject(subject_id):
 
 
 @app.route('/admin/students/edit/<int:user_id>', methods=['GET', 'POST'])
+@auth.admin_required
 def edit_student_record(user_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
 
@@ -974,17 +1067,12 @@ def edit_student_record(user_id):
 
 
 @app.route('/admin/students/delete/<int:user_id>')
+@auth.admin_required
 def delete_student_record(user_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
     conn = create_connection()
     cursor = conn.cursor()
 
-    cursor.execute("DELETE FROM student_marks WHERE user_id=?", (user_id,))
-    cursor.execute("DELETE FROM subject_results WHERE user_id=?", (user_id,))
-    cursor.execute("DELETE FROM cgpa WHERE user_id=?", (user_id,))
+    # Marks, results and CGPA go with it (ON DELETE CASCADE)
     cursor.execute("DELETE FROM users WHERE id=?", (user_id,))
 
     conn.commit()
@@ -995,10 +1083,12 @@ def delete_student_record(user_id):
 
 
 @app.route('/admin/students/<int:user_id>/marks')
+@auth.admin_required
 def view_student_marks(user_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
+    etag, last_modified = http_cache.validators(f'user:{user_id}', 'presets')
+    cached = http_cache.not_modified(etag, last_modified)
+    if cached:
+        return cached
 
     conn = create_connection()
     cursor = conn.cursor()
@@ -1007,13 +1097,33 @@ def view_student_marks(user_id):
     cursor.execute("SELECT * FROM users WHERE id=?", (user_id,))
     student = cursor.fetchone()
 
-    # Fetch subject results joined with subject and preset info
+    # Semesters with their stored totals and SGPA (see semester_results)
+    cursor.execute("""
+        SELECT sem.preset_id, p.course, p.year, p.semester, sem.total_credits, sem.total_points, sem.sgpa
+        FROM semester_results sem
+        JOIN presets p ON p.id = sem.preset_id
+        WHERE sem.user_id = ?
+        ORDER BY p.year DESC, p.semester DESC
+    """, (user_id,))
+
+    grouped_results = {}
+    detailed_marks = {}
+
+    for row in cursor.fetchall():
+        grouped_results[row[0]] = {
+            'course': row[1],
+            'year': row[2],
+            'semester': row[3],
+            'subjects': [],
+            'total_credits': row[4],
+            'total_points': row[5],
+            'sgpa': round(row[6], 2)
+        }
+
+    # Subject results for each semester
     cursor.execute("""
         SELECT 
-            p.id as preset_id,
-            p.course,
-            p.year,
-            p.semester,
+            s.preset_id,
             s.name as subject_name, 
             s.code,
             s.credits,
@@ -1025,60 +1135,37 @@ def view_student_marks(user_id):
             s.id as subject_id
         FROM subject_results sr
         JOIN subjects s ON sr.subject_id = s.id
-        JOIN presets p ON s.preset_id = p.id
         WHERE sr.user_id = ?
-        ORDER BY p.year DESC, p.semester DESC
+        ORDER BY s.id
     """, (user_id,))
-    
-    raw_results = cursor.fetchall()
-    
-    grouped_results = {}
-    detailed_marks = {}
 
-    for row in raw_results:
-        preset_id = row[0]
-        subject_id = row[12]
-        
-        if preset_id not in grouped_results:
-            grouped_results[preset_id] = {
-                'course': row[1],
-                'year': row[2],
-                'semester': row[3],
-                'subjects': [],
-                'total_credits': 0,
-                'total_points': 0
-            }
-        
-        grouped_results[preset_id]['subjects'].append({
-            'name': row[4],
-            'code': row[5],
-            'credits': row[6],
-            'obtained': row[7],
-            'max': row[8],
-            'percentage': row[9],
-            'grade': row[10],
-            'point': row[11],
-            'id': subject_id
+    for row in cursor.fetchall():
+        if row[0] not in grouped_results:
+            continue
+        grouped_results[row[0]]['subjects'].append({
+            'name': row[1],
+            'code': row[2],
+            'credits': row[3],
+            'obtained': row[4],
+            'max': row[5],
+            'percentage': row[6],
+            'grade': row[7],
+            'point': row[8],
+            'id': row[9]
         })
-        
-        grouped_results[preset_id]['total_credits'] += row[6]
-        grouped_results[preset_id]['total_points'] += (row[11] * row[6])
+        detailed_marks[row[9]] = []
 
-        # Fetch component marks for this subject
-        cursor.execute("""
-            SELECT c.name, sm.marks_obtained, c.max_marks
-            FROM student_marks sm
-            JOIN components c ON sm.component_id = c.id
-            WHERE sm.user_id = ? AND c.subject_id = ?
-        """, (user_id, subject_id))
-        detailed_marks[subject_id] = cursor.fetchall()
-
-    # Calculate SGPA for each group
-    for pid, data in grouped_results.items():
-        if data['total_credits'] > 0:
-            data['sgpa'] = round(data['total_points'] / data['total_credits'], 2)
-        else:
-            data['sgpa'] = 0.0
+    # Component marks for all subjects in one read
+    cursor.execute("""
+        SELECT c.subject_id, c.name, sm.marks_obtained, c.max_marks
+        FROM student_marks sm
+        JOIN components c ON sm.component_id = c.id
+        WHERE sm.user_id = ?
+        ORDER BY c.id
+    """, (user_id,))
+    for subject_id, name, obtained, max_marks in cursor.fetchall():
+        if subject_id in detailed_marks:
+            detailed_marks[subject_id].append((name, obtained, max_marks))
 
     # Get Final CGPA
     cursor.execute("SELECT cgpa FROM cgpa WHERE user_id=?", (user_id,))
@@ -1087,23 +1174,22 @@ def view_student_marks(user_id):
 
     conn.close()
 
-    return render_template(
+    return http_cache.add_validators(make_response(render_template(
         'admin_student_results.html',
         student=student,
         grouped_results=grouped_results,
         detailed_marks=detailed_marks,
         cgpa=cgpa
-    )
+    )), etag, last_modified)
 
 
 @app.route('/admin/students/<int:user_id>/download_csv')
+@auth.admin_required
 def download_student_csv(user_id):
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-
-    import csv
-    import io
+    etag, last_modified = http_cache.validators(f'user:{user_id}', 'presets')
+    cached = http_cache.not_modified(etag, last_modified)
+    if cached:
+        return cached
 
     conn = create_connection()
     cursor = conn.cursor()
@@ -1111,54 +1197,22 @@ def download_student_csv(user_id):
     # Get student info
     cursor.execute("SELECT name, roll_number, email, enrollment_number, department, current_year FROM users WHERE id=?", (user_id,))
     student = cursor.fetchone()
-    student_name = student[0]
-
-    # Get Marks Data
-    # ... (skipping context)
-
-    # Generate CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-
-    writer.writerow(['Student Report'])
-    writer.writerow(['Name', student[0]])
-    writer.writerow(['Roll Number', student[1]])
-    writer.writerow(['Email', student[2]])
-    writer.writerow(['Enrollment Number', student[3] or '-'])
-    writer.writerow(['Department', student[4] or '-'])
-    writer.writerow(['Current Year', student[5] or '-'])
-    writer.writerow(['SGPA/CGPA', cgpa])
-    writer.writerow([])
-    
-    writer.writerow(['--- Detailed Component Marks ---'])
-    writer.writerow(['Subject', 'Code', 'Component', 'Obtained', 'Max'])
-    for row in marks_data:
-        writer.writerow(row)
-    
-    writer.writerow([])
-    writer.writerow(['--- Subject Grades ---'])
-    writer.writerow(['Subject', 'Percentage', 'Grade', 'Grade Point'])
-    for row in results_data:
-        writer.writerow(row)
-
-    output.seek(0)
-    
-    # Using 'send_file' with BytesIO would be better but StringIO works if we encode
-    # Alternatively send_file expects bytes usually or a path. 
-    # Let's use make_response to just send the string as csv
-    from flask import make_response
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = f"attachment; filename=result_{student_name}.csv"
-    response.headers["Content-type"] = "text/csv"
-    return response
+    if not student:
+        flash("Student not found.", "error")
+        return redirect(url_for('view_students'))
 
+    rows = reports.iter_student_report_rows(cursor, student, user_id)
+    return http_cache.add_validators(stream_export(rows, f"result_{student[0]}", 'csv'), etag, last_modified)
 
 
 @app.route('/admin/master_sheet')
+@auth.admin_required
 def master_sheet():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
+    selected_preset_id = request.args.get('preset_id')
+    etag, last_modified = http_cache.validators('presets', *_results_namespaces([selected_preset_id]))
+    cached = http_cache.not_modified(etag, last_modified)
+    if cached:
+        return cached
 
     conn = create_connection()
     cursor = conn.cursor()
@@ -1167,160 +1221,147 @@ def master_sheet():
     cursor.execute("SELECT * FROM presets")
     presets = cursor.fetchall()
 
-    selected_preset_id = request.args.get('preset_id')
-    
     table_headers = []
     students_data = []
     subjects = []
 
     if selected_preset_id:
-        # Get Preset Info
-        cursor.execute("SELECT * FROM presets WHERE id=?", (selected_preset_id,))
-        preset = cursor.fetchone()
-
-        # 1. Get Subjects (Columns)
-        cursor.execute("SELECT id, name, code, credits FROM subjects WHERE preset_id=?", (selected_preset_id,))
-        subjects = cursor.fetchall()
-        
-        # Prepare headers: Name, Roll, [Sub1, Sub2...], SGPA/CGPA
-        table_headers = ['Roll Number', 'Name'] + [s[1] for s in subjects] + ['SGPA/CGPA']
-        
-        # 2. Find students who have taken these subjects
-        if subjects:
-            subject_ids = tuple([s[0] for s in subjects])
-            # Handle case with 1 subject
-            if len(subject_ids) == 1:
-                query_condition = f"({subject_ids[0]})"
-            else:
-                query_condition = str(subject_ids)
-            
-            query = f"""
-                SELECT DISTINCT u.id, u.name, u.roll_number 
-                FROM users u
-                JOIN subject_results sr ON u.id = sr.user_id
-                WHERE sr.subject_id IN {query_condition}
-                ORDER BY u.roll_number
-            """
-            cursor.execute(query)
-            students = cursor.fetchall()
-
-            # 3. Build Row Data
-            for student in students:
-                user_id = student[0]
-                row = {
-                    'roll': student[2],
-                    'name': student[1],
-                    'marks': {},
-                    'cgpa': 0
-                }
-
-                # Fetch marks for each subject
-                for sub in subjects:
-                    sub_id = sub[0]
-                    cursor.execute("""
-                        SELECT percentage, grade, grade_point 
-                        FROM subject_results 
-                        WHERE user_id=? AND subject_id=?
-                    """, (user_id, sub_id))
-                    res = cursor.fetchone()
-                    if res:
-                        row['marks'][sub_id] = f"{res[1]} ({int(res[0])}%)"
-                    else:
-                        row['marks'][sub_id] = "-"
-                
-                # Fetch CGPA
-                cursor.execute("SELECT cgpa FROM cgpa WHERE user_id=?", (user_id,))
-                cgpa_res = cursor.fetchone()
-                row['cgpa'] = "%.2f" % cgpa_res[0] if cgpa_res else "-"
-                
-                students_data.append(row)
+        # Whole class grid in a constant number of queries
+        grid = reports.build_master_grid(cursor, selected_preset_id)
+        if grid is not None:
+            subjects = grid.subjects
+            # Prepare headers: Name, Roll, [Sub1, Sub2...], SGPA/CGPA
+            table_headers = ['Roll Number', 'Name'] + [s[1] for s in subjects] + ['SGPA/CGPA']
+            students_data = grid.student_dicts()
 
     conn.close()
 
-    return render_template('master_sheet.html', 
-                           presets=presets, 
-                           selected_preset_id=int(selected_preset_id) if selected_preset_id else None,
-                           headers=table_headers,
-                           subjects=subjects,
-                           students_data=students_data)
+    return http_cache.add_validators(make_response(render_template(
+        'master_sheet.html',
+        presets=presets,
+        selected_preset_id=int(selected_preset_id) if selected_preset_id else None,
+        headers=table_headers,
+        subjects=subjects,
+        students_data=students_data,
+        departments=sorted({p[3] for p in presets if p[3]}),
+        years=sorted({p[4] for p in presets if p[4]}))), etag, last_modified)
+
+
+def _results_namespaces(preset_ids):
+    """cache_bus namespaces of the master sheets of `preset_ids` (given ones only)."""
+    return [f'results:{int(preset_id)}' for preset_id in preset_ids if str(preset_id or '').isdigit()]
 
 
 @app.route('/admin/master_sheet/download')
+@auth.admin_required
 def download_master_csv():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-    
     selected_preset_id = request.args.get('preset_id')
     if not selected_preset_id:
         flash("Please select a class first.", "error")
         return redirect(url_for('master_sheet'))
 
-    import csv
-    import io
-    from flask import make_response
+    etag, last_modified = http_cache.validators('presets', *_results_namespaces([selected_preset_id]))
+    cached = http_cache.not_modified(etag, last_modified)
+    if cached:
+        return cached
 
     conn = create_connection()
     cursor = conn.cursor()
-    
-    # Logic mirrors master_sheet but writes to CSV
-    cursor.execute("SELECT * FROM presets WHERE id=?", (selected_preset_id,))
-    preset = cursor.fetchone()
-    # preset name for filename
-    preset_name = f"{preset[2]}_{preset[3]}Yr_{preset[4]}".replace(" ", "_")
+    preset, subjects = reports.load_preset(cursor, selected_preset_id)
+    if not preset:
+        flash("Class not found.", "error")
+        return redirect(url_for('master_sheet'))
 
-    cursor.execute("SELECT id, name, code, credits FROM subjects WHERE preset_id=?", (selected_preset_id,))
-    subjects = cursor.fetchall()
+    rows = reports.iter_master_rows(cursor, preset, subjects)
+    response = stream_export(rows, f"MasterSheet_{reports.preset_name(preset)}", request.args.get('format', 'csv'))
+    return http_cache.add_validators(response, etag, last_modified)
 
-    subject_ids = tuple([s[0] for s in subjects])
-    if len(subject_ids) == 1:
-        query_condition = f"({subject_ids[0]})"
-    else:
-        query_condition = str(subject_ids)
-    
-    query = f"""
-        SELECT DISTINCT u.id, u.name, u.roll_number 
-        FROM users u
-        JOIN subject_results sr ON u.id = sr.user_id
-        WHERE sr.subject_id IN {query_condition}
-        ORDER BY u.roll_number
-    """
-    cursor.execute(query)
-    students = cursor.fetchall()
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Headers
-    headers = ['Roll Number', 'Name'] + [f"{s[1]} (Grade)" for s in subjects] + ['SGPA/CGPA']
-    writer.writerow(headers)
-
-    for student in students:
-        user_id = student[0]
-        row_data = [student[2], student[1]] # Roll, Name
-
-        for sub in subjects:
-            sub_id = sub[0]
-            cursor.execute("SELECT percentage, grade FROM subject_results WHERE user_id=? AND subject_id=?", (user_id, sub_id))
-            res = cursor.fetchone()
-            if res:
-                row_data.append(f"{res[1]} ({int(res[0])}%)")
-            else:
-                row_data.append("-")
-        
-        cursor.execute("SELECT cgpa FROM cgpa WHERE user_id=?", (user_id,))
-        cgpa_res = cursor.fetchone()
-        row_data.append("%.2f" % cgpa_res[0] if cgpa_res else "-")
+@app.route('/admin/master_sheet/download_all')
+@auth.admin_required
+def download_master_scope():
+    department = request.args.get('department') or None
+    year = request.args.get('year') or None
+    if not department and not year:
+        flash("Pick a department or a year to export.", "error")
+        return redirect(url_for('master_sheet'))
 
-        writer.writerow(row_data)
+    conn = create_connection()
+    cursor = conn.cursor()
+    presets = reports.find_presets(cursor, department, year)
+    if not presets:
+        flash("No classes match that department/year.", "error")
+        return redirect(url_for('master_sheet'))
 
-    conn.close()
-    
-    output.seek(0)
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = f"attachment; filename=MasterSheet_{preset_name}.csv"
-    response.headers["Content-type"] = "text/csv"
+    # Which classes are in scope takes one indexed read; their sheets only
+    # get built if one of them changed
+    etag, last_modified = http_cache.validators('presets', *_results_namespaces(p[0] for p in presets))
+    cached = http_cache.not_modified(etag, last_modified)
+    if cached:
+        return cached
+
+    scope = "_".join(part for part in (department, year) if part).replace(" ", "_")
+    rows = reports.iter_scope_rows(cursor, presets)
+    response = stream_export(rows, f"MasterSheets_{scope}", request.args.get('format', 'csv'))
+    return http_cache.add_validators(response, etag, last_modified)
+
+
+def stream_export(rows, basename, fmt):
+    """Stream `rows` as a CSV or XLSX download, encoding them chunk by chunk.
+
+    `rows` is normally a generator reading a live cursor. stream_with_context
+    keeps the app context (and with it the request's pooled connection) alive
+    until the last chunk is sent; teardown then returns the connection.
+    """
+    if fmt == 'xlsx':
+        body, mimetype, filename = reports.xlsx_chunks(rows), reports.XLSX_MIMETYPE, f"{basename}.xlsx"
+    else:
+        body, mimetype, filename = reports.csv_chunks(rows), 'text/csv', f"{basename}.csv"
+
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return response
+
+
+@app.route('/admin/master_sheet/export', methods=['POST'])
+@auth.admin_required
+def export_master_csv():
+    selected_preset_id = request.form.get('preset_id')
+    if not selected_preset_id:
+        flash("Please select a class first.", "error")
+        return redirect(url_for('master_sheet'))
+
+    job_id = jobs.submit('master_export', run_master_export, selected_preset_id,
+                         created_by=session['user']['email'], message=f'Exporting master sheet for preset {selected_preset_id}')
+    flash(f"Master sheet export started as job #{job_id}. Download it from the Jobs page when done.", "success")
+    return redirect(url_for('admin_jobs'))
+
+
+def run_master_export(job, preset_id):
+    import csv
+
+    conn = create_connection()
+    try:
+        cursor = conn.cursor()
+        preset, subjects = reports.load_preset(cursor, preset_id)
+        if not preset:
+            raise ValueError(f"Preset {preset_id} not found")
+
+        job.progress(0.1, 'Writing master sheet', force=True)
+        filename = f"MasterSheet_{reports.preset_name(preset)}.csv"
+        path = jobs.export_path(job.job_id, filename)
+        written = 0
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            for row in reports.iter_master_rows(cursor, preset, subjects):
+                writer.writerow(row)
+                written += 1
+                job.check_cancelled()
+    finally:
+        conn.close()
+    return {'file': path, 'filename': filename, 'rows': written - 1}
+
+
 def download_pdf():
     if 'user' not in session:
         return redirect(url_for('index'))
@@ -1338,8 +1379,7 @@ def dev_login():
         role = request.form.get('role', 'student')
         
         if role == 'admin':
-            admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-            email = admin_emails[0] if admin_emails else "admin@tsecmumbai.in"
+            email = auth.primary_admin_email() or "admin@tsecmumbai.in"
             # User wants "developer mode". Let's use the real admin email so they can access admin dashboard 
             # if the real admin email is hardcoded.
             # But wait, logic at line 122 of original file checks user_info['email'] == ADMIN_EMAIL.
@@ -1357,8 +1397,7 @@ def dev_login():
              # So I MUST use `ADMIN_EMAIL` to be recognized as Admin in `admin_dashboard`?
              # Line 365: `if 'user' not in session or session['user']['email'] != ADMIN_EMAIL:`
              # Yes. I must use the specific email.
-             admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-             email = admin_emails[0] if admin_emails else "admin@tsecmumbai.in"
+             email = auth.primary_admin_email() or "admin@tsecmumbai.in"
              name = "Dev Admin (Master)"
 
         user_info = {
@@ -1376,7 +1415,9 @@ def dev_login():
              c.execute("INSERT INTO users (email, name, is_admin) VALUES (?, ?, ?)", 
                        (email, name, 1 if role=='admin' else 0))
              conn.commit()
+             user_id = c.lastrowid
         else:
+             user_id = u[0]
              # Ensure admin status match
              current_status = u[8] # is_admin
              target_status = 1 if role == 'admin' else 0
@@ -1389,39 +1430,222 @@ def dev_login():
 
         conn.close()
         
-        session['user'] = user_info
+        auth.login_user(user_info, user_id)
         return redirect('/')
         
     return render_template('dev_login.html')
 
+def _promotion_rules(form):
+    # Parallel department/from_year/to_year fields; blank rows are skipped
+    departments = form.getlist('department')
+    rules = []
+    for i, (from_year, to_year) in enumerate(zip(form.getlist('from_year'), form.getlist('to_year'))):
+        if not from_year and not to_year:
+            continue
+        department = departments[i] if i < len(departments) else ''
+        rules.append((department or None, from_year, to_year))
+    return rules
+
+
 @app.route('/admin/promote', methods=['GET', 'POST'])
+@auth.admin_required
 def promote_students():
-    admin_emails = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
-    if 'user' not in session or session['user']['email'] not in admin_emails:
-        return redirect(url_for('index'))
-        
+    conn = create_connection()
+    departments = sorted(set(roster.department_names(conn.cursor()).values()))
+    conn.close()
+
+    rules, moves = [], None
     if request.method == 'POST':
-        from_year = request.form['from_year']
-        to_year = request.form['to_year']
-        
-        conn = create_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM users WHERE current_year=?", (from_year,))
-        count = cursor.fetchone()[0]
-        
-        if count > 0:
-            cursor.execute("UPDATE users SET current_year=? WHERE current_year=?", (to_year, from_year))
-            conn.commit()
-            flash(f"Successfully promoted {count} students from {from_year} to {to_year}!", "success")
+        rules = _promotion_rules(request.form)
+        problems = roster.check_rules(rules) or ([] if rules else ["Add at least one rule."])
+        if problems:
+            for problem in problems:
+                flash(problem, "error")
+        elif request.form.get('action') == 'preview':
+            conn = create_connection()
+            moves = roster.promote(conn, rules, dry_run=True)
+            conn.close()
         else:
-            flash(f"No students found in {from_year}.", "warning")
-            
+            summary = ', '.join(f"{d or 'All'} {f}->{t}" for d, f, t in rules)
+            job_id = jobs.submit('promote', run_promotion, rules,
+                                 created_by=session['user']['email'], message=f'Promoting {summary}')
+            flash(f"Promotion ({summary}) started as job #{job_id}.", "success")
+            return redirect(url_for('promote_students'))
+
+    return render_template('promote_students.html', departments=departments, years=roster.YEARS,
+                           rules=rules, moves=moves)
+
+
+def run_promotion(job, rules):
+    conn = create_connection()
+    try:
+        job.check_cancelled()
+        moves = roster.promote(conn, rules)
+        return {'promoted': sum(count for *_, count in moves),
+                'moves': ', '.join(f"{d or '-'} {f}->{t}: {count}" for d, f, t, count in moves)}
+    finally:
         conn.close()
-        return redirect(url_for('promote_students'))
-        
-    return render_template('promote_students.html')
+
+
+@app.route('/admin/roster', methods=['GET', 'POST'])
+@auth.admin_required
+def roster_import():
+    report = None
+    if request.method == 'POST':
+        file = request.files.get('roster_file')
+        if not file or file.filename == '':
+            flash('No selected file', 'error')
+            return redirect(url_for('roster_import'))
+
+        on_conflict = 'abort' if request.form.get('on_conflict') == 'abort' else 'skip'
+        conn = create_connection()
+        try:
+            parsed = roster.read_roster(file.filename, file.stream, roster.department_names(conn.cursor()))
+            if parsed['error_count']:
+                flash(f"Nothing imported: {parsed['error_count']} problem(s) in the file.", "error")
+                for message in parsed['errors'][:10]:
+                    flash(message, "error")
+                if parsed['error_count'] > 10:
+                    flash(f"...and {parsed['error_count'] - 10} more.", "error")
+                return redirect(url_for('roster_import'))
+            if parsed['ignored_columns']:
+                flash(f"Ignored columns: {', '.join(parsed['ignored_columns'])}", "info")
+
+            if request.form.get('preview'):
+                report = roster.import_roster(conn, parsed['rows'], on_conflict, dry_run=True)
+            else:
+                job_id = jobs.submit('roster', run_roster_import, parsed['rows'], on_conflict,
+                                     created_by=session['user']['email'],
+                                     message=f"Importing {len(parsed['rows'])} roster rows")
+                flash(f"Roster import of {len(parsed['rows'])} rows started as job #{job_id}.", "success")
+                return redirect(url_for('admin_jobs'))
+        except spreadsheets.SpreadsheetError as e:
+            flash(f"Import rejected: {str(e)}", "error")
+            return redirect(url_for('roster_import'))
+        finally:
+            conn.close()
+
+    return render_template('admin_roster.html', report=report)
+
+
+def run_roster_import(job, rows, on_conflict):
+    conn = create_connection()
+    try:
+        job.check_cancelled()
+        report = roster.import_roster(conn, rows, on_conflict, progress=job.progress)
+        if report['aborted']:
+            raise RuntimeError(f"{report['conflict_count']} roll number conflict(s); nothing was imported. "
+                               "Preview the file to see them.")
+        result = {key: report[key] for key in ('created', 'updated', 'unchanged', 'admins', 'conflict_count')}
+        result['seconds'] = round(report['elapsed'], 2)
+        result['steps'] = ', '.join(f"{name} {rows} ({seconds * 1000:.0f} ms)" for name, rows, seconds in report['steps'])
+        return result
+    finally:
+        conn.close()
+
+
+@app.route('/admin/jobs')
+@auth.admin_required
+def admin_jobs():
+    job_list = jobs.list_jobs()
+    active = any(j['status'] in ('queued', 'running') for j in job_list)
+    return render_template('admin_jobs.html', jobs=job_list, active=active)
+
+
+@app.route('/admin/jobs/<int:job_id>')
+@auth.admin_required
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+
+@app.route('/admin/jobs/<int:job_id>/cancel', methods=['POST'])
+@auth.admin_required
+def cancel_job(job_id):
+    if jobs.cancel(job_id):
+        flash(f"Cancellation requested for job #{job_id}.", "success")
+    else:
+        flash(f"Job #{job_id} is not running.", "warning")
+    return redirect(url_for('admin_jobs'))
+
+
+@app.route('/admin/jobs/<int:job_id>/download')
+@auth.admin_required
+def download_job_file(job_id):
+    job = jobs.get_job(job_id)
+    if not job or job['status'] != 'done' or not job['result'] or 'file' not in job['result']:
+        flash("No file available for this job.", "error")
+        return redirect(url_for('admin_jobs'))
+    return send_file(os.path.abspath(job['result']['file']), as_attachment=True,
+                     download_name=job['result']['filename'])
+
+
+@app.route('/admin/perf')
+@auth.admin_required
+def admin_perf():
+    return render_template('admin_perf.html',
+                           enabled=instrumentation.REPORT,
+                           threshold=instrumentation.NPLUSONE_THRESHOLD,
+                           endpoints=instrumentation.endpoint_summary(),
+                           recent=instrumentation.recent_requests(),
+                           pool=database.pool_stats(),
+                           preset_cache=preset_cache.stats(),
+                           cache_bus=cache_bus.stats(),
+                           boot_seconds=metrics.boot_seconds())
+
+
+@app.route('/admin/perf/reset', methods=['POST'])
+@auth.admin_required
+def reset_perf():
+    instrumentation.reset()
+    flash("Performance stats cleared for this worker.", "success")
+    return redirect(url_for('admin_perf'))
+
+
+@app.route('/admin/admins', methods=['GET', 'POST'])
+@auth.admin_required
+def manage_admins():
+    if request.method == 'POST':
+        email = request.form.get('email', '').strip().lower()
+        if not email or '@' not in email:
+            flash("Enter a valid email address.", "error")
+        else:
+            auth.add_admin(email, added_by=session['user']['email'])
+            flash(f"{email} is now an admin.", "success")
+        return redirect(url_for('manage_admins'))
+
+    return render_template('admin_admins.html', admins=auth.list_admins(),
+                           env_admins=sorted(auth.env_admins()))
+
+
+@app.route('/admin/admins/remove', methods=['POST'])
+@auth.admin_required
+def remove_admin():
+    email = request.form.get('email', '')
+    if email in auth.env_admins():
+        flash(f"{email} is listed in ADMIN_EMAILS; remove it there.", "error")
+    else:
+        auth.remove_admin(email)
+        flash(f"Removed admin access for {email}.", "success")
+    return redirect(url_for('manage_admins'))
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Scrapers send METRICS_TOKEN as a bearer token; admins can look in the
+    # browser. Open to anyone only with METRICS_PUBLIC=true.
+    token = os.environ.get('METRICS_TOKEN')
+    scraper = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    public = os.getenv('METRICS_PUBLIC', 'false').lower() == 'true'
+    if not (scraper or public or auth.current_role() == 'admin'):
+        return "Unauthorized", 401
+    if not metrics.ENABLED:
+        return "Metrics disabled", 404
+
+    body = metrics.render(extra=[('job_queue_depth', '', jobs.queue_depth())])
+    return Response(body, mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
-    create_tables()
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
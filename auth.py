@@ -0,0 +1,154 @@
+import os
+import threading
+import zlib
+from datetime import datetime
+from functools import wraps
+
+from flask import redirect, session, url_for
+
+import cache_bus
+from database import create_connection
+
+# Admins come from two places: ADMIN_EMAILS (parsed once per distinct value)
+# and the admins table (re-read only when its cache_bus version moves).
+_env = {'raw': None, 'emails': (), 'set': frozenset()}
+_db = {'version': None, 'set': frozenset()}
+_lock = threading.Lock()
+
+
+def env_admins():
+    """ADMIN_EMAILS as a frozenset."""
+    raw = os.environ.get('ADMIN_EMAILS', '')
+    if raw != _env['raw']:
+        emails = tuple(e.strip() for e in raw.split(',') if e.strip())
+        with _lock:
+            _env.update(raw=raw, emails=emails, set=frozenset(emails))
+    return _env['set']
+
+
+def primary_admin_email():
+    """First address listed in ADMIN_EMAILS, or None."""
+    env_admins()
+    return _env['emails'][0] if _env['emails'] else None
+
+
+def db_admins(force=False):
+    """Emails in the admins table as a frozenset. `force` polls the version
+    again, for changes this request has just committed."""
+    if force:
+        cache_bus.refresh()
+    version = cache_bus.version('admins')
+    if version is None:
+        emails = frozenset()
+    elif version == _db['version']:
+        return _db['set']
+    else:
+        conn = create_connection()
+        emails = frozenset(row[0] for row in conn.execute("SELECT email FROM admins").fetchall())
+        conn.close()
+
+    with _lock:
+        _db.update(version=version, set=emails)
+    return emails
+
+
+def is_admin_email(email):
+    return email in env_admins() or email in db_admins()
+
+
+def current_version():
+    """Stamp covering both admin sources; a session's cached role is only
+    trusted while this is unchanged."""
+    env_admins()
+    db_admins()
+    return f"{_db['version']}-{zlib.crc32(_env['raw'].encode()) if _env['raw'] else 0}"
+
+
+def login_user(user_info, user_id):
+    """Put the signed-in user in the session with their id and role resolved."""
+    user = dict(user_info)
+    user['id'] = user_id
+    user['id_version'] = cache_bus.version(f'user:{user_id}')
+    user['role'] = 'admin' if is_admin_email(user['email']) else 'student'
+    user['auth_version'] = current_version()
+    session['user'] = user
+
+
+def current_role():
+    """'admin', 'student', or None when nobody is signed in."""
+    user = session.get('user')
+    if not user:
+        return None
+    version = current_version()
+    if user.get('role') is None or user.get('auth_version') != version:
+        user['role'] = 'admin' if is_admin_email(user['email']) else 'student'
+        user['auth_version'] = version
+        session.modified = True
+    return user['role']
+
+
+def user_id():
+    """The signed-in user's id, cached in the session (None if unknown).
+
+    The id is trusted only while the user's cache_bus version is the one it
+    was looked up at. That version moves when the account is changed or
+    deleted, and after any restore (which may renumber users), so the id is
+    then looked up again by email. If the email is gone, the user is signed
+    out."""
+    user = session.get('user')
+    if not user:
+        return None
+    if user.get('id') is not None:
+        version = cache_bus.version(f"user:{user['id']}")
+        if version is not None and user.get('id_version') == version:
+            return user['id']
+
+    conn = create_connection()
+    row = conn.execute("SELECT id FROM users WHERE email=?", (user['email'],)).fetchone()
+    conn.close()
+    if not row:
+        session.pop('user', None)
+        return None
+    user['id'] = row[0]
+    user['id_version'] = cache_bus.version(f'user:{row[0]}')
+    session.modified = True
+    return user['id']
+
+
+def admin_required(view):
+    """Route decorator: anyone who is not an admin goes back to the index page."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_role() != 'admin':
+            return redirect(url_for('index'))
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def list_admins():
+    conn = create_connection()
+    rows = conn.execute("SELECT email, added_by, added_at FROM admins ORDER BY email").fetchall()
+    conn.close()
+    return rows
+
+
+def add_admin(email, added_by=None):
+    conn = create_connection()
+    conn.execute(
+        "INSERT OR IGNORE INTO admins (email, added_by, added_at) VALUES (?, ?, ?)",
+        (email, added_by, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    conn.execute("UPDATE users SET is_admin=1 WHERE email=?", (email,))
+    conn.commit()
+    conn.close()
+    db_admins(force=True)
+
+
+def remove_admin(email):
+    conn = create_connection()
+    conn.execute("DELETE FROM admins WHERE email=?", (email,))
+    if email not in env_admins():
+        conn.execute("UPDATE users SET is_admin=0 WHERE email=?", (email,))
+    conn.commit()
+    conn.close()
+    db_admins(force=True)
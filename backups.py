@@ -0,0 +1,454 @@
+"""Hot backups, a deduplicated snapshot store, and validated restores.
+
+snapshot() copies the live database with SQLite's online backup API, a few
+hundred pages per step, all inside one read transaction, into a temp file
+under BACKUP_DIR. The copy is a single point in time, and in WAL mode
+writers carry on while it runs. It is then read back one chunk at a time,
+so memory use stays flat however large the database grows.
+
+The copy is cut into chunks of CHUNK_PAGES pages. Each chunk is stored once
+under BACKUP_DIR/chunks, named by its SHA-256 and zlib-compressed. A
+snapshot is a JSON manifest in BACKUP_DIR/snapshots listing its chunk
+hashes. Pages that did not change since an earlier snapshot hash the same,
+so they cost nothing: only the chunks a change touched are compressed and
+written. prune() applies the retention policy (RETENTION) and deletes
+chunks no manifest uses any more.
+
+Restores never write over database.db on disk. A file (an upload, or a
+snapshot reassembled from its chunks) is checked first: integrity_check,
+the core tables, and a schema no newer than this code. Older schemas are
+migrated forward. Then it is copied into the live database with a single
+backup step. SQLite applies that as one write transaction, so readers see
+either the old data or the new. Every worker then drops its pooled
+connections (database.invalidate_connections).
+
+Usage:
+    python backups.py snapshot [label]
+    python backups.py list
+    python backups.py prune
+    python backups.py restore <snapshot id>
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import cache_bus
+import database
+from migrations import LATEST, migrate
+
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+CHUNK_DIR = os.path.join(BACKUP_DIR, 'chunks')
+SNAPSHOT_DIR = os.path.join(BACKUP_DIR, 'snapshots')
+
+# Pages copied per backup step, and the pause between steps
+PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '256'))
+STEP_SLEEP = 0.005
+
+# Pages per stored chunk (64 KB with the default 4 KB pages)
+CHUNK_PAGES = int(os.getenv('BACKUP_CHUNK_PAGES', '16'))
+
+# prune() keeps the newest snapshot in each of the last N hours, days and
+# semesters, plus the N most recent of any kind
+RETENTION = {
+    'last': int(os.getenv('BACKUP_KEEP_LAST', '10')),
+    'hourly': int(os.getenv('BACKUP_KEEP_HOURLY', '24')),
+    'daily': int(os.getenv('BACKUP_KEEP_DAILY', '14')),
+    'semester': int(os.getenv('BACKUP_KEEP_SEMESTERS', '8')),
+}
+
+# An unreferenced chunk younger than this may belong to a snapshot that is
+# still being written, so prune() leaves it alone
+CHUNK_GRACE = 3600
+
+REQUIRED_TABLES = ('users', 'presets', 'subjects', 'components', 'student_marks', 'subject_results', 'cgpa')
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class RestoreError(Exception):
+    pass
+
+
+def _semester(snapshot_id):
+    # Ids start with the timestamp. Odd semesters run July-December, even
+    # ones January-June
+    year, month = snapshot_id[:4], int(snapshot_id[4:6])
+    return f"{year}-{'odd' if month >= 7 else 'even'}"
+
+
+RETENTION_BUCKETS = {
+    'last': lambda snapshot_id: snapshot_id,
+    'hourly': lambda snapshot_id: snapshot_id[:11],     # YYYYmmdd_HH
+    'daily': lambda snapshot_id: snapshot_id[:8],       # YYYYmmdd
+    'semester': _semester,
+}
+
+
+def _write_atomic(path, data):
+    # Write then rename, so a half-written file never has the final name
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _chunk_path(digest):
+    return os.path.join(CHUNK_DIR, digest[:2], digest[2:])
+
+
+def _put_chunk(chunk):
+    """Store one chunk unless it is already there; returns (digest, bytes written)."""
+    digest = hashlib.sha256(chunk).hexdigest()
+    path = _chunk_path(digest)
+    if os.path.exists(path):
+        # Fresh mtime keeps it out of prune()'s reach until our manifest is written
+        os.utime(path)
+        return digest, 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    blob = zlib.compress(chunk, 6)
+    _write_atomic(path, blob)
+    return digest, len(blob)
+
+
+@contextmanager
+def _hot_copy():
+    """Copy the live database into a temp file under BACKUP_DIR; yields
+    (path, page size). The file is removed on the way out."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=BACKUP_DIR, suffix='.db.part')
+    os.close(fd)
+    try:
+        src = database.open_connection()
+        dst = sqlite3.connect(path)
+        try:
+            # A throwaway file: no need to make each step durable
+            dst.execute("PRAGMA synchronous=OFF")
+            # Every step reads the same snapshot, so commits made meanwhile
+            # neither show up half-way nor restart the copy
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1 -- full scan: one row, to open the read")
+            src.backup(dst, pages=PAGES_PER_STEP, sleep=STEP_SLEEP)
+            src.rollback()
+            page_size = dst.execute("PRAGMA page_size").fetchone()[0]
+        finally:
+            dst.close()
+            src.close()
+        yield path, page_size
+    finally:
+        os.remove(path)
+
+
+def snapshot(label='manual'):
+    """Snapshot the live database into the store, then prune. Returns the manifest."""
+    start = time.perf_counter()
+    created = datetime.now()
+    label = re.sub(r'[^a-z0-9]+', '_', label.lower()).strip('_') or 'manual'
+
+    chunks, new_chunks, stored_bytes = [], 0, 0
+    with _hot_copy() as (path, page_size):
+        size = os.path.getsize(path)
+        chunk_size = page_size * CHUNK_PAGES
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest, written = _put_chunk(chunk)
+                chunks.append(digest)
+                if written:
+                    new_chunks += 1
+                    stored_bytes += written
+
+    manifest = {
+        'id': f'{created.strftime("%Y%m%d_%H%M%S_%f")}_{label}',
+        'label': label,
+        'created_at': created.strftime('%Y-%m-%d %H:%M:%S'),
+        'size': size,
+        'page_size': page_size,
+        'chunk_size': chunk_size,
+        'chunks': chunks,
+        'new_chunks': new_chunks,
+        'stored_bytes': stored_bytes,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    _write_atomic(os.path.join(SNAPSHOT_DIR, f"{manifest['id']}.json"), json.dumps(manifest).encode())
+    prune()
+    return manifest
+
+
+def list_snapshots():
+    """Every manifest in the store, newest first."""
+    snapshots = []
+    if os.path.isdir(SNAPSHOT_DIR):
+        for name in os.listdir(SNAPSHOT_DIR):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(SNAPSHOT_DIR, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Pruned meanwhile, or not ours
+                continue
+    return sorted(snapshots, key=lambda s: s['id'], reverse=True)
+
+
+def get_snapshot(snapshot_id):
+    """The manifest for `snapshot_id`; KeyError if there is none."""
+    if not re.fullmatch(r'[0-9a-z_]+', snapshot_id or ''):
+        raise KeyError(snapshot_id)
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, f'{snapshot_id}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise KeyError(snapshot_id)
+
+
+def retained(snapshots):
+    """Ids of the snapshots RETENTION keeps."""
+    newest_first = sorted(snapshots, key=lambda s: s['id'], reverse=True)
+    keep = set()
+    for policy, count in RETENTION.items():
+        bucket_of = RETENTION_BUCKETS[policy]
+        buckets = set()
+        for snap in newest_first:
+            if len(buckets) >= count:
+                break
+            bucket = bucket_of(snap['id'])
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(snap['id'])
+    return keep
+
+
+def prune():
+    """Drop the snapshots RETENTION doesn't keep, then the chunks nothing
+    refers to. Returns (snapshots removed, bytes freed)."""
+    snapshots = list_snapshots()
+    keep = retained(snapshots)
+    removed = 0
+    used = set()
+    for snap in snapshots:
+        if snap['id'] in keep:
+            used.update(snap['chunks'])
+            continue
+        try:
+            os.remove(os.path.join(SNAPSHOT_DIR, f"{snap['id']}.json"))
+            removed += 1
+        except FileNotFoundError:
+            pass
+
+    freed = 0
+    cutoff = time.time() - CHUNK_GRACE
+    if os.path.isdir(CHUNK_DIR):
+        for prefix in os.listdir(CHUNK_DIR):
+            directory = os.path.join(CHUNK_DIR, prefix)
+            for rest in os.listdir(directory):
+                if prefix + rest in used:
+                    continue
+                path = os.path.join(directory, rest)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime < cutoff:
+                        os.remove(path)
+                        freed += stat.st_size
+                except FileNotFoundError:
+                    pass
+    return removed, freed
+
+
+def store_stats():
+    """Totals for the admin page: snapshot count, the bytes they represent
+    and the bytes actually on disk."""
+    snapshots = list_snapshots()
+    chunks, stored = 0, 0
+    if os.path.isdir(CHUNK_DIR):
+        for prefix in os.listdir(CHUNK_DIR):
+            directory = os.path.join(CHUNK_DIR, prefix)
+            for rest in os.listdir(directory):
+                chunks += 1
+                stored += os.path.getsize(os.path.join(directory, rest))
+    return {
+        'snapshots': len(snapshots),
+        'logical_bytes': sum(s['size'] for s in snapshots),
+        'stored_bytes': stored,
+        'chunks': chunks,
+    }
+
+
+def _assemble(manifest, out):
+    """Write the database file of `manifest` to the binary file `out`."""
+    # A digest used more than once (typically empty pages) is decompressed once
+    repeated = {}
+    counts = {}
+    for digest in manifest['chunks']:
+        counts[digest] = counts.get(digest, 0) + 1
+    for digest in manifest['chunks']:
+        chunk = repeated.get(digest)
+        if chunk is None:
+            try:
+                with open(_chunk_path(digest), 'rb') as f:
+                    chunk = zlib.decompress(f.read())
+            except (OSError, zlib.error) as e:
+                raise RestoreError(f"Snapshot {manifest['id']} is damaged (chunk {digest[:12]}: {e}).")
+            if counts[digest] > 1:
+                repeated[digest] = chunk
+        out.write(chunk)
+
+
+def export(snapshot_id):
+    """The snapshot as a gzip-compressed .db, in a rewound temp file."""
+    manifest = get_snapshot(snapshot_id)
+    f = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as gz:
+        _assemble(manifest, gz)
+    f.seek(0)
+    return f
+
+
+def export_live():
+    """A hot copy of the live database as a gzip-compressed .db, in a
+    rewound temp file. Nothing is added to the store."""
+    f = tempfile.TemporaryFile()
+    with _hot_copy() as (path, _), open(path, 'rb') as src:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as gz:
+            shutil.copyfileobj(src, gz)
+    f.seek(0)
+    return f
+
+
+def validate(path):
+    """Raise RestoreError unless `path` is a sound database this app can
+    run on. Older schemas are migrated forward in place."""
+    with open(path, 'rb') as f:
+        if f.read(16) != SQLITE_MAGIC:
+            raise RestoreError('Not a SQLite database file.')
+
+    conn = sqlite3.connect(path)
+    try:
+        # Stop at the first problem; one is enough to reject the file
+        result = conn.execute("PRAGMA integrity_check(1)").fetchone()[0]
+        if result != 'ok':
+            raise RestoreError(f"Integrity check failed: {result.splitlines()[-1]}")
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > LATEST:
+            raise RestoreError(f"Database schema v{version} is newer than this app (v{LATEST}).")
+
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        missing = [t for t in REQUIRED_TABLES if t not in tables]
+        if missing:
+            raise RestoreError(f"Not a CGPA database (missing {', '.join(missing)}).")
+
+        migrate(conn)
+    except sqlite3.DatabaseError as e:
+        raise RestoreError(f"Unreadable database: {e}")
+    finally:
+        conn.close()
+
+
+def _swap_in(path):
+    live = database.open_connection()
+    src = sqlite3.connect(path)
+    try:
+        # A WAL database can't change page size, so the copy must match it
+        page_size = live.execute("PRAGMA page_size").fetchone()[0]
+        if src.execute("PRAGMA page_size").fetchone()[0] != page_size:
+            src.execute("PRAGMA journal_mode=DELETE")
+            src.execute(f"PRAGMA page_size={int(page_size)}")
+            src.execute("VACUUM")
+
+        old_max = live.execute("SELECT COALESCE(MAX(version), 0) FROM cache_versions").fetchone()[0]
+
+        # pages=-1: the whole file in one step, i.e. one write transaction
+        src.backup(live, pages=-1)
+
+        # The restored stamps may equal ones workers have already cached:
+        # move cache_bus.ALL past both files' stamps, which invalidates every
+        # namespace in every worker
+        live.execute(cache_bus.BUMP, (cache_bus.ALL,))
+        live.execute("UPDATE cache_versions SET version = MAX(version, ? + 1) WHERE namespace = ?",
+                     (old_max, cache_bus.ALL))
+        live.commit()
+    finally:
+        src.close()
+        live.close()
+
+
+def restore(path, label='pre_restore'):
+    """Validate the database at `path` and make it the live database.
+    The current one is snapshotted first (as `label`); returns that
+    snapshot's id. `path` itself may be migrated in place."""
+    validate(path)
+    before = snapshot(label)
+    _swap_in(path)
+    database.invalidate_connections()
+    return before['id']
+
+
+def _restore_temp(fill):
+    """restore() a temp file next to the database, written by fill(f)."""
+    db_dir = os.path.dirname(os.path.abspath(database.DB_PATH))
+    fd, tmp = tempfile.mkstemp(dir=db_dir, prefix='.restore-', suffix='.db')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            fill(out)
+        return restore(tmp)
+    finally:
+        for leftover in (tmp, f'{tmp}-wal', f'{tmp}-shm', f'{tmp}-journal'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def restore_upload(fileobj):
+    """restore() for an uploaded .db or .db.gz file object."""
+    def fill(out):
+        head = fileobj.read(2)
+        fileobj.seek(0)
+        source = gzip.GzipFile(fileobj=fileobj) if head == GZIP_MAGIC else fileobj
+        try:
+            shutil.copyfileobj(source, out, 1 << 20)
+        except (OSError, EOFError) as e:
+            raise RestoreError(f"Could not unpack the upload: {e}")
+    return _restore_temp(fill)
+
+
+def restore_snapshot(snapshot_id):
+    """Point-in-time restore: reassemble a stored snapshot and restore() it."""
+    manifest = get_snapshot(snapshot_id)
+    return _restore_temp(lambda out: _assemble(manifest, out))
+
+
+def main(argv):
+    command = argv[0] if argv else 'list'
+    if command == 'snapshot':
+        snap = snapshot(argv[1] if len(argv) > 1 else 'manual')
+        print(f"{snap['id']}: {snap['size']} bytes in {len(snap['chunks'])} chunks, "
+              f"{snap['new_chunks']} new ({snap['stored_bytes']} bytes stored) in {snap['seconds']}s")
+    elif command == 'list':
+        for snap in list_snapshots():
+            print(f"{snap['id']:<40} {snap['created_at']}  {snap['size']:>12}  +{snap['stored_bytes']}")
+        stats = store_stats()
+        print(f"{stats['snapshots']} snapshots, {stats['logical_bytes']} bytes in "
+              f"{stats['stored_bytes']} bytes on disk ({stats['chunks']} chunks)")
+    elif command == 'prune':
+        removed, freed = prune()
+        print(f"Removed {removed} snapshots, freed {freed} bytes.")
+    elif command == 'restore' and len(argv) > 1:
+        print(f"Restored {argv[1]}; the previous database is snapshot {restore_snapshot(argv[1])}.")
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
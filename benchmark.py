@@ -0,0 +1,279 @@
+"""
+Load Benchmark
+==============
+
+Drives the app through the Flask test client against a copy of a database
+(see generate_dataset.py). It reports throughput and p50/p95/p99 latency for
+the hot paths: login, loading a class, calculate_cgpa, /result, the master
+sheet and the exports.
+
+Usage:
+    python generate_dataset.py bench.db
+    python benchmark.py bench.db
+    python benchmark.py bench.db --requests 200 --threads 4 --only result master_sheet
+    python benchmark.py bench.db --save baseline.json
+    python benchmark.py bench.db --compare baseline.json --max-regression 20
+
+With --compare, the exit code is 1 if any scenario's p95 is more than
+--max-regression percent slower than the baseline.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ADMIN_EMAIL = 'bench.admin@example.edu'
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the CGPA app with the Flask test client.")
+    parser.add_argument('database', help="database to benchmark (a temporary copy is used)")
+    parser.add_argument('--requests', type=int, default=100, help="requests per scenario")
+    parser.add_argument('--threads', type=int, default=1, help="concurrent clients")
+    parser.add_argument('--warmup', type=int, default=5, help="untimed requests per scenario")
+    parser.add_argument('--only', nargs='+', metavar='SCENARIO', help="run only these scenarios")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='FILE', help="write the results as JSON")
+    parser.add_argument('--compare', metavar='FILE', help="compare p95 against a saved baseline")
+    parser.add_argument('--max-regression', type=float, default=20.0,
+                        help="allowed p95 slowdown in percent when comparing")
+    return parser.parse_args(argv)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Fixture:
+    """Ids sampled from the database for the scenarios to use."""
+
+    def __init__(self, db_path, seed):
+        conn = sqlite3.connect(db_path)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # Students who have results, with their class
+        self.students = conn.execute("""
+            SELECT u.id, u.email, u.name, s.preset_id
+            FROM users u
+            JOIN subject_results sr ON sr.user_id = u.id
+            JOIN subjects s ON s.id = sr.subject_id
+            GROUP BY u.id
+        """).fetchall()
+        tree = {}
+        for preset_id, subject_id, comp_id, max_marks in conn.execute("""
+            SELECT s.preset_id, s.id, c.id, c.max_marks
+            FROM subjects s JOIN components c ON c.subject_id = s.id
+            ORDER BY s.id, c.id
+        """):
+            tree.setdefault(preset_id, {}).setdefault(subject_id, []).append((comp_id, max_marks))
+        self.tree = tree
+        self.departments = [r[0] for r in conn.execute(
+            "SELECT DISTINCT department FROM presets WHERE department IS NOT NULL")]
+        conn.close()
+        if not self.students:
+            sys.exit("The database has no students with results; generate one with generate_dataset.py.")
+
+    def student(self):
+        with self.lock:
+            return self.rng.choice(self.students)
+
+    def marks_form(self, preset_id):
+        form = {'action': 'calculate_cgpa', 'subjects': []}
+        with self.lock:
+            for subject_id, comps in self.tree.get(preset_id, {}).items():
+                form['subjects'].append(str(subject_id))
+                for comp_id, max_marks in comps:
+                    form[f'marks_{comp_id}'] = str(self.rng.randint(0, max_marks))
+        return form
+
+    def department(self):
+        with self.lock:
+            return self.rng.choice(self.departments)
+
+
+# A scenario prepares the client (e.g. logs in as a sampled student) and
+# returns a zero-argument callable that sends the timed request.
+
+def login_as(client, email, name):
+    with client.session_transaction() as sess:
+        sess['user'] = {'email': email, 'name': name, 'picture': ''}
+
+
+def scenario_login(client, fx):
+    return lambda: client.post('/dev_login', data={'role': 'student'})
+
+
+def scenario_load_subjects(client, fx):
+    _, email, name, preset_id = fx.student()
+    login_as(client, email, name)
+    return lambda: client.post('/student', data={'action': 'load_subjects', 'preset_id': preset_id})
+
+
+def scenario_calculate_cgpa(client, fx):
+    _, email, name, preset_id = fx.student()
+    login_as(client, email, name)
+    form = fx.marks_form(preset_id)
+    return lambda: client.post('/student', data=form)
+
+
+def scenario_result(client, fx):
+    _, email, name, _ = fx.student()
+    login_as(client, email, name)
+    return lambda: client.get('/result')
+
+
+def scenario_master_sheet(client, fx):
+    login_as(client, ADMIN_EMAIL, 'Bench Admin')
+    return lambda: client.get('/admin/master_sheet', query_string={'preset_id': fx.student()[3]})
+
+
+def scenario_master_csv(client, fx):
+    login_as(client, ADMIN_EMAIL, 'Bench Admin')
+    return lambda: client.get('/admin/master_sheet/download', query_string={'preset_id': fx.student()[3]})
+
+
+def scenario_master_xlsx(client, fx):
+    login_as(client, ADMIN_EMAIL, 'Bench Admin')
+    return lambda: client.get('/admin/master_sheet/download', query_string={'preset_id': fx.student()[3], 'format': 'xlsx'})
+
+
+def scenario_department_export(client, fx):
+    login_as(client, ADMIN_EMAIL, 'Bench Admin')
+    return lambda: client.get('/admin/master_sheet/download_all', query_string={'department': fx.department()})
+
+
+def scenario_student_csv(client, fx):
+    login_as(client, ADMIN_EMAIL, 'Bench Admin')
+    return lambda: client.get(f'/admin/students/{fx.student()[0]}/download_csv')
+
+
+SCENARIOS = {
+    'login': scenario_login,
+    'load_subjects': scenario_load_subjects,
+    'calculate_cgpa': scenario_calculate_cgpa,
+    'result': scenario_result,
+    'master_sheet': scenario_master_sheet,
+    'master_csv': scenario_master_csv,
+    'master_xlsx': scenario_master_xlsx,
+    'department_export': scenario_department_export,
+    'student_csv': scenario_student_csv,
+}
+
+
+def run_scenario(app, fx, func, requests, threads, warmup):
+    local = threading.local()
+
+    def one(_):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        send = func(client, fx)      # session setup stays out of the timing
+        start = time.perf_counter()
+        response = send()
+        response.get_data()          # drain streamed bodies
+        elapsed = time.perf_counter() - start
+        ok = response.status_code < 400
+        response.close()
+        return elapsed, ok
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(warmup)))
+        wall_start = time.perf_counter()
+        samples = list(pool.map(one, range(requests)))
+        wall = time.perf_counter() - wall_start
+
+    latencies = sorted(s[0] for s in samples)
+    return {
+        'requests': requests,
+        'errors': sum(1 for s in samples if not s[1]),
+        'throughput': requests / wall if wall else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def compare(results, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['scenarios']
+    regressions = []
+    print(f"\nCompared with {baseline_path} (p95, allowed slowdown {max_regression:.0f}%):")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['p95_ms'], result['p95_ms']
+        change = (after - before) / before * 100 if before else 0.0
+        flag = "  REGRESSION" if change > max_regression else ""
+        print(f"  {name:<18} {before:9.2f} -> {after:9.2f} ms  ({change:+.1f}%){flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(args):
+    # Work on a copy so calculate_cgpa and logins don't touch the source database
+    work_dir = tempfile.mkdtemp(prefix='cgpa_bench_')
+    db_path = os.path.join(work_dir, 'database.db')
+    shutil.copy(args.database, db_path)
+
+    # app.py and its modules read these at import time
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ['METRICS_PATH'] = os.path.join(work_dir, 'metrics.db')
+    os.environ['EXPORT_DIR'] = os.path.join(work_dir, 'exports')
+    os.environ['ADMIN_EMAILS'] = ADMIN_EMAIL
+    os.environ['DEV_MODE'] = 'true'
+    os.environ.setdefault('SQL_INSTRUMENT', 'false')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import create_app
+    app = create_app()
+
+    fx = Fixture(db_path, args.seed)
+    names = args.only or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenario(s): {', '.join(unknown)}. Choose from: {', '.join(SCENARIOS)}")
+
+    print(f"{len(fx.students)} students with results, {args.requests} requests per scenario, "
+          f"{args.threads} thread(s)\n")
+    print(f"{'scenario':<18} {'req/s':>8} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'errors':>7}")
+    results = {}
+    for name in names:
+        r = run_scenario(app, fx, SCENARIOS[name], args.requests, args.threads, args.warmup)
+        results[name] = r
+        print(f"{name:<18} {r['throughput']:8.1f} {r['mean_ms']:9.2f} {r['p50_ms']:9.2f} "
+              f"{r['p95_ms']:9.2f} {r['p99_ms']:9.2f} {r['max_ms']:9.2f} {r['errors']:7d}")
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'database': args.database, 'requests': args.requests, 'threads': args.threads,
+                       'scenarios': results}, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    status = 0
+    if any(r['errors'] for r in results.values()):
+        print("\nSome requests failed (status >= 400).")
+        status = 1
+    if args.compare and compare(results, args.compare, args.max_regression):
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args(sys.argv[1:])))
@@ -0,0 +1,261 @@
+"""
+Bulk Import Pipeline
+====================
+
+Shared machinery for the scripts that move data between database files
+(migration_tools/migrate_database.py, migration_tools/full_reset_import.py,
+full_restore_process.py, append_migration.py).
+
+The source file is ATTACHed as `src` and every table moves with one
+INSERT ... SELECT, so rows never pass through Python. When ids differ
+between the two files (users matched by email, subjects and components
+matched by name), the mapping is built once in a temp table and joined
+in. Everything runs in a single transaction: a failure leaves the target
+untouched, and semester_results and the data versions are brought up to
+date once at the end rather than per row (database.bulk_results). Each step is timed and reported in rows
+per second.
+
+Only grading needs Python: the (user, subject) totals are aggregated in
+SQL, graded with the compiled GradingTable and written back with one
+executemany.
+"""
+
+import time
+
+from database import bulk_results
+from grading import compile_rules
+
+
+class Pipeline:
+    """One import: `with Pipeline(conn, source_path) as p: p.step(...)`.
+
+    Attaches the source, opens the transaction, and on exit commits (or
+    rolls back), detaches and prints the per-step report.
+    """
+
+    def __init__(self, conn, source_path, label='Import'):
+        self.conn = conn
+        self.source_path = source_path
+        self.label = label
+        self.cursor = conn.cursor()
+        self.steps = []          # (name, rows, seconds)
+        self._started = None
+        self._bulk = None
+
+    def __enter__(self):
+        # ATTACH is not allowed inside a transaction, so it comes first
+        self.conn.execute("ATTACH DATABASE ? AS src", (self.source_path,))
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._started = time.perf_counter()
+        self._bulk = bulk_results(self.cursor)
+        self._bulk.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            start = time.perf_counter()
+            self._bulk.__exit__(None, None, None)
+            pairs = self.query("SELECT COUNT(*) FROM temp.bulk_pairs")[0][0]
+            self.record('semester_results', pairs, time.perf_counter() - start)
+            self.conn.commit()
+        else:
+            self._bulk.__exit__(exc_type, exc, tb)
+            self.conn.rollback()
+        self.conn.execute("DETACH DATABASE src")
+        if exc_type is None:
+            self.report()
+        return False
+
+    def step(self, name, sql, params=()):
+        """Run one set-based statement and record how many rows it touched."""
+        start = time.perf_counter()
+        self.cursor.execute(sql, params)
+        rows = max(self.cursor.rowcount, 0)
+        self.record(name, rows, time.perf_counter() - start)
+        return rows
+
+    def record(self, name, rows, seconds):
+        self.steps.append((name, rows, seconds))
+
+    def query(self, sql, params=()):
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchall()
+
+    def source_columns(self, table):
+        """Column names of `table` in the source, or an empty set if it has no such table."""
+        self.cursor.execute(f"PRAGMA src.table_info({table})")
+        return {row[1] for row in self.cursor.fetchall()}
+
+    def select_list(self, table, columns, defaults=None, alias=None, cast=None):
+        """SELECT expressions for `columns` from src.`table`. Columns the
+        source lacks (older layouts) come from `defaults`, else NULL;
+        `cast` maps columns to the type they are converted to."""
+        defaults = defaults or {}
+        cast = cast or {}
+        present = self.source_columns(table)
+        prefix = f"{alias}." if alias else ''
+        exprs = []
+        for column in columns:
+            if column in present and column in cast:
+                exprs.append(f"CAST({prefix}{column} AS {cast[column]})")
+            elif column in present:
+                exprs.append(prefix + column)
+            elif column in defaults:
+                exprs.append(defaults[column])
+            else:
+                exprs.append('NULL')
+        return ', '.join(exprs)
+
+    def copy_table(self, table, columns, defaults=None, verb='INSERT', cast=None):
+        """Copy src.`table` into main.`table` with ids kept as they are."""
+        if not self.source_columns(table):
+            print(f"   Warning: table {table} not found in source")
+            return 0
+        return self.step(table, f"""
+            {verb} INTO main.{table} ({', '.join(columns)})
+            SELECT {self.select_list(table, columns, defaults, cast=cast)} FROM src.{table}
+        """)
+
+    def report(self):
+        total_rows = sum(rows for _, rows, _ in self.steps)
+        total_time = time.perf_counter() - self._started
+        print(f"\n{self.label}: {total_rows} rows in {total_time:.2f}s "
+              f"({total_rows / total_time if total_time else 0:,.0f} rows/s)")
+        for name, rows, seconds in self.steps:
+            rate = f"{rows / seconds:,.0f} rows/s" if seconds > 0 and rows else '-'
+            print(f"   {name:<28} {rows:>8}  {seconds * 1000:8.1f} ms  {rate}")
+
+
+def map_users_by_email(p, new_user_defaults=None):
+    """Fill temp.user_map (src_id -> dst_id), matching users by email.
+    With `new_user_defaults`, source users missing from the target are
+    added first, with those values for the profile columns."""
+    if new_user_defaults is not None:
+        columns = ['email', 'name', 'roll_number', 'department', 'academic_year', 'current_year', 'is_admin']
+        # The fixed values replace whatever the source has for those columns
+        select = ', '.join(f":{c}" if c in new_user_defaults else f"u.{c}" for c in columns)
+        p.step('users (new)', f"""
+            INSERT INTO main.users ({', '.join(columns)})
+            SELECT {select} FROM src.users u
+            WHERE NOT EXISTS (SELECT 1 FROM main.users t WHERE t.email = u.email)
+        """, new_user_defaults)
+
+    p.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS user_map (src_id INTEGER PRIMARY KEY, dst_id INTEGER NOT NULL)")
+    p.cursor.execute("DELETE FROM temp.user_map")
+    return p.step('user id map', """
+        INSERT INTO temp.user_map (src_id, dst_id)
+        SELECT u.id, t.id FROM src.users u JOIN main.users t ON t.email = u.email
+    """)
+
+
+def map_subjects(p, preset_id, by_code=False):
+    """Fill temp.subject_map, matching source subjects to the target
+    preset's subjects by name (or by code first, when `by_code`)."""
+    p.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS subject_map (src_id INTEGER PRIMARY KEY, dst_id INTEGER NOT NULL)")
+    p.cursor.execute("DELETE FROM temp.subject_map")
+    by_name = """
+        (SELECT MAX(t.id) FROM main.subjects t
+         WHERE t.preset_id = :preset AND lower(trim(t.name)) = lower(trim(s.name)))
+    """
+    match = by_name
+    if by_code:
+        match = f"""COALESCE(
+            (SELECT MAX(t.id) FROM main.subjects t
+             WHERE t.preset_id = :preset AND trim(COALESCE(s.code, '')) != ''
+               AND lower(trim(t.code)) = lower(trim(s.code))),
+            {by_name})"""
+    rows = p.step('subject id map', f"""
+        INSERT INTO temp.subject_map (src_id, dst_id)
+        SELECT src_id, dst_id FROM (SELECT s.id AS src_id, {match} AS dst_id FROM src.subjects s)
+        WHERE dst_id IS NOT NULL
+    """, {'preset': preset_id})
+
+    for name, code in p.query("""
+        SELECT name, code FROM src.subjects
+        WHERE id NOT IN (SELECT src_id FROM temp.subject_map)
+    """):
+        print(f"   Warning: Could not map subject '{name}' ({code}). Skipping marks for this subject.")
+    return rows
+
+
+def map_components(p):
+    """Fill temp.component_map: components of mapped subjects, matched by name."""
+    p.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS component_map (src_id INTEGER PRIMARY KEY, dst_id INTEGER NOT NULL)")
+    p.cursor.execute("DELETE FROM temp.component_map")
+    return p.step('component id map', """
+        INSERT INTO temp.component_map (src_id, dst_id)
+        SELECT c.id, MAX(t.id)
+        FROM src.components c
+        JOIN temp.subject_map m ON m.src_id = c.subject_id
+        JOIN main.components t ON t.subject_id = m.dst_id AND lower(trim(t.name)) = lower(trim(c.name))
+        GROUP BY c.id
+    """)
+
+
+def copy_mapped_marks(p, overwrite=False):
+    """Copy marks through user_map and component_map. Existing marks are
+    kept unless `overwrite`."""
+    conflict = "DO UPDATE SET marks_obtained = excluded.marks_obtained" if overwrite else "DO NOTHING"
+    return p.step('student_marks', f"""
+        INSERT INTO main.student_marks (user_id, component_id, marks_obtained)
+        SELECT um.dst_id, cm.dst_id, sm.marks_obtained
+        FROM src.student_marks sm
+        JOIN temp.user_map um ON um.src_id = sm.user_id
+        JOIN temp.component_map cm ON cm.src_id = sm.component_id
+        WHERE true
+        ON CONFLICT (user_id, component_id) {conflict}
+    """)
+
+
+def recompute_results(p, rules=None, users_sql=None, existing_only=False):
+    """Rebuild subject_results from student_marks, then the CGPA of the same
+    students. `users_sql` is a SELECT of user ids to limit it to (default:
+    everyone with marks); `existing_only` refreshes only (user, subject)
+    pairs that already have a result. `rules` defaults to grading_rules."""
+    if rules is None:
+        rules = compile_rules(p.query(
+            "SELECT min_percentage, max_percentage, grade, grade_point FROM main.grading_rules ORDER BY id"))
+
+    where = []
+    if users_sql:
+        where.append(f"sm.user_id IN ({users_sql})")
+    if existing_only:
+        where.append("""EXISTS (SELECT 1 FROM main.subject_results r
+                                WHERE r.user_id = sm.user_id AND r.subject_id = c.subject_id)""")
+
+    start = time.perf_counter()
+    totals = p.query(f"""
+        SELECT sm.user_id, c.subject_id, SUM(sm.marks_obtained), SUM(c.max_marks)
+        FROM main.student_marks sm
+        JOIN main.components c ON c.id = sm.component_id
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        GROUP BY sm.user_id, c.subject_id
+        HAVING SUM(c.max_marks) > 0
+    """)
+    percentages = [obt / mx * 100 for _, _, obt, mx in totals]
+    rows = [(user_id, subject_id, obt, mx, perc, grade, point)
+            for (user_id, subject_id, obt, mx), perc, (grade, point)
+            in zip(totals, percentages, rules.grade_many(percentages))]
+    p.cursor.executemany("""
+        INSERT INTO main.subject_results
+            (user_id, subject_id, total_obtained_marks, total_max_marks, percentage, grade, grade_point)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, subject_id) DO UPDATE SET
+            total_obtained_marks = excluded.total_obtained_marks,
+            total_max_marks = excluded.total_max_marks,
+            percentage = excluded.percentage,
+            grade = excluded.grade,
+            grade_point = excluded.grade_point
+    """, rows)
+    p.record('subject_results (graded)', len(rows), time.perf_counter() - start)
+
+    p.step('cgpa', f"""
+        INSERT OR REPLACE INTO main.cgpa (user_id, cgpa)
+        SELECT sr.user_id, SUM(sr.grade_point * s.credits) * 1.0 / SUM(s.credits)
+        FROM main.subject_results sr
+        JOIN main.subjects s ON s.id = sr.subject_id
+        {'WHERE sr.user_id IN (' + users_sql + ')' if users_sql else ''}
+        GROUP BY sr.user_id
+        HAVING SUM(s.credits) > 0
+    """)
+    return len(rows)
@@ -0,0 +1,104 @@
+"""Cross-worker invalidation for in-process caches.
+
+Each cache namespace ('grading_rules', 'admins', 'preset:<id>', ...) has a
+version in cache_versions. A change bumps it to one more than the highest
+version of any namespace, so versions only ever grow and a worker can ask
+for everything that moved since it last looked with one indexed range
+query (WHERE version > last seen). Each worker does that at most once per
+request, on the first version() call, and caches compare the version they
+were filled at with the current one: no TTLs, and a change committed in
+one worker is seen by the others on their next request.
+
+Bumps come from bump() in the route that makes the change, or from the
+triggers on tables any script may edit (grading_rules, admins, 'presets'
+for the class structure, and the per-student and per-class data versions;
+see migrations.py). Bumping ALL invalidates every namespace at once; a
+restore does that (backups._swap_in). Each stamp also records when it last
+moved (changed_at, Unix seconds), for HTTP Last-Modified headers.
+"""
+
+import sqlite3
+import threading
+
+from flask import g, has_app_context
+
+import database
+
+ALL = 'all'
+
+_state = {'seen': None, 'versions': {}, 'changed': {}, 'polls': 0}
+_lock = threading.Lock()
+
+BUMP = """
+    INSERT INTO cache_versions (namespace, version, changed_at)
+    VALUES (?, (SELECT COALESCE(MAX(version), 0) FROM cache_versions) + 1, CAST(strftime('%s', 'now') AS INTEGER))
+    ON CONFLICT (namespace) DO UPDATE SET version = excluded.version, changed_at = excluded.changed_at
+"""
+
+
+def bump(cursor, namespace):
+    """Move `namespace` to a new version. Call before committing the change
+    it stands for, so both land together."""
+    cursor.execute(BUMP, (namespace,))
+
+
+def refresh():
+    """Poll now. Returns False if the database has no cache_versions table."""
+    seen = _state['seen']
+    conn = database.get_pool().checkout()
+    try:
+        if seen is None:
+            rows = conn.execute("""
+                SELECT namespace, version, changed_at FROM cache_versions
+                -- full scan: once per worker, after that only what changed
+            """).fetchall()
+        else:
+            rows = conn.execute("SELECT namespace, version, changed_at FROM cache_versions WHERE version > ?",
+                                (seen,)).fetchall()
+    except sqlite3.OperationalError:
+        # Database not bootstrapped by create_tables()
+        return False
+    finally:
+        conn.close()
+
+    with _lock:
+        versions, changed = _state['versions'], _state['changed']
+        for namespace, version, changed_at in rows:
+            if version > versions.get(namespace, -1):
+                versions[namespace] = version
+                changed[namespace] = changed_at
+        _state['seen'] = max([seen or 0] + [row[1] for row in rows])
+        _state['polls'] += 1
+    return True
+
+
+def _polled():
+    if has_app_context():
+        if '_cache_bus_ok' not in g:
+            g._cache_bus_ok = refresh()
+        return g._cache_bus_ok
+    # Background jobs and scripts: no request to share a poll with
+    return refresh()
+
+
+def version(namespace):
+    """Current version of `namespace` (0 if it was never bumped), or None
+    when the database has no version stamps, in which case don't cache."""
+    if not _polled():
+        return None
+    versions = _state['versions']
+    return max(versions.get(namespace, 0), versions.get(ALL, 0))
+
+
+def changed_at(namespace):
+    """When `namespace` (or ALL) last moved, in Unix seconds; None if unknown."""
+    if not _polled():
+        return None
+    stamps = [_state['changed'].get(name) for name in (namespace, ALL)]
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    return max(stamps) if stamps else None
+
+
+def stats():
+    with _lock:
+        return {'namespaces': len(_state['versions']), 'seen': _state['seen'], 'polls': _state['polls']}
@@ -1,132 +1,483 @@
+import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+import instrumentation
+
+DB_PATH = os.getenv('DATABASE_PATH', 'database.db')
+
+# Pool tuning (per gunicorn worker)
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+
+# Rewritten whenever the database is restored (see backups.py). Each worker
+# re-reads it at most every STAMP_INTERVAL seconds on checkout and drops its
+# pooled connections when it changes.
+RESTORE_STAMP = os.getenv('DATABASE_RESTORE_STAMP', f'{DB_PATH}.restored')
+STAMP_INTERVAL = 1.0
+
+# Applied once to every pooled connection when it is opened.
+# journal_mode is persistent in the file, the rest are per-connection.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # ~16 MB page cache
+    "PRAGMA mmap_size=268435456",    # 256 MB memory map
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+]
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def _read_stamp():
+    try:
+        with open(RESTORE_STAMP) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def open_connection(db_path=DB_PATH):
+    """A new, unpooled connection with the standard pragmas applied."""
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class PooledConnection:
+    """Thin wrapper around sqlite3.Connection. close() hands the connection
+    back to the pool instead of closing it, so existing route code keeps working."""
+
+    def __init__(self, pool, raw, generation):
+        self._pool = pool
+        self._raw = raw
+        self._generation = generation
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self._raw.__enter__()
+
+    def __exit__(self, *exc):
+        return self._raw.__exit__(*exc)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._pool.checkin(self._raw, self._generation)
+
+
+class ConnectionPool:
+    def __init__(self, db_path=DB_PATH, max_size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._lock = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._generation = 0
+        self._pid = os.getpid()
+        self._stamp = _read_stamp()
+        self._stamp_checked = time.perf_counter()
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'created': 0,
+        }
+
+    def _open(self):
+        conn = open_connection(self.db_path)
+        self._stats['created'] += 1
+        return conn
+
+    def _reset_after_fork(self):
+        # Connections must never be shared across fork() (gunicorn --preload).
+        # Drop the parent's handles without closing them.
+        self._idle = []
+        self._size = 0
+        self._pid = os.getpid()
+
+    def _check_stamp(self):
+        # Another worker restored the database: start over with fresh connections
+        self._stamp_checked = time.perf_counter()
+        stamp = _read_stamp()
+        if stamp != self._stamp:
+            self.reset(stamp)
+
+    def checkout(self):
+        start = time.perf_counter()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_after_fork()
+            if start - self._stamp_checked >= STAMP_INTERVAL:
+                self._check_stamp()
+            while not self._idle and self._size >= self.max_size:
+                remaining = self.timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(f"No database connection available after {self.timeout}s")
+                self._lock.wait(remaining)
+
+            if self._idle:
+                raw = self._idle.pop()
+            else:
+                self._size += 1
+                try:
+                    raw = self._open()
+                except Exception:
+                    self._size -= 1
+                    raise
+
+            waited = time.perf_counter() - start
+            self._stats['checkouts'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+            generation = self._generation
+        return PooledConnection(self, raw, generation)
+
+    def checkin(self, raw, generation):
+        # Uncommitted work is discarded, same as closing a plain connection
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            stale = generation != self._generation
+            if not stale:
+                try:
+                    if raw.in_transaction:
+                        raw.rollback()
+                except sqlite3.Error:
+                    stale = True
+            if stale:
+                try:
+                    raw.close()
+                except sqlite3.Error:
+                    pass
+                if generation == self._generation:
+                    self._size -= 1
+            else:
+                self._idle.append(raw)
+            self._lock.notify()
+
+    def close_all(self):
+        """Close every idle connection and retire the ones still in use, so
+        nothing keeps a handle on the old file when database.db is replaced."""
+        with self._lock:
+            for raw in self._idle:
+                try:
+                    raw.close()
+                except sqlite3.Error:
+                    pass
+            self._idle = []
+            self._size = 0
+            self._generation += 1
+            self._lock.notify_all()
+
+    def reset(self, stamp):
+        """Adopt a new restore stamp and retire every connection."""
+        with self._lock:
+            self._stamp = stamp
+            self.close_all()
+
+    def stats(self):
+        with self._lock:
+            checkouts = self._stats['checkouts']
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'created': self._stats['created'],
+                'checkouts': checkouts,
+                'timeouts': self._stats['timeouts'],
+                'wait_time_total': round(self._stats['wait_time_total'], 6),
+                'wait_time_avg': round(self._stats['wait_time_total'] / checkouts, 6) if checkouts else 0.0,
+                'wait_time_max': round(self._stats['wait_time_max'], 6),
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
 
 def create_connection():
-    conn = sqlite3.connect('database.db')
+    conn = get_pool().checkout()
+    # Inside a request, remember the checkout so teardown can return it
+    # even on early-return paths that never call conn.close()
+    if has_app_context():
+        g.setdefault('_db_connections', []).append(conn)
+        conn = instrumentation.wrap(conn)
     return conn
 
-def create_tables():
+
+def release_connections(exc=None):
+    for conn in g.pop('_db_connections', []):
+        conn.close()
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+def invalidate_connections():
+    """Retire pooled connections in every worker: this one at once, the
+    others on their next checkout (within STAMP_INTERVAL)."""
+    stamp = str(time.time_ns())
+    with open(RESTORE_STAMP, 'w') as f:
+        f.write(stamp)
+    get_pool().reset(stamp)
+
+
+def checkpoint():
+    """Flush the WAL into database.db so the file on disk is complete."""
     conn = create_connection()
-    cursor = conn.cursor()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
 
-    # Create users table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            name TEXT,
-            roll_number TEXT,
-            enrollment_number TEXT,
-            department TEXT,
-            academic_year TEXT,
-            current_year TEXT,
-            is_admin BOOLEAN DEFAULT 0
-        )
-    """)
 
-    # Create presets table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS presets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            academic_year TEXT NOT NULL,
-            course TEXT NOT NULL,
-            department TEXT,
-            year TEXT NOT NULL,
-            division TEXT NOT NULL,
-            semester TEXT NOT NULL
-        )
-    """)
+def init_app(app):
+    app.teardown_appcontext(release_connections)
 
-    # Create subjects table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS subjects (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            preset_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            code TEXT,
-            credits INTEGER NOT NULL,
-            FOREIGN KEY (preset_id) REFERENCES presets (id)
-        )
-    """)
+def managed_indexes():
+    """Secondary indexes owned by the app: (name, table, columns).
+    Trailing columns make the hot lookups covering, so they never touch the table.
+    They are synced whenever migrations run, so a change here ships with a
+    migration (an empty one will do) to reach existing databases."""
+    return [
+        # Class structure: subjects of a preset, components of a subject
+        ('idx_subjects_preset', 'subjects', ['preset_id', 'id', 'credits']),
+        ('idx_components_subject', 'components', ['subject_id', 'id', 'max_marks']),
+        # Student dashboard preset filter and promotions
+        ('idx_presets_year_department', 'presets', ['year', 'department']),
+        ('idx_users_current_year', 'users', ['current_year']),
+        ('idx_users_is_admin', 'users', ['is_admin']),
+        # Marks entry: a student's marks, and cleanup by component
+        ('idx_student_marks_user', 'student_marks', ['user_id', 'component_id', 'marks_obtained']),
+        ('idx_student_marks_component', 'student_marks', ['component_id']),
+        # /result and CGPA aggregation (covering)
+        ('idx_subject_results_user', 'subject_results',
+         ['user_id', 'subject_id', 'grade_point', 'percentage', 'grade', 'total_obtained_marks', 'total_max_marks']),
+        # Master sheet lookups by subject (covering)
+        ('idx_subject_results_subject', 'subject_results',
+         ['subject_id', 'user_id', 'percentage', 'grade', 'grade_point']),
+        ('idx_cgpa_user', 'cgpa', ['user_id', 'cgpa']),
+        # Class-wide semester_results refresh (subject deleted, preset deleted)
+        ('idx_semester_results_preset', 'semester_results', ['preset_id']),
+        # Job queue depth
+        ('idx_jobs_status', 'jobs', ['status']),
+        # cache_bus polls: stamps moved since the last poll
+        ('idx_cache_versions_version', 'cache_versions', ['version']),
+    ]
 
-    # Create components table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS components (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            subject_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            max_marks INTEGER NOT NULL,
-            FOREIGN KEY (subject_id) REFERENCES subjects (id)
-        )
-    """)
 
-    # Create student_marks table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS student_marks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            component_id INTEGER NOT NULL,
-            marks_obtained REAL NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (component_id) REFERENCES components (id),
-            UNIQUE(user_id, component_id)
-        )
-    """)
+def create_indexes(cursor):
+    indexes = managed_indexes()
+    wanted = {name for name, _, _ in indexes}
 
-    # Create subject_results table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS subject_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            subject_id INTEGER NOT NULL,
-            total_obtained REAL NOT NULL,
-            total_max REAL NOT NULL,
-            percentage REAL NOT NULL,
-            grade TEXT NOT NULL,
-            grade_point REAL NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (subject_id) REFERENCES subjects (id),
-            UNIQUE(user_id, subject_id)
-        )
-    """)
+    # Drop managed indexes that are no longer part of the set
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx\\_%' ESCAPE '\\'")
+    for (name,) in cursor.fetchall():
+        if name not in wanted:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
 
-    # Create cgpa table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS cgpa (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            cgpa REAL NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id)
-        )
-    """)
+    for name, table, columns in indexes:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+
+# Recompute semester_results for the (user, preset) pairs selected by {where},
+# which may refer to subject_results as sr and subjects as s. The matching
+# rows must be deleted first; pairs with no results left simply disappear.
+SEMESTER_RESULTS_REFRESH = """
+    INSERT INTO semester_results (user_id, preset_id, total_credits, total_points, sgpa)
+    SELECT sr.user_id, s.preset_id, SUM(s.credits), SUM(sr.grade_point * s.credits),
+           COALESCE(SUM(sr.grade_point * s.credits) * 1.0 / NULLIF(SUM(s.credits), 0), 0)
+    FROM subject_results sr
+    JOIN subjects s ON s.id = sr.subject_id
+    WHERE {where}
+    GROUP BY sr.user_id, s.preset_id
+"""
+
+
+def _refresh_pair(row):
+    """Trigger body refreshing the (user, preset) pair of a subject_results row (NEW or OLD)."""
+    preset = f"(SELECT preset_id FROM subjects WHERE id = {row}.subject_id)"
+    return (
+        f"DELETE FROM semester_results WHERE user_id = {row}.user_id AND preset_id = {preset};"
+        + SEMESTER_RESULTS_REFRESH.format(where=f"sr.user_id = {row}.user_id AND s.preset_id = {preset}") + ";"
+    )
+
+
+def semester_results_triggers(guarded=True):
+    """(name, sql) of the triggers keeping semester_results in step with
+    subject_results, subject credits and presets. Grading rule changes reach
+    it through the subject_results updates made by the regrade.
+
+    The per-result triggers are skipped inside bulk_results(). Migrations
+    older than deferred_result_triggers pass guarded=False, as trigger_guards
+    doesn't exist yet."""
+    affected = "(SELECT user_id FROM subject_results WHERE subject_id = NEW.id)"
+    when = f"WHEN NOT EXISTS (SELECT 1 FROM trigger_guards WHERE name = '{SEMESTER_RESULTS_GUARD}') " if guarded else ''
+    return [
+        ('semester_results_result_insert',
+         f"AFTER INSERT ON subject_results {when}BEGIN {_refresh_pair('NEW')} END"),
+        ('semester_results_result_delete',
+         f"AFTER DELETE ON subject_results {when}BEGIN {_refresh_pair('OLD')} END"),
+        ('semester_results_result_update',
+         f"AFTER UPDATE OF user_id, subject_id, grade_point ON subject_results {when}"
+         f"BEGIN {_refresh_pair('OLD')} {_refresh_pair('NEW')} END"),
+        ('semester_results_subject_update',
+         "AFTER UPDATE OF credits, preset_id ON subjects BEGIN "
+         f"DELETE FROM semester_results WHERE preset_id IN (OLD.preset_id, NEW.preset_id) AND user_id IN {affected};"
+         + SEMESTER_RESULTS_REFRESH.format(
+             where=f"s.preset_id IN (OLD.preset_id, NEW.preset_id) AND sr.user_id IN {affected}")
+         + "; END"),
+        ('semester_results_subject_delete',
+         "AFTER DELETE ON subjects BEGIN "
+         "DELETE FROM semester_results WHERE preset_id = OLD.preset_id;"
+         + SEMESTER_RESULTS_REFRESH.format(where="s.preset_id = OLD.preset_id")
+         + "; END"),
+        ('semester_results_preset_delete',
+         "AFTER DELETE ON presets BEGIN DELETE FROM semester_results WHERE preset_id = OLD.id; END"),
+    ]
 
-    # Create grading_rules table
+
+def rebuild_semester_results(cursor):
+    """Recompute the whole semester_results table from subject_results."""
+    cursor.execute("DELETE FROM semester_results")
+    cursor.execute(SEMESTER_RESULTS_REFRESH.format(where="1"))
+
+
+# A row named SEMESTER_RESULTS_GUARD in trigger_guards turns the per-result
+# semester_results triggers off (and one named migrations.DATA_VERSIONS_GUARD
+# the data version triggers). bulk_results() adds them inside the writer's
+# transaction and removes them before that ends, so they are never committed
+# and other connections keep their triggers.
+SEMESTER_RESULTS_GUARD = 'semester_results'
+
+
+@contextmanager
+def bulk_results(cursor):
+    """Keep semester_results and the data versions (migrations.DATA_VERSIONS)
+    current for a bulk write with one set-based pass instead of one per row.
+
+    Inside the block their triggers are off for this connection; temp
+    triggers note which results and version namespaces are touched, and on
+    the way out the (user, preset) pairs are recomputed together and each
+    namespace is bumped once. Use within the caller's transaction, before it
+    commits. A nested use joins the outer one."""
+    from migrations import BULK_NAMESPACES_BUMP, DATA_VERSIONS_GUARD, data_version_triggers
+
+    cursor.execute("SELECT 1 FROM trigger_guards WHERE name = ?", (SEMESTER_RESULTS_GUARD,))
+    if cursor.fetchone():
+        yield
+        return
+
+    guards = [(SEMESTER_RESULTS_GUARD,), (DATA_VERSIONS_GUARD,)]
+    cursor.executemany("INSERT INTO trigger_guards (name) VALUES (?)", guards)
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS grading_rules (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            min_percentage REAL NOT NULL,
-            max_percentage REAL NOT NULL,
-            grade TEXT NOT NULL,
-            grade_point REAL NOT NULL
-        )
+        CREATE TEMP TABLE IF NOT EXISTS bulk_results (
+            user_id INTEGER, subject_id INTEGER, PRIMARY KEY (user_id, subject_id)
+        ) WITHOUT ROWID
     """)
+    cursor.execute("DELETE FROM bulk_results")
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_namespaces (namespace TEXT PRIMARY KEY) WITHOUT ROWID")
+    cursor.execute("DELETE FROM bulk_namespaces")
+
+    triggers = data_version_triggers(collect=True)
+    for event, rows in (('INSERT', ('NEW',)), ('UPDATE OF user_id, subject_id, grade_point', ('OLD', 'NEW')),
+                        ('DELETE', ('OLD',))):
+        # ON CONFLICT rather than OR IGNORE, which the outer statement's own conflict clause would override
+        body = ''.join(f"INSERT INTO bulk_results VALUES ({row}.user_id, {row}.subject_id) ON CONFLICT DO NOTHING;"
+                       for row in rows)
+        triggers.append((f"bulk_results_{event.split()[0].lower()}",
+                         f"AFTER {event} ON main.subject_results BEGIN {body} END"))
+    for name, body in triggers:
+        cursor.execute(f"CREATE TEMP TRIGGER {name} {body}")
+    try:
+        yield
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS bulk_pairs (
+                user_id INTEGER, preset_id INTEGER, PRIMARY KEY (user_id, preset_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("DELETE FROM bulk_pairs")
+        cursor.execute("""
+            INSERT OR IGNORE INTO bulk_pairs (user_id, preset_id)
+            SELECT b.user_id, s.preset_id FROM bulk_results b JOIN subjects s ON s.id = b.subject_id
+        """)
+        cursor.execute("DELETE FROM semester_results WHERE (user_id, preset_id) IN (SELECT user_id, preset_id FROM bulk_pairs)")
+        cursor.execute(SEMESTER_RESULTS_REFRESH.format(
+            where="sr.user_id IN (SELECT user_id FROM bulk_pairs) "
+                  "AND (sr.user_id, s.preset_id) IN (SELECT user_id, preset_id FROM bulk_pairs)"))
+        cursor.execute(BULK_NAMESPACES_BUMP)
+    finally:
+        for name, _ in triggers:
+            cursor.execute(f"DROP TRIGGER IF EXISTS temp.{name}")
+        cursor.executemany("DELETE FROM trigger_guards WHERE name = ?", guards)
+
+
+def create_tables():
+    """Bring the schema up to date (see migrations.py). Returns the
+    migrations applied, as [(version, name)]."""
+    from migrations import migrate
+
+    conn = create_connection()
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
+
+
+_bootstrapped = False
+_bootstrap_lock = threading.Lock()
+
+
+def bootstrap():
+    """Apply pending migrations once per process, before serving.
+
+    A database that is already current costs one PRAGMA user_version read.
+    migrate() holds SQLite's write lock while it works, so workers starting
+    together don't race; the ones that wait find nothing left to apply.
+    Uses its own connection so a gunicorn master (preload) forks without
+    pooled handles.
+
+    Returns the migrations applied, as [(version, name)].
+    """
+    from migrations import LATEST, migrate
+
+    global _bootstrapped
+    with _bootstrap_lock:
+        if _bootstrapped:
+            return []
+        conn = open_connection()
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            applied = [] if current == LATEST else migrate(conn)
+        finally:
+            conn.close()
+        _bootstrapped = True
+        return applied
 
-    # Insert default grading rules (matching official university system)
-    cursor.execute("SELECT COUNT(*) FROM grading_rules")
-    if cursor.fetchone()[0] == 0:
-        default_rules = [
-            (90.0, 100.0, 'O', 10),      # Outstanding: 90-100%
-            (80.0, 89.99, 'A+', 9),      # Excellent: 80-<90%
-            (70.0, 79.99, 'A', 8),       # Very Good: 70-<80%
-            (60.0, 69.99, 'B+', 7),      # Good: 60-<70%
-            (50.0, 59.99, 'B', 6),       # Above Average: 50-<60%
-            (40.0, 49.99, 'C', 5),       # Average: 40-<50%
-            (0.0, 39.99, 'F', 0)         # Fail: 0-<40%
-        ]
-        cursor.executemany("INSERT INTO grading_rules (min_percentage, max_percentage, grade, grade_point) VALUES (?, ?, ?, ?)", default_rules)
-
-    conn.commit()
-    conn.close()
 
 if __name__ == '__main__':
     create_tables()
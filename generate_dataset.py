@@ -0,0 +1,161 @@
+"""
+Synthetic Dataset Generator
+===========================
+
+Builds a database at realistic scale using the app's own schema
+(database.create_tables), for load testing and query-plan work.
+
+Every department x year x division gets one preset with its own subjects and
+components, and its own batch of students. Most students have marks for
+every component, and their results and CGPA are computed the same way
+calculate_cgpa does.
+
+Usage:
+    python generate_dataset.py bench.db
+    python generate_dataset.py bench.db --departments 6 --students 120 --seed 7
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+DEPARTMENTS = [
+    'Computer Engineering', 'Information Technology', 'AI & ML', 'Electronics',
+    'Mechanical Engineering', 'Civil Engineering', 'Data Science', 'Chemical Engineering',
+]
+YEARS = ['FE', 'SE', 'TE', 'BE']
+DIVISIONS = 'ABCDEFGH'
+# (name, max_marks), used in this order
+COMPONENTS = [('IAT1', 20), ('IAT2', 20), ('EndSem', 60), ('TermWork', 25), ('Practical', 25), ('Oral', 25)]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Generate a synthetic CGPA database.")
+    parser.add_argument('output', help="path of the database to create")
+    parser.add_argument('--departments', type=int, default=4, help="number of departments (max %d)" % len(DEPARTMENTS))
+    parser.add_argument('--years', type=int, default=4, help="years per department (max %d)" % len(YEARS))
+    parser.add_argument('--divisions', type=int, default=2, help="divisions per year (max %d)" % len(DIVISIONS))
+    parser.add_argument('--subjects', type=int, default=8, help="subjects per preset")
+    parser.add_argument('--components', type=int, default=3, help="components per subject (max %d)" % len(COMPONENTS))
+    parser.add_argument('--students', type=int, default=60, help="students per division")
+    parser.add_argument('--completion', type=float, default=0.9,
+                        help="fraction of students who have entered marks")
+    parser.add_argument('--academic-year', default='2025-2026')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--force', action='store_true', help="overwrite the output file")
+    return parser.parse_args(argv)
+
+
+def generate(args):
+    if os.path.exists(args.output):
+        if not args.force:
+            sys.exit(f"{args.output} exists; pass --force to overwrite it.")
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.output + suffix):
+                os.remove(args.output + suffix)
+
+    # database.py reads DATABASE_PATH at import time
+    os.environ['DATABASE_PATH'] = os.path.abspath(args.output)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import database
+    import grading
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    database.create_tables()
+
+    conn = database.create_connection()
+    cursor = conn.cursor()
+    rules = grading.load_rules(cursor)
+    components = COMPONENTS[:args.components]
+
+    counts = dict.fromkeys(['presets', 'subjects', 'components', 'students', 'marks', 'results'], 0)
+    roll = 0
+    for department in DEPARTMENTS[:args.departments]:
+        for year_index, year in enumerate(YEARS[:args.years]):
+            semester = str(year_index * 2 + 1)
+            for division in DIVISIONS[:args.divisions]:
+                cursor.execute(
+                    "INSERT INTO presets (academic_year, course, department, year, division, semester) VALUES (?, ?, ?, ?, ?, ?)",
+                    (args.academic_year, 'B.E', department, year, division, semester)
+                )
+                preset_id = cursor.lastrowid
+                counts['presets'] += 1
+
+                # Class structure: [(subject_id, credits, [(component_id, max_marks)])]
+                tree = []
+                for n in range(args.subjects):
+                    credits = rng.choice([2, 3, 3, 4])
+                    code = f"{department[:2].upper()}{year_index + 1}{n + 1:02d}"
+                    cursor.execute("INSERT INTO subjects (preset_id, name, code, credits) VALUES (?, ?, ?, ?)",
+                                   (preset_id, f"Subject {code}", code, credits))
+                    subject_id = cursor.lastrowid
+                    comps = []
+                    for name, max_marks in components:
+                        cursor.execute("INSERT INTO components (subject_id, name, max_marks) VALUES (?, ?, ?)",
+                                       (subject_id, name, max_marks))
+                        comps.append((cursor.lastrowid, max_marks))
+                    tree.append((subject_id, credits, comps))
+                counts['subjects'] += len(tree)
+                counts['components'] += len(tree) * len(components)
+
+                user_ids = []
+                for _ in range(args.students):
+                    roll += 1
+                    cursor.execute(
+                        "INSERT INTO users (email, name, roll_number, enrollment_number, department, academic_year, current_year) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (f"student{roll:06d}@example.edu", f"Student {roll}", f"{roll:06d}",
+                         f"EN{roll:08d}", department, args.academic_year, year)
+                    )
+                    user_ids.append(cursor.lastrowid)
+                counts['students'] += len(user_ids)
+
+                marks_rows, result_rows, cgpa_rows = [], [], []
+                for user_id in user_ids:
+                    if rng.random() >= args.completion:
+                        continue
+                    ability = rng.uniform(0.35, 0.95)
+                    total_credits = 0
+                    total_points = 0
+                    for subject_id, credits, comps in tree:
+                        obtained_total = 0
+                        max_total = 0
+                        for comp_id, max_marks in comps:
+                            share = min(1.0, max(0.0, rng.gauss(ability, 0.12)))
+                            obtained = float(round(share * max_marks))
+                            marks_rows.append((user_id, comp_id, obtained))
+                            obtained_total += obtained
+                            max_total += max_marks
+                        percentage = obtained_total / max_total * 100 if max_total else 0
+                        grade, grade_point = rules.grade(percentage)
+                        result_rows.append((user_id, subject_id, obtained_total, max_total, percentage, grade, grade_point))
+                        total_credits += credits
+                        total_points += grade_point * credits
+                    cgpa_rows.append((user_id, total_points / total_credits if total_credits else 0))
+
+                cursor.executemany(
+                    "INSERT INTO student_marks (user_id, component_id, marks_obtained) VALUES (?, ?, ?)",
+                    marks_rows
+                )
+                cursor.executemany(
+                    "INSERT INTO subject_results (user_id, subject_id, total_obtained_marks, total_max_marks, percentage, grade, grade_point) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    result_rows
+                )
+                cursor.executemany("INSERT INTO cgpa (user_id, cgpa) VALUES (?, ?)", cgpa_rows)
+                counts['marks'] += len(marks_rows)
+                counts['results'] += len(result_rows)
+        conn.commit()
+        print(f"  {department}: done")
+
+    conn.close()
+    database.checkpoint()
+
+    elapsed = time.perf_counter() - start
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+    print(f"Wrote {args.output} in {elapsed:.1f}s")
+
+
+if __name__ == '__main__':
+    generate(parse_args(sys.argv[1:]))
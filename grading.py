@@ -0,0 +1,153 @@
+import threading
+import time
+from bisect import bisect_left
+
+import cache_bus
+import database
+
+DEFAULT_GRADE = ('F', 0.0)
+
+
+class GradingTable:
+    """Grading rules compiled into sorted boundary arrays.
+
+    Semantics match the old linear scan exactly: the first rule (in table
+    order) with min_percentage <= p <= max_percentage wins, and anything
+    matching no rule is an F. The boundaries split the number line into
+    points and open gaps; each piece's grade is resolved once at compile
+    time, so a lookup is a single bisect.
+    """
+
+    def __init__(self, rules):
+        # rules: iterable of (min_percentage, max_percentage, grade, grade_point), in table order
+        self.rules = [(float(r[0]), float(r[1]), r[2], r[3]) for r in rules]
+        self.bounds = sorted({b for r in self.rules for b in r[:2]})
+
+        # at_bound[i]: grade exactly at bounds[i]
+        # between[i]: grade strictly between bounds[i-1] and bounds[i]
+        #             (between[0] is below all bounds, between[-1] above all)
+        self.at_bound = [self._scan(b) for b in self.bounds]
+        self.between = [self._scan(self._inside(i)) for i in range(len(self.bounds) + 1)]
+
+    def _inside(self, i):
+        if not self.bounds:
+            return 0.0
+        if i == 0:
+            return self.bounds[0] - 1
+        if i == len(self.bounds):
+            return self.bounds[-1] + 1
+        return (self.bounds[i - 1] + self.bounds[i]) / 2
+
+    def _scan(self, percentage):
+        for min_p, max_p, g, p in self.rules:
+            if percentage >= min_p and percentage <= max_p:
+                return g, p
+        return DEFAULT_GRADE
+
+    def __len__(self):
+        return len(self.rules)
+
+    def grade(self, percentage):
+        """Return (grade, grade_point) for a single percentage."""
+        i = bisect_left(self.bounds, percentage)
+        if i < len(self.bounds) and self.bounds[i] == percentage:
+            return self.at_bound[i]
+        return self.between[i]
+
+    def grade_many(self, percentages):
+        """Grade a whole column of percentages in one call."""
+        bounds, at_bound, between = self.bounds, self.at_bound, self.between
+        n = len(bounds)
+        out = []
+        for p in percentages:
+            i = bisect_left(bounds, p)
+            out.append(at_bound[i] if i < n and bounds[i] == p else between[i])
+        return out
+
+
+def compile_rules(rules):
+    return GradingTable(rules)
+
+
+# In-process cache of the compiled table, keyed by the 'grading_rules'
+# cache_bus version. Triggers on grading_rules bump it, so admin edits (and
+# scripts like update_grading_rules.py) invalidate it in every worker.
+_cache = {'version': None, 'table': None}
+_cache_lock = threading.Lock()
+
+
+def load_rules(cursor):
+    """Return the compiled GradingTable, re-reading grading_rules only when
+    its version moved since the last call."""
+    version = cache_bus.version('grading_rules')
+    if version is not None and version == _cache['version']:
+        return _cache['table']
+
+    cursor.execute("SELECT min_percentage, max_percentage, grade, grade_point FROM grading_rules ORDER BY id")
+    table = compile_rules(cursor.fetchall())
+
+    if version is not None:
+        with _cache_lock:
+            _cache['version'] = version
+            _cache['table'] = table
+    return table
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache['version'] = None
+        _cache['table'] = None
+
+
+def regrade_all(cursor, table):
+    """Re-grade every subject_results row against `table` and refresh the CGPA
+    of the students whose grades moved. Only rows whose percentage, grade or
+    grade point actually change are written. Does not commit.
+
+    Returns a dict with rows_scanned, rows_changed, users_updated and elapsed (s).
+    """
+    start = time.perf_counter()
+
+    cursor.execute("""
+        SELECT id, user_id, total_obtained_marks, total_max_marks, percentage, grade, grade_point
+        FROM subject_results  -- full scan: every result is re-graded
+    """)
+    rows = cursor.fetchall()
+
+    percentages = [(obt / mx * 100) if mx and mx > 0 else 0 for _, _, obt, mx, _, _, _ in rows]
+    new_grades = table.grade_many(percentages)
+
+    updates = []
+    changed_users = set()
+    for row, perc, (new_g, new_p) in zip(rows, percentages, new_grades):
+        res_id, u_id, _, _, old_perc, old_g, old_p = row
+        if perc != old_perc or new_g != old_g or new_p != old_p:
+            updates.append((perc, new_g, new_p, res_id))
+            changed_users.add(u_id)
+
+    # semester_results and the data versions follow in one pass, not per row
+    with database.bulk_results(cursor):
+        cursor.executemany("UPDATE subject_results SET percentage=?, grade=?, grade_point=? WHERE id=?", updates)
+
+        # CGPA for affected students only, in one set-based statement
+        if changed_users:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS regrade_users (user_id INTEGER PRIMARY KEY)")
+            cursor.execute("DELETE FROM regrade_users")
+            cursor.executemany("INSERT INTO regrade_users (user_id) VALUES (?)", [(u,) for u in changed_users])
+            cursor.execute("""
+                INSERT OR REPLACE INTO cgpa (user_id, cgpa)
+                SELECT ru.user_id,
+                       COALESCE(SUM(sr.grade_point * s.credits) * 1.0 / NULLIF(SUM(s.credits), 0), 0)
+                FROM regrade_users ru
+                JOIN subject_results sr ON sr.user_id = ru.user_id
+                LEFT JOIN subjects s ON s.id = sr.subject_id
+                GROUP BY ru.user_id
+            """)
+            cursor.execute("DELETE FROM regrade_users")
+
+    return {
+        'rows_scanned': len(rows),
+        'rows_changed': len(updates),
+        'users_updated': len(changed_users),
+        'elapsed': time.perf_counter() - start,
+    }
@@ -0,0 +1,29 @@
+"""gunicorn settings, picked up automatically by `gunicorn`.
+
+The app is built once in the master by create_app() (preload_app), which is
+where the schema bootstrap runs; workers fork from it with nothing left to
+set up.
+Each worker logs how long it took from fork to ready, and reports it as
+app_boot_seconds on /metrics.
+"""
+
+import os
+import time
+
+wsgi_app = 'app:create_app()'
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+
+
+def post_worker_init(worker):
+    import metrics
+
+    seconds = time.perf_counter() - worker.boot_started
+    metrics.record_boot(seconds)
+    worker.log.info("Worker %s booted in %.1f ms", worker.pid, seconds * 1000)
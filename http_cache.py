@@ -0,0 +1,79 @@
+"""Conditional GET (ETag / Last-Modified) for pages and downloads built
+from versioned data.
+
+A view names the cache_bus namespaces its output depends on, e.g.
+'user:<id>' and 'presets' for a result page. The ETag is made of their
+versions, so it is known before any data is read: when the browser's copy
+is still current, not_modified() answers 304 without querying or
+rendering anything. Otherwise the view builds the response as usual and
+passes it through add_validators().
+
+Responses are private and must be revalidated on every use (no-cache), so
+a browser never shows a stale page without asking first.
+"""
+
+import os
+import zlib
+from datetime import datetime, timezone
+
+from flask import Response, request, session
+
+import cache_bus
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _build_stamp():
+    # Changing the code or a template changes every ETag
+    paths = [os.path.join(_ROOT, name) for name in os.listdir(_ROOT) if name.endswith('.py')]
+    templates = os.path.join(_ROOT, 'templates')
+    if os.path.isdir(templates):
+        paths += [os.path.join(templates, name) for name in os.listdir(templates)]
+    return format(int(max(os.path.getmtime(path) for path in paths)), 'x')
+
+
+BUILD = _build_stamp()
+
+
+def validators(*namespaces):
+    """(etag, last_modified) for a response built from `namespaces`, or
+    (None, None) when the database keeps no versions."""
+    versions = [cache_bus.version(namespace) for namespace in namespaces]
+    if None in versions:
+        return None, None
+    # The page header shows who is signed in
+    user = session.get('user') or {}
+    viewer = zlib.crc32(repr((user.get('email'), user.get('name'), user.get('picture'))).encode())
+    etag = f"{request.endpoint}-{BUILD}-{'.'.join(map(str, versions))}-{viewer:x}"
+
+    stamps = [cache_bus.changed_at(namespace) for namespace in namespaces]
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    last_modified = datetime.fromtimestamp(max(stamps), timezone.utc) if stamps else None
+    return etag, last_modified
+
+
+def add_validators(response, etag, last_modified):
+    if etag is None:
+        return response
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag, last_modified):
+    """A 304 response if the browser's copy is current, else None."""
+    if etag is None or '_flashes' in session:
+        # Messages waiting to be shown need a fresh page
+        return None
+    if request.if_none_match:
+        current = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        current = last_modified <= request.if_modified_since
+    else:
+        current = False
+    if not current:
+        return None
+    return add_validators(Response(status=304), etag, last_modified)
@@ -0,0 +1,229 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+from flask import current_app, g, has_app_context, request
+
+# Set by init_app(). ENABLED: statements are timed per request.
+# REPORT: N+1 detection, the /admin/perf history and dev-mode headers.
+ENABLED = False
+REPORT = False
+
+# A statement shape run this many times in one request is flagged as N+1
+NPLUSONE_THRESHOLD = int(os.getenv('SQL_NPLUSONE_THRESHOLD', '10'))
+
+# Recent requests kept per worker for /admin/perf
+HISTORY_SIZE = 200
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'IN\s*\((?:\s*\?\s*,)*\s*\?\s*\)', re.I)
+
+
+@lru_cache(maxsize=2048)
+def normalize(sql):
+    """Reduce a statement to its shape: literals become ?, IN lists collapse,
+    whitespace is squeezed. Two statements differing only in values match."""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('IN (?...)', sql)
+    return ' '.join(sql.split())
+
+
+class RequestStats:
+    """Statements run during one request, aggregated by shape."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.shapes = {}          # shape -> [count, total_seconds]
+        self.count = 0
+        self.sql_time = 0.0
+
+    def record(self, sql, elapsed):
+        entry = self.shapes.setdefault(normalize(sql), [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        self.count += 1
+        self.sql_time += elapsed
+
+    def statements(self):
+        """[(shape, count, seconds)] sorted by total time."""
+        rows = [(shape, count, seconds) for shape, (count, seconds) in self.shapes.items()]
+        return sorted(rows, key=lambda r: r[2], reverse=True)
+
+    def repeated(self, threshold=NPLUSONE_THRESHOLD):
+        return [s for s in self.statements() if s[1] >= threshold]
+
+
+class InstrumentedCursor:
+    """Cursor wrapper that times execute/executemany/executescript."""
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method, sql, *args):
+        start = time.perf_counter()
+        try:
+            method(sql, *args)
+        finally:
+            self._stats.record(sql, time.perf_counter() - start)
+        return self
+
+    def execute(self, sql, params=()):
+        return self._timed(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(self._cursor.executemany, sql, seq_of_params)
+
+    def executescript(self, script):
+        return self._timed(self._cursor.executescript, script)
+
+
+class InstrumentedConnection:
+    """Wraps a pooled connection so every cursor it hands out is timed."""
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def cursor(self):
+        return InstrumentedCursor(self._conn.cursor(), self._stats)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def close(self):
+        self._conn.close()
+
+
+def wrap(conn):
+    """Return `conn` instrumented for the current request, or unchanged
+    outside a request or when instrumentation is off."""
+    if not ENABLED or not has_app_context():
+        return conn
+    stats = g.get('_sql_stats')
+    if stats is None:
+        return conn
+    return InstrumentedConnection(conn, stats)
+
+
+# Per-worker history for /admin/perf
+_history = deque(maxlen=HISTORY_SIZE)
+_endpoints = {}
+_lock = threading.Lock()
+
+
+def _start_request():
+    g._sql_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.get('_sql_stats')
+    if stats is None or not REPORT:
+        return response
+
+    elapsed = time.perf_counter() - stats.started
+    repeated = stats.repeated()
+    if repeated:
+        current_app.logger.warning("[N+1] %s %s: %s", request.method, request.path,
+                                   "; ".join(f"{count}x {shape[:120]}" for shape, count, _ in repeated))
+
+    entry = {
+        'endpoint': request.endpoint or request.path,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'status': response.status_code,
+        'queries': stats.count,
+        'sql_time': stats.sql_time,
+        'elapsed': elapsed,
+        'repeated': repeated,
+        'statements': stats.statements()[:15],
+        'at': time.strftime('%H:%M:%S'),
+    }
+    with _lock:
+        _history.appendleft(entry)
+        agg = _endpoints.setdefault(entry['endpoint'], {
+            'endpoint': entry['endpoint'], 'requests': 0, 'queries': 0,
+            'max_queries': 0, 'sql_time': 0.0, 'elapsed': 0.0, 'nplusone': 0,
+        })
+        agg['requests'] += 1
+        agg['queries'] += stats.count
+        agg['max_queries'] = max(agg['max_queries'], stats.count)
+        agg['sql_time'] += stats.sql_time
+        agg['elapsed'] += elapsed
+        agg['nplusone'] += 1 if repeated else 0
+
+    if g.get('_sql_headers'):
+        response.headers['X-SQL-Count'] = str(stats.count)
+        response.headers['X-SQL-Time-Ms'] = f"{stats.sql_time * 1000:.2f}"
+        response.headers['X-SQL-NPlusOne'] = str(len(repeated))
+        if repeated:
+            shape, count, _ = repeated[0]
+            response.headers['X-SQL-NPlusOne-Top'] = f"{count}x {shape[:200]}"
+    return response
+
+
+def recent_requests():
+    with _lock:
+        return list(_history)
+
+
+def endpoint_summary():
+    """Per-endpoint totals, slowest SQL first."""
+    with _lock:
+        rows = [dict(a) for a in _endpoints.values()]
+    for row in rows:
+        row['avg_queries'] = row['queries'] / row['requests']
+        row['avg_sql_ms'] = row['sql_time'] * 1000 / row['requests']
+        row['avg_ms'] = row['elapsed'] * 1000 / row['requests']
+    return sorted(rows, key=lambda r: r['sql_time'], reverse=True)
+
+
+def reset():
+    with _lock:
+        _history.clear()
+        _endpoints.clear()
+
+
+def init_app(app, headers=False, timing=False):
+    """Record SQL for every request; with headers=True (dev mode) also
+    report the counts on each response as X-SQL-* headers. timing=True
+    keeps per-request SQL timing on (for metrics) even with reports off.
+
+    Reports are on by default in dev mode; SQL_INSTRUMENT=true/false
+    overrides. Read here rather than at import so values from .env are seen.
+    """
+    global ENABLED, REPORT
+    REPORT = os.getenv('SQL_INSTRUMENT', os.getenv('DEV_MODE', 'false')).lower() == 'true'
+    ENABLED = REPORT or timing
+    if not ENABLED:
+        return
+
+    @app.before_request
+    def start_sql_stats():
+        _start_request()
+        g._sql_headers = headers
+
+    app.after_request(_finish_request)
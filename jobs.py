@@ -0,0 +1,317 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+
+import database
+from database import create_connection, DB_PATH
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+
+# Progress/cancel bookkeeping is written on a side connection. A running job
+# usually holds the write lock, so these writes are throttled, use a short
+# busy timeout and are dropped if the database is busy.
+PROGRESS_INTERVAL = 1.0
+SIDE_TIMEOUT = 0.05
+
+# Each job records the worker process that owns it, which stamps a heartbeat
+# on its unfinished jobs every HEARTBEAT_INTERVAL seconds. A queued or
+# running job whose owner is gone, or that has not had a heartbeat for
+# JOB_STALE_AFTER seconds (a restarted container can reuse the pid), is
+# failed by recover_orphans(): at bootstrap, and at most every
+# HEARTBEAT_INTERVAL when jobs are read.
+HEARTBEAT_INTERVAL = 15.0
+STALE_AFTER = float(os.getenv('JOB_STALE_AFTER', '600'))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class JobContext:
+    """Handed to every job function: report progress, check for cancellation."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._last_write = 0.0
+        self._last_check = 0.0
+
+    def _side_write(self, sql, params):
+        try:
+            with closing(sqlite3.connect(DB_PATH, timeout=SIDE_TIMEOUT)) as conn:
+                conn.execute(sql, params)
+                conn.commit()
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    def progress(self, fraction, message=None, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_write < PROGRESS_INTERVAL:
+            return
+        if self._side_write("UPDATE jobs SET progress=?, message=COALESCE(?, message), heartbeat_at=? WHERE id=?",
+                            (max(0.0, min(1.0, fraction)), message, time.time(), self.job_id)):
+            self._last_write = now
+
+    def check_cancelled(self):
+        """Raise JobCancelled if an admin asked to cancel this job."""
+        now = time.monotonic()
+        if now - self._last_check < PROGRESS_INTERVAL:
+            return
+        self._last_check = now
+        conn = sqlite3.connect(DB_PATH)
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=?", (self.job_id,)).fetchone()
+        conn.close()
+        if row and row[0]:
+            raise JobCancelled()
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Ids of this process's unfinished jobs, kept alive by the heartbeat thread
+_active = set()
+_last_recovery = 0.0
+
+
+def _get_executor():
+    # One executor (and heartbeat thread) per worker process; never reuse
+    # threads across fork()
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+            _executor_pid = os.getpid()
+            _active.clear()
+            threading.Thread(target=_heartbeat, name='job-heartbeat', daemon=True).start()
+    return _executor
+
+
+def _heartbeat():
+    pid = os.getpid()
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        with _executor_lock:
+            job_ids = list(_active)
+        if not job_ids:
+            continue
+        # A job holding the write lock can delay this; STALE_AFTER allows for that
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=5)
+            conn.execute(f"UPDATE jobs SET heartbeat_at=? WHERE owner_pid=? AND id IN ({','.join('?' * len(job_ids))})",
+                         [time.time(), pid] + job_ids)
+            conn.commit()
+            conn.close()
+        except sqlite3.OperationalError:
+            pass
+
+
+def _owner_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def recover_orphans(force=True):
+    """Fail queued/running jobs whose worker process is gone or has stopped
+    sending heartbeats. Returns how many were failed. Without `force`, runs
+    at most once per HEARTBEAT_INTERVAL in this process."""
+    global _last_recovery
+    now = time.time()
+    if not force and now - _last_recovery < HEARTBEAT_INTERVAL:
+        return 0
+    _last_recovery = now
+
+    # Unpooled: create_app() runs this in a preloading gunicorn master,
+    # which must fork with no pooled connections open
+    conn = database.open_connection()
+    try:
+        return _fail_orphans(conn, now)
+    finally:
+        conn.close()
+
+
+def _fail_orphans(conn, now):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, owner_pid, heartbeat_at FROM jobs WHERE status IN ('queued', 'running')")
+    with _executor_lock:
+        ours = set(_active) if _executor_pid == os.getpid() else set()
+    orphans = [job_id for job_id, pid, heartbeat in cursor.fetchall()
+               if job_id not in ours and
+               (pid is None or not _owner_alive(pid) or (heartbeat or 0) < now - STALE_AFTER)]
+    failed = 0
+    for job_id in orphans:
+        # Only if nothing has touched it since it was read
+        cursor.execute("""
+            UPDATE jobs SET status='failed', error=?, finished_at=?
+            WHERE id=? AND status IN ('queued', 'running') AND COALESCE(heartbeat_at, 0) < ?
+        """, ("The worker running this job stopped before it finished.", _now(), job_id, now - HEARTBEAT_INTERVAL))
+        failed += cursor.rowcount
+    conn.commit()
+    return failed
+
+
+def _set_status(job_id, status, **fields):
+    columns = ['status=?']
+    params = [status]
+    for key, value in fields.items():
+        columns.append(f"{key}=?")
+        params.append(value)
+    params.append(job_id)
+
+    conn = create_connection()
+    conn.execute(f"UPDATE jobs SET {', '.join(columns)} WHERE id=?", params)
+    conn.commit()
+    conn.close()
+
+
+def _run(job_id, func, args, kwargs):
+    conn = create_connection()
+    row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=?", (job_id,)).fetchone()
+    conn.close()
+    if row and row[0]:
+        _set_status(job_id, 'cancelled', finished_at=_now())
+        with _executor_lock:
+            _active.discard(job_id)
+        return
+
+    _set_status(job_id, 'running', started_at=_now(), heartbeat_at=time.time())
+    ctx = JobContext(job_id)
+    try:
+        result = func(ctx, *args, **kwargs)
+        _set_status(job_id, 'done', progress=1.0, finished_at=_now(),
+                    result=json.dumps(result) if result is not None else None)
+    except JobCancelled:
+        _set_status(job_id, 'cancelled', finished_at=_now())
+    except Exception as e:
+        logger.exception("Job %s (%s) failed", job_id, func.__name__)
+        _set_status(job_id, 'failed', error=str(e), finished_at=_now())
+    finally:
+        with _executor_lock:
+            _active.discard(job_id)
+
+
+def submit(kind, func, *args, created_by=None, message=None, **kwargs):
+    """Queue `func(ctx, *args, **kwargs)` on the worker's job pool and return the job id.
+    The function's return value (JSON-serialisable) is stored as the job result."""
+    executor = _get_executor()
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO jobs (kind, status, message, created_by, created_at, owner_pid, heartbeat_at) "
+        "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+        (kind, message, created_by, _now(), os.getpid(), time.time())
+    )
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+
+    with _executor_lock:
+        _active.add(job_id)
+    executor.submit(_run, job_id, func, args, kwargs)
+    return job_id
+
+
+def reclaim(job):
+    """Write `job` (as get_job() returns it) back as running in this
+    process, replacing any row with its id. For a job whose own row was
+    lost, e.g. to the restore it performs."""
+    conn = create_connection()
+    conn.execute("""
+        INSERT INTO jobs (id, kind, status, message, created_by, created_at, started_at, owner_pid, heartbeat_at)
+        VALUES (?, ?, 'running', ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            kind=excluded.kind, status='running', progress=0, message=excluded.message, result=NULL,
+            error=NULL, cancel_requested=0, created_by=excluded.created_by, created_at=excluded.created_at,
+            started_at=excluded.started_at, finished_at=NULL, owner_pid=excluded.owner_pid,
+            heartbeat_at=excluded.heartbeat_at
+    """, (job['id'], job['kind'], job['message'], job['created_by'], job['created_at'], job['started_at'],
+          os.getpid(), time.time()))
+    conn.commit()
+    conn.close()
+
+
+def cancel(job_id):
+    """Ask a job to stop. Queued jobs never start; running jobs stop at their next check."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE jobs SET cancel_requested=1 WHERE id=? AND status IN ('queued', 'running')",
+        (job_id,)
+    )
+    changed = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return changed > 0
+
+
+def _row_to_job(row):
+    job = {
+        'id': row[0],
+        'kind': row[1],
+        'status': row[2],
+        'progress': row[3],
+        'message': row[4],
+        'result': json.loads(row[5]) if row[5] else None,
+        'error': row[6],
+        'cancel_requested': bool(row[7]),
+        'created_by': row[8],
+        'created_at': row[9],
+        'started_at': row[10],
+        'finished_at': row[11],
+    }
+    return job
+
+
+JOB_COLUMNS = "id, kind, status, progress, message, result, error, cancel_requested, created_by, created_at, started_at, finished_at"
+
+
+def get_job(job_id):
+    recover_orphans(force=False)
+    conn = create_connection()
+    row = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id=?", (job_id,)).fetchone()
+    conn.close()
+    return _row_to_job(row) if row else None
+
+
+def list_jobs(limit=50):
+    recover_orphans(force=False)
+    conn = create_connection()
+    rows = conn.execute(f"""
+        SELECT {JOB_COLUMNS} FROM jobs ORDER BY id DESC LIMIT ?
+        -- full scan: newest first down the rowid, stops after `limit` rows
+    """, (limit,)).fetchall()
+    conn.close()
+    return [_row_to_job(r) for r in rows]
+
+
+def queue_depth():
+    recover_orphans(force=False)
+    conn = create_connection()
+    row = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()
+    conn.close()
+    return row[0]
+
+
+def export_path(job_id, filename):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    return os.path.join(EXPORT_DIR, f"job{job_id}_{filename}")
@@ -0,0 +1,308 @@
+"""Bulk marks import: a class spreadsheet (CSV or XLSX) into a preset.
+
+The first row is the header. One column identifies the student: Email if
+there is one, else Roll Number. Every other column is matched to a
+component of the preset by "<subject name or code> <component>", ignoring
+case, spaces and punctuation (template_header() gives the canonical form).
+A subject with a single component also matches by its name or code alone.
+
+Rows stream through the parser and are validated one at a time:
+- A blank cell leaves that mark as it is.
+- AB/ABS/ABSENT counts as 0.
+- Anything else must be a number between 0 and the component's max marks.
+If any row is invalid, nothing is written.
+
+Otherwise everything happens in one transaction. The marks are upserted
+with one executemany. The students touched are then regraded in one
+set-based pass: their totals for every subject of the preset are
+aggregated by one GROUP BY, graded with grade_many and written with one
+executemany. The CGPA is one INSERT ... SELECT.
+"""
+
+import math
+import time
+
+import database
+import grading
+from spreadsheets import SpreadsheetError, header_key, normalize_roll, read_rows
+
+# Validation errors listed in the report (the rest are only counted)
+MAX_ERRORS = 50
+
+ABSENT = {'AB', 'ABS', 'ABSENT'}
+
+
+class MarksImportError(SpreadsheetError):
+    """The file doesn't fit the preset (or the preset has nothing to import into)."""
+
+
+# ---------------------------------------------------------------------------
+# Header and student mapping
+# ---------------------------------------------------------------------------
+
+def load_components(cursor, preset_id):
+    """(subject_id, subject_name, code, component_id, component_name, max_marks)
+    for every component of the preset, in display order."""
+    cursor.execute("""
+        SELECT s.id, s.name, s.code, c.id, c.name, c.max_marks
+        FROM subjects s
+        JOIN components c ON c.subject_id = s.id
+        WHERE s.preset_id = ?
+        ORDER BY s.id, c.id
+    """, (preset_id,))
+    return cursor.fetchall()
+
+
+def template_header(components):
+    return ['Roll Number', 'Name'] + [f"{code or name} {comp}" for _, name, code, _, comp, _ in components]
+
+
+# Columns that are expected in a class sheet but not imported
+_SKIPPED = {'name', 'studentname', 'srno', 'sno', 'division', 'div'}
+
+
+def map_columns(header, components):
+    """Match the header to the preset.
+
+    Returns (key column, by_email, {column: (component_id, max_marks)},
+    ignored column titles).
+    """
+    per_subject = {}
+    for subject_id, *_ in components:
+        per_subject[subject_id] = per_subject.get(subject_id, 0) + 1
+
+    targets = {}
+    for subject_id, name, code, comp_id, comp_name, max_marks in components:
+        for label in filter(None, (name, code)):
+            targets.setdefault(header_key(label) + header_key(comp_name), (comp_id, max_marks))
+            if per_subject[subject_id] == 1:
+                targets.setdefault(header_key(label), (comp_id, max_marks))
+
+    email_col = roll_col = None
+    columns = {}
+    ignored = []
+    for i, title in enumerate(header):
+        key = header_key(title)
+        if key in ('email', 'emailid', 'emailaddress'):
+            email_col = i
+        elif key in ('rollnumber', 'rollno', 'roll'):
+            roll_col = i
+        elif key in targets:
+            if targets[key] in columns.values():
+                raise MarksImportError(f'Column "{title}" repeats a component that already has a column.')
+            columns[i] = targets[key]
+        elif key and key not in _SKIPPED:
+            ignored.append(title)
+
+    if email_col is None and roll_col is None:
+        raise MarksImportError('The header needs a "Roll Number" or "Email" column.')
+    if not columns:
+        raise MarksImportError('No column matches a component of this preset. '
+                               'Download the template for the expected headers.')
+    if email_col is not None:
+        return email_col, True, columns, ignored
+    return roll_col, False, columns, ignored
+
+
+def student_lookup(cursor, preset, by_email):
+    """A function mapping a row's key cell to (user_id, problem).
+
+    Roll numbers are only unique within a class, so a roll is looked up
+    among the students of the preset's department and year first, and
+    anywhere else only if that finds no one.
+    """
+    department, year = preset[3], preset[4]
+    cursor.execute("""
+        SELECT id, email, roll_number, department, current_year
+        FROM users  -- full scan: the whole roster is indexed in memory once
+        WHERE is_admin = 0
+    """)
+    index = {}
+    for user_id, email, roll, dept, current_year in cursor.fetchall():
+        key = (email or '').strip().lower() if by_email else normalize_roll(roll or '')
+        if key:
+            index.setdefault(key, []).append((user_id, dept == department and current_year == year))
+
+    def lookup(cell):
+        key = cell.strip().lower() if by_email else normalize_roll(cell)
+        if not key:
+            return None, 'no roll number or email'
+        found = index.get(key)
+        if not found:
+            return None, f'no student with {"email" if by_email else "roll number"} {cell.strip()}'
+        in_class = [user_id for user_id, local in found if local]
+        candidates = in_class or [user_id for user_id, _ in found]
+        if len(candidates) > 1:
+            return None, f'{len(candidates)} students share roll number {cell.strip()}; use an Email column'
+        return candidates[0], None
+
+    return lookup
+
+
+def parse_mark(text, max_marks):
+    """The mark in a cell, or None for a blank cell. Raises ValueError."""
+    text = text.strip()
+    if not text:
+        return None
+    if text.upper() in ABSENT:
+        return 0.0
+    try:
+        value = float(text)
+    except ValueError:
+        raise ValueError(f'"{text}" is not a number')
+    if not math.isfinite(value) or value < 0 or value > max_marks:
+        raise ValueError(f'{text} is outside 0-{max_marks:g}')
+    return value
+
+
+# ---------------------------------------------------------------------------
+# Import
+# ---------------------------------------------------------------------------
+
+def regrade_students(cursor, preset_id, user_ids, components, rules):
+    """Recompute the preset's subject_results for `user_ids`, then their CGPA.
+    A subject's maximum counts every component, so marks not entered count
+    as 0 (as on the student form). Only results that change are written.
+    Does not commit. Returns the number of results written."""
+    subject_max = {}
+    for subject_id, _, _, _, _, max_marks in components:
+        subject_max[subject_id] = subject_max.get(subject_id, 0) + max_marks
+
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_users (user_id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM import_users")
+    cursor.executemany("INSERT INTO import_users (user_id) VALUES (?)", [(u,) for u in user_ids])
+
+    cursor.execute("""
+        SELECT sm.user_id, c.subject_id, SUM(sm.marks_obtained)
+        FROM import_users iu
+        JOIN student_marks sm ON sm.user_id = iu.user_id
+        JOIN components c ON c.id = sm.component_id
+        JOIN subjects s ON s.id = c.subject_id
+        WHERE s.preset_id = ?
+        GROUP BY sm.user_id, c.subject_id
+    """, (preset_id,))
+    totals = [(u, s, obt, subject_max[s]) for u, s, obt in cursor.fetchall() if s in subject_max]
+
+    cursor.execute("""
+        SELECT sr.user_id, sr.subject_id, sr.total_obtained_marks, sr.total_max_marks,
+               sr.percentage, sr.grade, sr.grade_point
+        FROM import_users iu
+        JOIN subject_results sr ON sr.user_id = iu.user_id
+        JOIN subjects s ON s.id = sr.subject_id
+        WHERE s.preset_id = ?
+    """, (preset_id,))
+    current = {(row[0], row[1]): row[2:] for row in cursor.fetchall()}
+
+    percentages = [(obt / mx * 100) if mx > 0 else 0 for _, _, obt, mx in totals]
+    rows = []
+    for (user_id, subject_id, obt, mx), perc, (grade, point) in zip(totals, percentages, rules.grade_many(percentages)):
+        if current.get((user_id, subject_id)) != (obt, mx, perc, grade, point):
+            rows.append((user_id, subject_id, obt, mx, perc, grade, point))
+
+    # Unchanged rows are skipped: each write is still a row to regrade and version
+    cursor.executemany("""
+        INSERT INTO subject_results
+            (user_id, subject_id, total_obtained_marks, total_max_marks, percentage, grade, grade_point)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, subject_id) DO UPDATE SET
+            total_obtained_marks = excluded.total_obtained_marks,
+            total_max_marks = excluded.total_max_marks,
+            percentage = excluded.percentage,
+            grade = excluded.grade,
+            grade_point = excluded.grade_point
+    """, rows)
+
+    cursor.execute("""
+        INSERT OR REPLACE INTO cgpa (user_id, cgpa)
+        SELECT iu.user_id,
+               COALESCE(SUM(sr.grade_point * s.credits) * 1.0 / NULLIF(SUM(s.credits), 0), 0)
+        FROM import_users iu
+        JOIN subject_results sr ON sr.user_id = iu.user_id
+        LEFT JOIN subjects s ON s.id = sr.subject_id
+        GROUP BY iu.user_id
+    """)
+    cursor.execute("DELETE FROM import_users")
+    return len(rows)
+
+
+def import_marks(conn, preset_id, filename, stream, dry_run=False):
+    """Validate a class sheet and, unless `dry_run` or a row is invalid,
+    write it in one transaction.
+
+    Returns a report dict: rows, students, marks, errors (up to MAX_ERRORS
+    "Row n: ..." messages), error_count, ignored_columns, results (subject
+    results written), imported (bool) and elapsed (s). Raises
+    SpreadsheetError (or MarksImportError) when the file itself can't be used.
+    """
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, academic_year, course, department, year, division, semester FROM presets WHERE id = ?",
+                   (preset_id,))
+    preset = cursor.fetchone()
+    if not preset:
+        raise MarksImportError('Preset not found.')
+    components = load_components(cursor, preset_id)
+    if not components:
+        raise MarksImportError('This preset has no subjects with components yet.')
+
+    rows = read_rows(filename, stream)
+    header = next(rows, None)
+    if not header:
+        raise MarksImportError('The file is empty.')
+    key_col, by_email, columns, ignored = map_columns(header, components)
+    lookup = student_lookup(cursor, preset, by_email)
+
+    report = {'rows': 0, 'students': 0, 'marks': 0, 'errors': [], 'error_count': 0,
+              'ignored_columns': ignored, 'results': 0, 'imported': False}
+
+    def error(row_no, message):
+        report['error_count'] += 1
+        if len(report['errors']) < MAX_ERRORS:
+            report['errors'].append(f"Row {row_no}: {message}")
+
+    marks = []
+    seen = {}   # user_id -> row number
+    for row_no, row in enumerate(rows, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        report['rows'] += 1
+        user_id, problem = lookup(row[key_col] if key_col < len(row) else '')
+        if problem:
+            error(row_no, problem)
+            continue
+        if user_id in seen:
+            error(row_no, f"same student as row {seen[user_id]}")
+            continue
+        seen[user_id] = row_no
+        for col, (comp_id, max_marks) in columns.items():
+            try:
+                value = parse_mark(row[col] if col < len(row) else '', max_marks)
+            except ValueError as e:
+                error(row_no, f"{header[col]}: {e}")
+                continue
+            if value is not None:
+                marks.append((user_id, comp_id, value))
+
+    report['students'] = len(seen)
+    report['marks'] = len(marks)
+    if report['error_count'] or dry_run or not marks:
+        report['elapsed'] = time.perf_counter() - start
+        return report
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        with database.bulk_results(cursor):
+            cursor.executemany("""
+                INSERT INTO student_marks (user_id, component_id, marks_obtained)
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id, component_id) DO UPDATE SET marks_obtained = excluded.marks_obtained
+            """, marks)
+            report['results'] = regrade_students(cursor, preset_id, list(seen), components,
+                                                 grading.load_rules(cursor))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    report['imported'] = True
+    report['elapsed'] = time.perf_counter() - start
+    return report
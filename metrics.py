@@ -0,0 +1,248 @@
+"""Prometheus-style metrics shared across gunicorn workers.
+
+Each worker accumulates counters and histogram buckets in memory and folds
+them into a small SQLite file (METRICS_PATH) every METRICS_FLUSH_INTERVAL
+seconds, so a scrape of /metrics on any worker sees the whole server.
+A worker that goes idle flushes on its next request, on exit, or when it
+serves a scrape. Per-worker gauges (pool usage, boot time) are stored per pid and are
+dropped once a worker has been silent for STALE_AFTER seconds.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, request
+
+import database
+
+ENABLED = False
+METRICS_PATH = os.getenv('METRICS_PATH', 'metrics.db')
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+STALE_AFTER = 300
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# family -> (type, help)
+FAMILIES = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Time to produce a response, by endpoint.'),
+    'db_time_seconds': ('histogram', 'Time spent in SQL per request, by endpoint.'),
+    'db_queries_total': ('counter', 'SQL statements executed in requests, by endpoint.'),
+    'db_pool_connections': ('gauge', 'Pooled connections per worker, by state.'),
+    'db_pool_max_size': ('gauge', 'Pool size limit per worker.'),
+    'db_pool_timeouts_total': ('counter', 'Pool checkouts that timed out, per worker.'),
+    'db_pool_wait_seconds_total': ('counter', 'Time spent waiting for a pooled connection, per worker.'),
+    'job_queue_depth': ('gauge', 'Background jobs queued or running.'),
+    'app_boot_seconds': ('gauge', 'Time from process start (or fork) until the worker was ready to serve.'),
+}
+
+_pending = {}        # (name, labels, le) -> amount to add
+_lock = threading.Lock()
+_last_flush = 0.0
+_boot_seconds = None
+
+
+def _labels(**labels):
+    return ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_le(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def inc(name, amount=1.0, **labels):
+    key = (name, _labels(**labels), '')
+    with _lock:
+        _pending[key] = _pending.get(key, 0.0) + amount
+
+
+def observe(name, value, buckets, **labels):
+    """Add one observation to histogram `name` (cumulative buckets, _sum, _count)."""
+    base = _labels(**labels)
+    with _lock:
+        for bound in buckets + (float('inf'),):
+            if value <= bound:
+                key = (name + '_bucket', base, _format_le(bound))
+                _pending[key] = _pending.get(key, 0.0) + 1
+        for suffix, amount in (('_sum', value), ('_count', 1)):
+            key = (name + suffix, base, '')
+            _pending[key] = _pending.get(key, 0.0) + amount
+
+
+def record_boot(seconds):
+    """Remember how long this worker took to boot; reported as a per-worker gauge."""
+    global _boot_seconds
+    _boot_seconds = seconds
+
+
+def boot_seconds():
+    return _boot_seconds
+
+
+def _connect():
+    conn = sqlite3.connect(METRICS_PATH, timeout=1)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS samples (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            le TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels, le)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS worker_gauges (
+            pid INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (pid, name, labels)
+        )
+    """)
+    return conn
+
+
+def _worker_gauges():
+    stats = database.pool_stats()
+    gauges = [
+        ('db_pool_connections', _labels(state='in_use'), stats['in_use']),
+        ('db_pool_connections', _labels(state='idle'), stats['idle']),
+        ('db_pool_max_size', '', stats['max_size']),
+        ('db_pool_timeouts_total', '', stats['timeouts']),
+        ('db_pool_wait_seconds_total', '', stats['wait_time_total']),
+    ]
+    if _boot_seconds is not None:
+        gauges.append(('app_boot_seconds', '', _boot_seconds))
+    return gauges
+
+
+def flush(force=False):
+    """Fold this worker's pending counts and current gauges into the shared store.
+    Rate-limited to once per FLUSH_INTERVAL unless forced; a busy store just
+    keeps the counts pending for the next attempt."""
+    global _last_flush
+    now = time.time()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = now
+
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+
+    pid = os.getpid()
+    try:
+        conn = _connect()
+        with conn:
+            conn.executemany("""
+                INSERT INTO samples (name, labels, le, value) VALUES (?, ?, ?, ?)
+                ON CONFLICT (name, labels, le) DO UPDATE SET value = value + excluded.value
+            """, [(name, labels, le, value) for (name, labels, le), value in pending.items()])
+            conn.executemany("""
+                INSERT OR REPLACE INTO worker_gauges (pid, name, labels, value, updated)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(pid, name, labels, value, now) for name, labels, value in _worker_gauges()])
+        conn.close()
+    except sqlite3.OperationalError:
+        with _lock:
+            for key, value in pending.items():
+                _pending[key] = _pending.get(key, 0.0) + value
+
+
+def _family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+            return name[:-len(suffix)]
+    return name
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _le_key(le):
+    return float('inf') if le == '+Inf' else float(le)
+
+
+def render(extra=()):
+    """All samples from the shared store in Prometheus text exposition format.
+    `extra` is (name, labels, value) for gauges computed at scrape time."""
+    flush(force=True)
+    conn = _connect()
+    conn.execute("DELETE FROM worker_gauges WHERE updated < ?", (time.time() - STALE_AFTER,))
+    conn.commit()
+    samples = conn.execute("SELECT name, labels, le, value FROM samples").fetchall()
+    gauges = conn.execute("SELECT pid, name, labels, value FROM worker_gauges").fetchall()
+    conn.close()
+
+    series = {}      # family -> [(name, labels, le, value)]
+    for name, labels, le, value in samples:
+        series.setdefault(_family(name), []).append((name, labels, le, value))
+    for pid, name, labels, value in gauges:
+        labels = f'{labels},pid="{pid}"' if labels else f'pid="{pid}"'
+        series.setdefault(name, []).append((name, labels, '', value))
+    for name, labels, value in extra:
+        series.setdefault(name, []).append((name, labels, '', value))
+
+    lines = []
+    for family in sorted(series):
+        kind, help_text = FAMILIES.get(family, ('untyped', ''))
+        lines.append(f"# HELP {family} {help_text}")
+        lines.append(f"# TYPE {family} {kind}")
+        # Per label set: buckets in increasing le order, then _count and _sum
+        for name, labels, le, value in sorted(series[family],
+                                              key=lambda s: (s[1], s[0], _le_key(s[2]) if s[2] else 0)):
+            if le:
+                labels = f'{labels},le="{le}"' if labels else f'le="{le}"'
+            value = _format_value(value)
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """Time every request and record it; read METRICS_ENABLED (default on)."""
+    global ENABLED
+    ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    if not ENABLED:
+        return
+
+    @app.before_request
+    def start_request_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('_metrics_start')
+        if start is None:
+            return response
+
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        stats = g.get('_sql_stats')
+
+        def record():
+            # Once the body has been sent: a streamed export's time and SQL
+            # are spent after after_request, while it is being iterated
+            elapsed = time.perf_counter() - start
+            observe('http_request_duration_seconds', elapsed, LATENCY_BUCKETS, endpoint=endpoint)
+            inc('http_requests_total', endpoint=endpoint, method=method, status=response.status_code)
+            if stats is not None:
+                observe('db_time_seconds', stats.sql_time, DB_BUCKETS, endpoint=endpoint)
+                inc('db_queries_total', stats.count, endpoint=endpoint)
+            flush()
+
+        response.call_on_close(record)
+        return response
+
+    atexit.register(flush, True)
@@ -0,0 +1,598 @@
+"""
+Schema Migrations
+=================
+
+Numbered migrations, applied in order and recorded in the schema_version
+table. migrate() runs every pending one inside a single transaction, so a
+failure leaves the database exactly as it was. PRAGMA user_version mirrors
+the latest applied number, so a booting worker can tell the schema is
+current with one read (see database.bootstrap()).
+
+Migrations 1-7 replace the old CREATE IF NOT EXISTS block and
+add_user_profile_fields.py. They are written to be safe on files created
+before schema_version existed, so older databases are simply brought
+forward. After migration 3 every database names the result totals
+total_obtained_marks/total_max_marks; app code relies on that.
+
+New migrations go at the end of MIGRATIONS and may assume the layout left
+by the previous ones.
+
+Usage:
+    python migrations.py                # migrate DATABASE_PATH (database.db)
+    python migrations.py other.db
+    python migrations.py --status [other.db]
+"""
+
+import sys
+from datetime import datetime
+
+from database import create_indexes, rebuild_semester_results, semester_results_triggers
+
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _table_exists(cursor, table):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return cursor.fetchone() is not None
+
+
+def _bump(namespace, source="WHERE true"):
+    """Trigger statement moving `namespace` (an SQL expression, one per row
+    of `source`) to one past the highest stamp of any namespace, like
+    cache_bus.bump()."""
+    return f"""
+        INSERT INTO cache_versions (namespace, version, changed_at)
+        SELECT {namespace}, (SELECT COALESCE(MAX(version), 0) FROM cache_versions) + 1,
+               CAST(strftime('%s', 'now') AS INTEGER)
+        {source}
+        ON CONFLICT (namespace) DO UPDATE SET version = excluded.version, changed_at = excluded.changed_at;
+    """
+
+
+def _version_triggers(cursor, table, namespace=None, changed_at=True):
+    """Any change to `table` bumps the cache_versions stamp of `namespace`
+    (default: the table's name), whoever makes it. Migrations older than
+    data_versions pass changed_at=False: the column doesn't exist yet, and
+    a table rename fails while any trigger names a missing column."""
+    namespace = namespace or table
+    cursor.execute("INSERT OR IGNORE INTO cache_versions (namespace, version) VALUES (?, 0)", (namespace,))
+    if changed_at:
+        body = _bump(f"'{namespace}'")
+    else:
+        body = f"""
+            UPDATE cache_versions SET version = (SELECT MAX(version) FROM cache_versions) + 1
+            WHERE namespace = '{namespace}';
+        """
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN {body} END
+        """)
+
+
+# Data version triggers: table -> [(namespace, source)], with {row}
+# standing for NEW or OLD. Each set is frozen as the migration that
+# introduced it shipped it; a change goes in a new migration with a set of
+# its own, which adds or replaces triggers.
+#
+# data_versions (10): per-student and per-class stamps for HTTP validators
+# (ETags). 'user:<id>' covers what a student's result page and report show;
+# 'results:<preset id>' covers a class's master sheet, which also shows each
+# student's name, roll number and CGPA.
+RESULT_VERSIONS = {
+    'users': [("'user:' || {row}.id", "WHERE true"),
+              ("'results:' || preset_id", "FROM semester_results WHERE user_id = {row}.id")],
+    'student_marks': [("'user:' || {row}.user_id", "WHERE true")],
+    'subject_results': [("'user:' || {row}.user_id", "WHERE true"),
+                        ("'results:' || preset_id", "FROM subjects WHERE id = {row}.subject_id")],
+    'cgpa': [("'user:' || {row}.user_id", "WHERE true"),
+             ("'results:' || preset_id", "FROM semester_results WHERE user_id = {row}.user_id")],
+}
+
+# preset_versions (14): 'preset:<id>' covers a preset's subjects and
+# components, as preset_cache.py keeps them.
+PRESET_VERSIONS = {
+    'presets': [("'preset:' || {row}.id", "WHERE true")],
+    'subjects': [("'preset:' || {row}.preset_id", "WHERE true")],
+    'components': [("'preset:' || preset_id", "FROM subjects WHERE id = {row}.subject_id")],
+}
+
+# Every data version trigger a current database has
+DATA_VERSIONS = {**RESULT_VERSIONS, **PRESET_VERSIONS}
+
+
+# Bulk writes (database.bulk_results) turn the DATA_VERSIONS triggers off
+# with a row of this name in trigger_guards. Temp triggers note the
+# namespaces in bulk_namespaces instead, and BULK_NAMESPACES_BUMP moves
+# each of them once before the commit.
+DATA_VERSIONS_GUARD = 'data_versions'
+BULK_NAMESPACES_BUMP = _bump("namespace", "FROM bulk_namespaces WHERE true")
+
+
+def data_version_triggers(versions=DATA_VERSIONS, guarded=True, collect=False):
+    """(name, sql) of the triggers for `versions`. Updates bump the new row's
+    namespaces only: the app never moves a row to another student or subject.
+
+    collect=True gives the temp triggers bulk_results() uses in their place.
+    Migrations older than deferred_data_versions pass guarded=False, as
+    trigger_guards doesn't exist yet."""
+    when = ''
+    if guarded and not collect:
+        when = f"WHEN NOT EXISTS (SELECT 1 FROM trigger_guards WHERE name = '{DATA_VERSIONS_GUARD}') "
+    triggers = []
+    for table, bumps in versions.items():
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            if collect:
+                body = ''.join(f"INSERT INTO bulk_namespaces (namespace) SELECT {namespace.format(row=row)} "
+                               f"{source.format(row=row)} ON CONFLICT DO NOTHING;" for namespace, source in bumps)
+                triggers.append((f"bulk_{table}_data_version_{event.lower()}",
+                                 f"AFTER {event} ON main.{table} BEGIN {body} END"))
+            else:
+                body = ''.join(_bump(namespace.format(row=row), source.format(row=row)) for namespace, source in bumps)
+                triggers.append((f"{table}_data_version_{event.lower()}",
+                                 f"AFTER {event} ON {table} {when}BEGIN {body} END"))
+    return triggers
+
+
+def core_tables(cursor):
+    # Create users table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            name TEXT,
+            roll_number TEXT,
+            enrollment_number TEXT,
+            department TEXT,
+            academic_year TEXT,
+            current_year TEXT,
+            is_admin BOOLEAN DEFAULT 0
+        )
+    """)
+
+    # Create presets table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS presets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            academic_year TEXT NOT NULL,
+            course TEXT NOT NULL,
+            department TEXT,
+            year TEXT NOT NULL,
+            division TEXT NOT NULL,
+            semester TEXT NOT NULL
+        )
+    """)
+
+    # Create subjects table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subjects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            preset_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            code TEXT,
+            credits INTEGER NOT NULL,
+            FOREIGN KEY (preset_id) REFERENCES presets (id)
+        )
+    """)
+
+    # Create components table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS components (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            max_marks INTEGER NOT NULL,
+            FOREIGN KEY (subject_id) REFERENCES subjects (id)
+        )
+    """)
+
+    # Create student_marks table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS student_marks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            component_id INTEGER NOT NULL,
+            marks_obtained REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (component_id) REFERENCES components (id),
+            UNIQUE(user_id, component_id)
+        )
+    """)
+
+    # Create subject_results table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subject_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            subject_id INTEGER NOT NULL,
+            total_obtained_marks REAL NOT NULL,
+            total_max_marks REAL NOT NULL,
+            percentage REAL NOT NULL,
+            grade TEXT NOT NULL,
+            grade_point REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (subject_id) REFERENCES subjects (id),
+            UNIQUE(user_id, subject_id)
+        )
+    """)
+
+    # Create cgpa table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cgpa (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            cgpa REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id)
+        )
+    """)
+
+    # Create grading_rules table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS grading_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            min_percentage REAL NOT NULL,
+            max_percentage REAL NOT NULL,
+            grade TEXT NOT NULL,
+            grade_point REAL NOT NULL
+        )
+    """)
+
+    # Insert default grading rules (matching official university system)
+    cursor.execute("SELECT COUNT(*) FROM grading_rules")
+    if cursor.fetchone()[0] == 0:
+        default_rules = [
+            (90.0, 100.0, 'O', 10),      # Outstanding: 90-100%
+            (80.0, 89.99, 'A+', 9),      # Excellent: 80-<90%
+            (70.0, 79.99, 'A', 8),       # Very Good: 70-<80%
+            (60.0, 69.99, 'B+', 7),      # Good: 60-<70%
+            (50.0, 59.99, 'B', 6),       # Above Average: 50-<60%
+            (40.0, 49.99, 'C', 5),       # Average: 40-<50%
+            (0.0, 39.99, 'F', 0)         # Fail: 0-<40%
+        ]
+        cursor.executemany("INSERT INTO grading_rules (min_percentage, max_percentage, grade, grade_point) VALUES (?, ?, ?, ?)", default_rules)
+
+
+def profile_columns(cursor):
+    # Databases from before the profile page only have email, name and
+    # roll_number for users, and no department on presets
+    existing = _columns(cursor, 'users')
+    for name in ('enrollment_number', 'department', 'academic_year', 'current_year'):
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE users ADD COLUMN {name} TEXT")
+    if 'department' not in _columns(cursor, 'presets'):
+        cursor.execute("ALTER TABLE presets ADD COLUMN department TEXT")
+
+
+def result_total_columns(cursor):
+    # Older databases name the totals total_obtained/total_max
+    existing = _columns(cursor, 'subject_results')
+    for old, new in (('total_obtained', 'total_obtained_marks'), ('total_max', 'total_max_marks')):
+        if old in existing and new not in existing:
+            cursor.execute(f"ALTER TABLE subject_results RENAME COLUMN {old} TO {new}")
+
+
+def jobs_table(cursor):
+    # Create jobs table (background admin operations, see jobs.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            created_by TEXT,
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    """)
+
+
+def cache_versions(cursor):
+    # Create cache_versions table (version stamps for in-process caches)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            namespace TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    _version_triggers(cursor, 'grading_rules', changed_at=False)
+
+
+def semester_results(cursor):
+    # Create semester_results table (per-semester totals and SGPA, kept
+    # current by triggers so the result pages never re-aggregate)
+    backfill = not _table_exists(cursor, 'semester_results')
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS semester_results (
+            user_id INTEGER NOT NULL,
+            preset_id INTEGER NOT NULL,
+            total_credits INTEGER NOT NULL,
+            total_points REAL NOT NULL,
+            sgpa REAL NOT NULL,
+            PRIMARY KEY (user_id, preset_id)
+        )
+    """)
+    for name, body in semester_results_triggers(guarded=False):
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+    if backfill:
+        rebuild_semester_results(cursor)
+
+
+def admins_table(cursor):
+    # Create admins table (admin accounts granted in the app, on top of ADMIN_EMAILS)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            email TEXT PRIMARY KEY,
+            added_by TEXT,
+            added_at TEXT
+        )
+    """)
+    _version_triggers(cursor, 'admins', changed_at=False)
+
+
+def _rebuild(cursor, table, definition, keep):
+    """Recreate `table` from `definition` (CREATE TABLE {table} ...), copying
+    the rows matched by `keep` and keeping its AUTOINCREMENT counter. Where
+    an old file broke a UNIQUE constraint of the new definition, the latest
+    row wins. Indexes come back with create_indexes(); triggers are the
+    caller's."""
+    old_columns = _columns(cursor, table)
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+    seq = cursor.fetchone()
+
+    cursor.execute(definition.format(table=f"{table}_new"))
+    cursor.execute(f"PRAGMA table_info({table}_new)")
+    columns = ', '.join(row[1] for row in cursor.fetchall() if row[1] in old_columns)
+    cursor.execute(f"INSERT OR REPLACE INTO {table}_new ({columns}) SELECT {columns} FROM {table} WHERE {keep} ORDER BY rowid")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    if seq:
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seq[0], table))
+
+
+def cascade_deletes(cursor):
+    # Declare ON DELETE CASCADE, so deleting a preset, subject or student
+    # takes everything under it along. SQLite can't alter a foreign key, so
+    # the tables are rebuilt (parents first); rows already orphaned by the
+    # old Python-side deletes are dropped on the way.
+    # The semester_results triggers refer to these tables and would block
+    # the renames, so they are recreated afterwards.
+    for name, _ in semester_results_triggers():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    _rebuild(cursor, 'subjects', """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            preset_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            code TEXT,
+            credits INTEGER NOT NULL,
+            FOREIGN KEY (preset_id) REFERENCES presets (id) ON DELETE CASCADE
+        )
+    """, "preset_id IN (SELECT id FROM presets)")
+    _rebuild(cursor, 'components', """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            max_marks INTEGER NOT NULL,
+            FOREIGN KEY (subject_id) REFERENCES subjects (id) ON DELETE CASCADE
+        )
+    """, "subject_id IN (SELECT id FROM subjects)")
+    _rebuild(cursor, 'student_marks', """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            component_id INTEGER NOT NULL,
+            marks_obtained REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (component_id) REFERENCES components (id) ON DELETE CASCADE,
+            UNIQUE(user_id, component_id)
+        )
+    """, "component_id IN (SELECT id FROM components) AND user_id IN (SELECT id FROM users)")
+    _rebuild(cursor, 'subject_results', """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            subject_id INTEGER NOT NULL,
+            total_obtained_marks REAL NOT NULL,
+            total_max_marks REAL NOT NULL,
+            percentage REAL NOT NULL,
+            grade TEXT NOT NULL,
+            grade_point REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (subject_id) REFERENCES subjects (id) ON DELETE CASCADE,
+            UNIQUE(user_id, subject_id)
+        )
+    """, "subject_id IN (SELECT id FROM subjects) AND user_id IN (SELECT id FROM users)")
+    _rebuild(cursor, 'cgpa', """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            cgpa REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(user_id)
+        )
+    """, "user_id IN (SELECT id FROM users)")
+
+    for name, body in semester_results_triggers(guarded=False):
+        cursor.execute(f"CREATE TRIGGER {name} {body}")
+    rebuild_semester_results(cursor)
+
+
+def global_cache_versions(cursor):
+    # cache_versions stamps become one sequence across namespaces, so workers
+    # can poll for what changed (cache_bus.py); the triggers switch over and
+    # idx_cache_versions_version comes with the index sync
+    for table in ('grading_rules', 'admins'):
+        for event in ('insert', 'update', 'delete'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_version_{event}")
+        _version_triggers(cursor, table, changed_at=False)
+
+
+def data_versions(cursor):
+    # When each stamp last moved (for Last-Modified), a 'presets' stamp for
+    # the class structure, and per-student and per-class stamps (see
+    # RESULT_VERSIONS); the older triggers are recreated to set changed_at
+    if 'changed_at' not in _columns(cursor, 'cache_versions'):
+        cursor.execute("ALTER TABLE cache_versions ADD COLUMN changed_at INTEGER")
+    for table in ('grading_rules', 'admins'):
+        for event in ('insert', 'update', 'delete'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_version_{event}")
+        _version_triggers(cursor, table)
+    for table in ('presets', 'subjects', 'components'):
+        _version_triggers(cursor, table, 'presets')
+    for name, body in data_version_triggers(RESULT_VERSIONS, guarded=False):
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+
+def job_owners(cursor):
+    # Which worker process owns each job, and when it last reported, so jobs
+    # left behind by a worker that died can be failed (jobs.recover_orphans)
+    existing = _columns(cursor, 'jobs')
+    if 'owner_pid' not in existing:
+        cursor.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+    if 'heartbeat_at' not in existing:
+        cursor.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+
+
+def deferred_result_triggers(cursor):
+    # Bulk writes switch the per-result semester_results triggers off and
+    # refresh once at the end (database.bulk_results)
+    cursor.execute("CREATE TABLE IF NOT EXISTS trigger_guards (name TEXT PRIMARY KEY)")
+    for name, body in semester_results_triggers():
+        if name.startswith('semester_results_result_'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cursor.execute(f"CREATE TRIGGER {name} {body}")
+
+
+def deferred_data_versions(cursor):
+    # Bulk writes bump each data version once rather than per row
+    # (database.bulk_results)
+    for name, body in data_version_triggers(RESULT_VERSIONS):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"CREATE TRIGGER {name} {body}")
+
+
+def preset_versions(cursor):
+    # Any change to a preset, its subjects or their components bumps
+    # 'preset:<id>' (preset_cache.py), whoever makes it
+    for name, body in data_version_triggers(PRESET_VERSIONS):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"CREATE TRIGGER {name} {body}")
+
+
+# (version, migration); numbers are never reused or reordered
+MIGRATIONS = [
+    (1, core_tables),
+    (2, profile_columns),
+    (3, result_total_columns),
+    (4, jobs_table),
+    (5, cache_versions),
+    (6, semester_results),
+    (7, admins_table),
+    (8, cascade_deletes),
+    (9, global_cache_versions),
+    (10, data_versions),
+    (11, job_owners),
+    (12, deferred_result_triggers),
+    (13, deferred_data_versions),
+    (14, preset_versions),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+def _check_foreign_keys(cursor):
+    cursor.execute("PRAGMA foreign_key_check")
+    problems = cursor.fetchall()
+    if problems:
+        tables = ', '.join(sorted({row[0] for row in problems}))
+        raise RuntimeError(f"Migration left {len(problems)} row(s) without their parent row in {tables}")
+
+
+def applied_versions(cursor):
+    if not _table_exists(cursor, 'schema_version'):
+        return {}
+    cursor.execute("SELECT version, name, applied_at FROM schema_version")
+    return {version: (name, applied_at) for version, name, applied_at in cursor.fetchall()}
+
+
+def migrate(conn):
+    """Apply every pending migration in one transaction, then sync the
+    managed indexes. Holds the write lock from the first read, so two
+    processes never apply the same migration.
+
+    Foreign key enforcement is off while they run (table rebuilds drop and
+    rename parents) and is checked before committing.
+
+    Returns the migrations applied, as [(version, name)].
+    """
+    # Can't be changed inside a transaction
+    foreign_keys = conn.execute("PRAGMA foreign_keys").fetchone()[0]
+    conn.execute("PRAGMA foreign_keys = OFF")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        """)
+        done = applied_versions(cursor)
+        applied = []
+        for version, migration in MIGRATIONS:
+            if version in done:
+                continue
+            migration(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, migration.__name__, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            applied.append((version, migration.__name__))
+        if applied:
+            create_indexes(cursor)
+            _check_foreign_keys(cursor)
+        cursor.execute(f"PRAGMA user_version = {LATEST}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if foreign_keys:
+            conn.execute("PRAGMA foreign_keys = ON")
+    return applied
+
+
+def main(argv):
+    import database
+
+    status = '--status' in argv
+    paths = [a for a in argv if a != '--status']
+    conn = database.open_connection(paths[0] if paths else database.DB_PATH)
+
+    if status:
+        done = applied_versions(conn.cursor())
+        for version, migration in MIGRATIONS:
+            name, applied_at = done.get(version, (migration.__name__, None))
+            print(f"{version:4d}  {name:<24} {applied_at or 'pending'}")
+    else:
+        applied = migrate(conn)
+        for version, name in applied:
+            print(f"Applied {version}: {name}")
+        print(f"Schema is at version {LATEST}." if applied else "Nothing to apply.")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+"""Google sign-in client, created on first use.
+
+authlib (and the requests/cryptography stack under it) is only imported when
+someone actually logs in, so workers boot without it. Google's OpenID
+metadata is cached on disk, so each worker's first login doesn't
+refetch it.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+METADATA_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+METADATA_CACHE = os.getenv('OAUTH_METADATA_CACHE', '.oauth_metadata.json')
+METADATA_MAX_AGE = float(os.getenv('OAUTH_METADATA_MAX_AGE', '86400'))
+
+_client = None
+_lock = threading.Lock()
+
+
+def _read_cache():
+    try:
+        with open(METADATA_CACHE) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - metadata.get('_loaded_at', 0) > METADATA_MAX_AGE:
+        return None
+    return metadata
+
+
+def _write_cache(metadata):
+    # Write then rename, so a worker never reads a half-written file
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(METADATA_CACHE)),
+                                   prefix='.oauth_metadata.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp, METADATA_CACHE)
+    except OSError:
+        pass
+
+
+def google(app):
+    """The registered Google client, with its server metadata loaded."""
+    global _client
+    with _lock:
+        if _client is None:
+            from authlib.integrations.flask_client import OAuth
+
+            oauth = OAuth(app)
+            _client = oauth.register(
+                name='google',
+                client_id=os.getenv('GOOGLE_CLIENT_ID'),
+                client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
+                server_metadata_url=METADATA_URL,
+                client_kwargs={
+                    'scope': 'openid email profile'
+                }
+            )
+            cached = _read_cache()
+            if cached:
+                # authlib skips the fetch once _loaded_at is present
+                _client.server_metadata.update(cached)
+
+        if '_loaded_at' not in _client.server_metadata or \
+                time.time() - _client.server_metadata['_loaded_at'] > METADATA_MAX_AGE:
+            _client.server_metadata.pop('_loaded_at', None)
+            _write_cache(dict(_client.load_server_metadata()))
+    return _client
@@ -0,0 +1,90 @@
+"""In-process cache of assembled preset trees (the preset row, its subjects
+and their components), as the student marks form and calculate_cgpa use them.
+
+Each preset has a cache_bus namespace ('preset:<id>'), which triggers on
+presets, subjects and components bump with every change, from the app or
+a script (migrations.DATA_VERSIONS). A cached tree is only served while
+that version still matches, so a hit costs no query of its own.
+
+Trees are evicted least recently used first, beyond PRESET_CACHE_SIZE.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import cache_bus
+
+MAX_PRESETS = int(os.getenv('PRESET_CACHE_SIZE', '256'))
+
+# preset id -> (version, tree); most recently used last
+_trees = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+class PresetTree:
+    """`preset` and `subjects` are rows as SELECT * returns them; `components`
+    maps subject id -> its component rows. Shared between requests: read only."""
+
+    def __init__(self, preset, subjects, components):
+        self.preset = preset
+        self.subjects = subjects
+        self.components = components
+        # subject id -> (credits, [(component id, max marks), ...])
+        self.grading = {s[0]: (s[4], [(c[0], c[3]) for c in components[s[0]]]) for s in subjects}
+
+
+def namespace(preset_id):
+    return f'preset:{int(preset_id)}'
+
+
+def _load(cursor, preset_id):
+    cursor.execute("SELECT * FROM presets WHERE id = ?", (preset_id,))
+    preset = cursor.fetchone()
+    if not preset:
+        return None
+    cursor.execute("SELECT * FROM subjects WHERE preset_id = ? ORDER BY id", (preset_id,))
+    subjects = cursor.fetchall()
+    components = {s[0]: [] for s in subjects}
+    cursor.execute("""
+        SELECT c.* FROM subjects s
+        JOIN components c ON c.subject_id = s.id
+        WHERE s.preset_id = ?
+        ORDER BY c.id
+    """, (preset_id,))
+    for row in cursor.fetchall():
+        components[row[1]].append(row)
+    return PresetTree(preset, subjects, components)
+
+
+def get_tree(cursor, preset_id):
+    """The PresetTree of `preset_id`, or None if there is no such preset."""
+    preset_id = int(preset_id)
+    current = cache_bus.version(namespace(preset_id))
+    with _lock:
+        entry = _trees.get(preset_id)
+        if entry and current is not None and entry[0] == current:
+            _trees.move_to_end(preset_id)
+            _stats['hits'] += 1
+            return entry[1]
+        _stats['misses'] += 1
+
+    tree = _load(cursor, preset_id)
+    if tree is not None and current is not None:
+        with _lock:
+            _trees[preset_id] = (current, tree)
+            _trees.move_to_end(preset_id)
+            while len(_trees) > MAX_PRESETS:
+                _trees.popitem(last=False)
+    return tree
+
+
+def clear():
+    with _lock:
+        _trees.clear()
+
+
+def stats():
+    with _lock:
+        return {'size': len(_trees), 'max_size': MAX_PRESETS, **_stats}
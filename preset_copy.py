@@ -0,0 +1,139 @@
+"""Copying presets with their subjects and components.
+
+Any number of presets copy with one statement per table. The new presets
+are inserted first. Every subject to copy then gets its new id in a temp
+map: the next free ids, in order. Subjects are inserted from the map with
+one INSERT ... SELECT, and their components follow with another.
+
+roll_over() uses it to carry a whole academic year's presets into the next
+one (the rollover wizard at /admin/rollover).
+"""
+
+import time
+
+PRESET_FIELDS = ('academic_year', 'course', 'department', 'year', 'division', 'semester')
+
+
+def clone_presets(cursor, targets):
+    """Copy presets. `targets` is a list of (source preset id, {field: value}),
+    with a value for every PRESET_FIELDS entry of the new preset. Does not
+    commit.
+
+    Returns (new preset ids in the order of `targets`, subjects copied,
+    components copied).
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS clone_presets_map (dst_id INTEGER PRIMARY KEY, src_id INTEGER NOT NULL)
+    """)
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS clone_subjects_map (
+            dst_id INTEGER PRIMARY KEY, src_id INTEGER NOT NULL, preset_id INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("DELETE FROM clone_presets_map")
+    cursor.execute("DELETE FROM clone_subjects_map")
+
+    new_ids = []
+    for _, fields in targets:
+        cursor.execute(
+            f"INSERT INTO presets ({', '.join(PRESET_FIELDS)}) VALUES ({', '.join('?' * len(PRESET_FIELDS))})",
+            [fields[name] for name in PRESET_FIELDS]
+        )
+        new_ids.append(cursor.lastrowid)
+    cursor.executemany("INSERT INTO clone_presets_map (dst_id, src_id) VALUES (?, ?)",
+                       [(new_id, source_id) for new_id, (source_id, _) in zip(new_ids, targets)])
+
+    # New subject ids continue from the AUTOINCREMENT counter
+    cursor.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'subjects'), 0),
+                   COALESCE((SELECT MAX(id) FROM subjects), 0))
+        -- full scan: sqlite_sequence has one row per table
+    """)
+    last_id = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO clone_subjects_map (dst_id, src_id, preset_id)
+        SELECT ? + ROW_NUMBER() OVER (ORDER BY cp.dst_id, s.id), s.id, cp.dst_id
+        FROM clone_presets_map cp
+        JOIN subjects s ON s.preset_id = cp.src_id
+    """, (last_id,))
+    cursor.execute("""
+        INSERT INTO subjects (id, preset_id, name, code, credits)
+        SELECT cs.dst_id, cs.preset_id, s.name, s.code, s.credits
+        FROM clone_subjects_map cs
+        JOIN subjects s ON s.id = cs.src_id
+        ORDER BY cs.dst_id
+    """)
+    subjects = cursor.rowcount
+    cursor.execute("""
+        INSERT INTO components (subject_id, name, max_marks)
+        SELECT cs.dst_id, c.name, c.max_marks
+        FROM clone_subjects_map cs
+        JOIN components c ON c.subject_id = cs.src_id
+        ORDER BY cs.dst_id, c.id
+    """)
+    components = cursor.rowcount
+
+    cursor.execute("DELETE FROM clone_presets_map")
+    cursor.execute("DELETE FROM clone_subjects_map")
+    return new_ids, subjects, components
+
+
+def next_academic_year(academic_year):
+    """The year after `academic_year`: 2025-26 -> 2026-27, 2025-2026 -> 2026-2027.
+    None when it is written some other way."""
+    first, sep, second = (academic_year or '').partition('-')
+    if not (sep and first.isdigit() and second.isdigit()):
+        return None
+    start = int(first) + 1
+    end = str(int(second) + 1).zfill(len(second))[-len(second):]
+    return f"{start}{sep}{end}"
+
+
+def rollover_plan(cursor, from_year, to_year, departments=None):
+    """The presets of academic year `from_year` (only those of `departments`,
+    if given; '' stands for presets without one), as dicts with their
+    subject and component counts. `exists` marks the ones `to_year`
+    already has (same course, department, year, division and semester);
+    those are not copied again."""
+    cursor.execute("""
+        SELECT p.id, p.course, p.department, p.year, p.division, p.semester,
+               (SELECT COUNT(*) FROM subjects s WHERE s.preset_id = p.id),
+               (SELECT COUNT(*) FROM subjects s JOIN components c ON c.subject_id = s.id
+                WHERE s.preset_id = p.id),
+               EXISTS (SELECT 1 FROM presets t
+                       WHERE t.academic_year = ? AND t.course IS p.course AND t.department IS p.department
+                         AND t.year = p.year AND t.division = p.division AND t.semester = p.semester)
+        FROM presets p
+        WHERE p.academic_year = ?
+        ORDER BY p.department, p.year, p.semester, p.division
+    """, (to_year, from_year))
+    plan = []
+    for preset_id, course, department, year, division, semester, subjects, components, exists in cursor.fetchall():
+        if departments and (department or '') not in departments:
+            continue
+        plan.append({'id': preset_id, 'course': course, 'department': department, 'year': year,
+                     'division': division, 'semester': semester, 'subjects': subjects,
+                     'components': components, 'exists': bool(exists)})
+    return plan
+
+
+def roll_over(conn, from_year, to_year, departments=None):
+    """Copy the presets of rollover_plan() that `to_year` doesn't have yet,
+    in one transaction.
+
+    Returns a dict with presets, subjects and components created, skipped
+    (presets already there) and elapsed (s).
+    """
+    start = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.cursor()
+        plan = rollover_plan(cursor, from_year, to_year, departments)
+        targets = [(p['id'], dict(p, academic_year=to_year)) for p in plan if not p['exists']]
+        new_ids, subjects, components = clone_presets(cursor, targets) if targets else ([], 0, 0)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return {'presets': len(new_ids), 'subjects': subjects, 'components': components,
+            'skipped': len(plan) - len(targets), 'elapsed': round(time.perf_counter() - start, 3)}
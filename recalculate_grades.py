@@ -1,5 +1,7 @@
 import sqlite3
 
+from grading import compile_rules
+
 def recalculate_grades():
     db_path = 'database.db'
     conn = sqlite3.connect(db_path)
@@ -7,7 +9,7 @@ def recalculate_grades():
 
     print("Fetching new grading rules...")
     cursor.execute("SELECT min_percentage, max_percentage, grade, grade_point FROM grading_rules")
-    rules = cursor.fetchall()
+    rules = compile_rules(cursor.fetchall())
     
     # 1. Update Subject Results (Grades & Pointers)
     print("Recalculating Subject Grades...")
@@ -22,15 +24,7 @@ def recalculate_grades():
             percentage = (obtained / max_marks) * 100
         
         # Find new grade
-        new_grade = 'F'
-        new_point = 0.0
-        
-        for min_p, max_p, grade, point in rules:
-            # Using precise comparison as per typical logic, float tolerance is handled by range
-            if percentage >= min_p and percentage <= max_p:
-                new_grade = grade
-                new_point = point
-                break
+        new_grade, new_point = rules.grade(percentage)
         
         cursor.execute(
             "UPDATE subject_results SET percentage=?, grade=?, grade_point=? WHERE id=?",
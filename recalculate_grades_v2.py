@@ -1,5 +1,7 @@
 import sqlite3
 
+from grading import compile_rules
+
 def recalculate_grades_v2():
     db_path = 'database.db'
     conn = sqlite3.connect(db_path)
@@ -7,7 +9,7 @@ def recalculate_grades_v2():
 
     print("Fetching new grading rules...")
     cursor.execute("SELECT min_percentage, max_percentage, grade, grade_point FROM grading_rules")
-    rules = cursor.fetchall()
+    rules = compile_rules(cursor.fetchall())
     
     # 1. Update Subject Results (Grades & Pointers)
     print("Recalculating Subject Grades...")
@@ -23,14 +25,7 @@ def recalculate_grades_v2():
             percentage = (obtained / max_marks) * 100
         
         # Find new grade
-        new_grade = 'F'
-        new_point = 0.0
-        
-        for min_p, max_p, grade, point in rules:
-            if percentage >= min_p and percentage <= max_p:
-                new_grade = grade
-                new_point = point
-                break
+        new_grade, new_point = rules.grade(percentage)
         
         # Update using composite key (user_id, subject_id)
         cursor.execute(
@@ -0,0 +1,297 @@
+import csv
+import io
+import zipfile
+from xml.sax.saxutils import escape
+
+# Rows buffered per chunk when streaming an export
+EXPORT_CHUNK_ROWS = 500
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def preset_name(preset):
+    return f"{preset[2]}_{preset[3]}Yr_{preset[4]}".replace(" ", "_")
+
+
+def format_cgpa(cgpa):
+    return "%.2f" % cgpa if cgpa is not None else "-"
+
+
+def master_header(subjects):
+    return ['Roll Number', 'Name'] + [f"{s[1]} (Grade)" for s in subjects] + ['SGPA/CGPA']
+
+
+def load_preset(cursor, preset_id):
+    """Return (preset, subjects), or (None, []) if the preset does not exist."""
+    cursor.execute("SELECT * FROM presets WHERE id=?", (preset_id,))
+    preset = cursor.fetchone()
+    if not preset:
+        return None, []
+    cursor.execute("SELECT id, name, code, credits FROM subjects WHERE preset_id=?", (preset_id,))
+    return preset, cursor.fetchall()
+
+
+def iter_students(cursor, preset_id, subjects):
+    """Yield (user_id, name, roll, cgpa, cells) per student in roll-number order.
+
+    Rows are grouped as they come off the cursor, so only one student is held
+    in memory at a time. `cells` is aligned with `subjects`; "-" means no result.
+    """
+    position = {s[0]: i for i, s in enumerate(subjects)}
+    cursor.execute("""
+        SELECT u.id, u.name, u.roll_number, sr.subject_id, sr.percentage, sr.grade, c.cgpa
+        FROM subjects s
+        JOIN subject_results sr ON sr.subject_id = s.id
+        JOIN users u ON u.id = sr.user_id
+        LEFT JOIN cgpa c ON c.user_id = u.id
+        WHERE s.preset_id = ?
+        ORDER BY u.roll_number, u.id
+    """, (preset_id,))
+
+    current = None
+    for user_id, name, roll, subject_id, percentage, grade, cgpa in cursor:
+        if current is None or current[0] != user_id:
+            if current is not None:
+                yield current
+            current = (user_id, name, roll, cgpa, ["-"] * len(subjects))
+        current[4][position[subject_id]] = f"{grade} ({int(percentage)}%)"
+    if current is not None:
+        yield current
+
+
+class MasterGrid:
+    """A class's results pivoted into column-major arrays.
+
+    Students are the rows (in roll-number order), subjects are the columns.
+    `cells[subject_id][i]` is the formatted "Grade (NN%)" of student i, or "-".
+    """
+
+    def __init__(self, preset, subjects):
+        self.preset = preset
+        self.subjects = subjects          # [(id, name, code, credits)]
+        self.user_ids = []
+        self.rolls = []
+        self.names = []
+        self.cgpas = []
+        self.cells = {s[0]: [] for s in subjects}
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @property
+    def preset_name(self):
+        return preset_name(self.preset)
+
+    def _add_student(self, user_id, name, roll, cgpa, cells):
+        self.user_ids.append(user_id)
+        self.names.append(name)
+        self.rolls.append(roll)
+        self.cgpas.append(format_cgpa(cgpa))
+        for subject, cell in zip(self.subjects, cells):
+            self.cells[subject[0]].append(cell)
+
+    def row(self, i):
+        return [self.rolls[i], self.names[i]] + [self.cells[s[0]][i] for s in self.subjects] + [self.cgpas[i]]
+
+    def rows(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def student_dicts(self):
+        """Row-major view used by master_sheet.html."""
+        return [
+            {
+                'roll': self.rolls[i],
+                'name': self.names[i],
+                'marks': {s[0]: self.cells[s[0]][i] for s in self.subjects},
+                'cgpa': self.cgpas[i],
+            }
+            for i in range(len(self))
+        ]
+
+
+def build_master_grid(cursor, preset_id):
+    """Fetch a whole class grid with a constant number of queries and pivot it.
+    Returns None if the preset does not exist."""
+    preset, subjects = load_preset(cursor, preset_id)
+    if not preset:
+        return None
+
+    grid = MasterGrid(preset, subjects)
+    for student in iter_students(cursor, preset_id, subjects):
+        grid._add_student(*student)
+    return grid
+
+
+def iter_master_rows(cursor, preset, subjects):
+    """Master sheet export rows for one class, header first, streamed off the cursor."""
+    yield master_header(subjects)
+    for _, name, roll, cgpa, cells in iter_students(cursor, preset[0], subjects):
+        yield [roll, name] + cells + [format_cgpa(cgpa)]
+
+
+def find_presets(cursor, department=None, year=None):
+    """Presets matching a department and/or year (None matches anything)."""
+    cursor.execute("""
+        SELECT * FROM presets
+        WHERE (? IS NULL OR department = ?) AND (? IS NULL OR year = ?)
+        ORDER BY year, department, division, semester, id
+    """, (department, department, year, year))
+    return cursor.fetchall()
+
+
+def iter_scope_rows(cursor, presets):
+    """Concatenate the master sheets of several classes into one export.
+    Each class gets a title row and its own header, followed by a blank row."""
+    for preset in presets:
+        _, subjects = load_preset(cursor, preset[0])
+        yield [f"{preset[2]} {preset[3] or ''} {preset[4]} - Div {preset[5]}, Sem {preset[6]} ({preset[1]})"]
+        yield from iter_master_rows(cursor, preset, subjects)
+        yield []
+
+
+def iter_student_report_rows(cursor, student, user_id):
+    """Rows of the per-student CSV report. `student` is
+    (name, roll_number, email, enrollment_number, department, current_year)."""
+    cursor.execute("SELECT cgpa FROM cgpa WHERE user_id=?", (user_id,))
+    cgpa = cursor.fetchone()
+
+    yield ['Student Report']
+    yield ['Name', student[0]]
+    yield ['Roll Number', student[1]]
+    yield ['Email', student[2]]
+    yield ['Enrollment Number', student[3] or '-']
+    yield ['Department', student[4] or '-']
+    yield ['Current Year', student[5] or '-']
+    yield ['SGPA/CGPA', cgpa[0] if cgpa else 0]
+    yield []
+
+    yield ['--- Detailed Component Marks ---']
+    yield ['Subject', 'Code', 'Component', 'Obtained', 'Max']
+    cursor.execute("""
+        SELECT s.name, s.code, c.name, sm.marks_obtained, c.max_marks
+        FROM student_marks sm
+        JOIN components c ON c.id = sm.component_id
+        JOIN subjects s ON s.id = c.subject_id
+        WHERE sm.user_id = ?
+        ORDER BY s.id, c.id
+    """, (user_id,))
+    yield from cursor
+
+    yield []
+    yield ['--- Subject Grades ---']
+    yield ['Subject', 'Percentage', 'Grade', 'Grade Point']
+    cursor.execute("""
+        SELECT s.name, sr.percentage, sr.grade, sr.grade_point
+        FROM subject_results sr
+        JOIN subjects s ON s.id = sr.subject_id
+        WHERE sr.user_id = ?
+        ORDER BY s.id
+    """, (user_id,))
+    yield from cursor
+
+
+def csv_chunks(rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Encode rows as CSV text, yielding one chunk every `chunk_rows` rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for n, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if n % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that collects bytes until drained.
+    zipfile writes to it with data descriptors, so an archive can be streamed."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+_XLSX_STATIC = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Master Sheet" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _xlsx_row(row):
+    cells = []
+    for value in row:
+        if value is None:
+            cells.append('<c/>')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>')
+    return f"<row>{''.join(cells)}</row>"
+
+
+def xlsx_chunks(rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Encode rows as a single-sheet .xlsx workbook, yielding compressed bytes
+    as they are produced. Cells are written inline, so no shared-string table
+    (and no whole-sheet buffer) is needed."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC.items():
+            archive.writestr(name, content)
+        yield sink.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetData>')
+            for n, row in enumerate(rows, 1):
+                sheet.write(_xlsx_row(row).encode('utf-8'))
+                if n % chunk_rows == 0:
+                    yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
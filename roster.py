@@ -0,0 +1,387 @@
+"""Bulk roster import and batched promotion rules.
+
+Roster import
+-------------
+A CSV or XLSX with one row per student creates and updates `users` rows in
+bulk. Email is the identity, as it is for Google sign-in. Every other
+column is optional, and a blank cell keeps what the account already has.
+Columns (case, spaces and punctuation ignored): Email, Name, Roll Number,
+Enrollment Number, Department, Academic Year, Current Year.
+
+Conflict resolution:
+- The same email twice in the file is an error, and nothing is written.
+- Admin accounts are never changed.
+- A roll number already held by another student of the same department
+  and year is a conflict. That student may be in the database or on an
+  earlier row of the file. The row is skipped, or with
+  on_conflict='abort' the whole import is.
+
+The rows are loaded into a temp table with one executemany. Matching,
+conflict detection, the updates and the inserts are one statement each,
+all in one transaction.
+
+Promotion rules
+---------------
+A rule is (department, from_year, to_year); department None means every
+department. A department's own rule beats the all-departments rule for
+the same year. All the rules apply in one UPDATE, so FE->SE and SE->TE in
+the same batch move each student exactly once.
+"""
+
+import time
+
+from spreadsheets import SpreadsheetError, header_key, normalize_roll, read_rows
+
+YEARS = ('FE', 'SE', 'TE', 'BE')
+
+# As offered on the profile form, with the short names used on class lists
+DEPARTMENTS = {
+    'Computer Engineering': ('CO', 'COMP', 'CE'),
+    'AI & ML': ('AIML',),
+    'Electronics & Computer Science': ('ECS',),
+    'Mechanical Engineering': ('MECH',),
+    'Information Technology': ('IT',),
+}
+
+# Problems listed in a report (the rest are only counted)
+MAX_ERRORS = 50
+
+# Rows of new and changed accounts shown in the preview
+PREVIEW_ROWS = 20
+
+# users column -> accepted header spellings (as header_key() gives them)
+COLUMNS = {
+    'email': ('email', 'emailid', 'emailaddress'),
+    'name': ('name', 'studentname', 'fullname'),
+    'roll_number': ('rollnumber', 'rollno', 'roll'),
+    'enrollment_number': ('enrollmentnumber', 'enrollmentno', 'enrolmentnumber', 'enrolmentno'),
+    'department': ('department', 'dept', 'branch'),
+    'academic_year': ('academicyear', 'batch'),
+    'current_year': ('currentyear', 'year'),
+}
+FIELDS = list(COLUMNS)[1:]
+
+
+class RosterError(SpreadsheetError):
+    """The roster header can't be used."""
+
+
+def department_names(cursor):
+    """header_key() of every accepted spelling -> the department as stored."""
+    names = {}
+    for department, short in DEPARTMENTS.items():
+        for alias in (department,) + short:
+            names[header_key(alias)] = department
+    # Departments presets were created with count too, spelled as there
+    cursor.execute("SELECT DISTINCT department FROM presets WHERE department IS NOT NULL")
+    for (department,) in cursor.fetchall():
+        names.setdefault(header_key(department), department)
+    return names
+
+
+def map_header(header):
+    aliases = {alias: column for column, spellings in COLUMNS.items() for alias in spellings}
+    positions = {}
+    ignored = []
+    for i, title in enumerate(header):
+        column = aliases.get(header_key(title))
+        if column and column not in positions:
+            positions[column] = i
+        elif header_key(title):
+            ignored.append(title)
+    if 'email' not in positions:
+        raise RosterError('The header needs an "Email" column.')
+    if len(positions) == 1:
+        raise RosterError('Only an Email column was found. Add Name, Roll Number, Department, '
+                          'Academic Year or Current Year columns.')
+    return positions, ignored
+
+
+def read_roster(filename, stream, departments):
+    """Parse and validate a roster file; `departments` is department_names().
+
+    Returns a dict: rows (row_no, email, name, roll_number, enrollment_number,
+    department, academic_year, current_year; None for blank cells), errors
+    (up to MAX_ERRORS "Row n: ..." messages), error_count and ignored_columns.
+    Raises SpreadsheetError when the file itself can't be used.
+    """
+    rows = read_rows(filename, stream)
+    header = next(rows, None)
+    if not header:
+        raise RosterError('The file is empty.')
+    positions, ignored = map_header(header)
+
+    report = {'rows': [], 'errors': [], 'error_count': 0, 'ignored_columns': ignored}
+
+    def error(row_no, message):
+        report['error_count'] += 1
+        if len(report['errors']) < MAX_ERRORS:
+            report['errors'].append(f"Row {row_no}: {message}")
+
+    seen = {}   # email -> row number
+    for row_no, row in enumerate(rows, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        values = {column: (row[i].strip() if i < len(row) else '') or None for column, i in positions.items()}
+
+        email = (values['email'] or '').lower()
+        if '@' not in email or ' ' in email:
+            error(row_no, f'"{values["email"] or ""}" is not an email address')
+            continue
+        if email in seen:
+            error(row_no, f"{email} is already on row {seen[email]}")
+            continue
+        seen[email] = row_no
+
+        if values.get('roll_number'):
+            values['roll_number'] = normalize_roll(values['roll_number'])
+        if values.get('department'):
+            department = departments.get(header_key(values['department']))
+            if not department:
+                error(row_no, f'unknown department "{values["department"]}"')
+                continue
+            values['department'] = department
+        if values.get('current_year'):
+            year = values['current_year'].upper()
+            if year not in YEARS:
+                error(row_no, f'current year "{values["current_year"]}" is not one of {", ".join(YEARS)}')
+                continue
+            values['current_year'] = year
+
+        report['rows'].append((row_no, email) + tuple(values.get(column) for column in FIELDS))
+    return report
+
+
+def import_roster(conn, rows, on_conflict='skip', dry_run=False, progress=None):
+    """Create and update users from read_roster() rows in one transaction.
+    With `dry_run` the same statements run and are rolled back, which is
+    the preview. `progress(fraction, message)` is called between steps.
+
+    Returns a report dict: created, updated, unchanged, admins (admin
+    accounts left alone), conflicts (up to MAX_ERRORS (row_no, email,
+    reason)), conflict_count, preview (up to PREVIEW_ROWS new or changed
+    rows), aborted, applied, steps [(name, rows, seconds)] and elapsed (s).
+    """
+    progress = progress or (lambda fraction, message: None)
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    steps = []
+
+    def step(name, sql, params=()):
+        began = time.perf_counter()
+        cursor.execute(sql, params)
+        steps.append((name, max(cursor.rowcount, 0), time.perf_counter() - began))
+        return steps[-1][1]
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS roster_import (
+                row_no INTEGER PRIMARY KEY,
+                email TEXT NOT NULL,
+                name TEXT,
+                roll_number TEXT,
+                enrollment_number TEXT,
+                department TEXT,
+                academic_year TEXT,
+                current_year TEXT,
+                user_id INTEGER,
+                roll_key TEXT,
+                status TEXT NOT NULL DEFAULT 'new',
+                note TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS temp.roster_import_user ON roster_import (user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS temp.roster_import_roll ON roster_import (roll_key, department, current_year)")
+        cursor.execute("DELETE FROM roster_import")
+
+        began = time.perf_counter()
+        cursor.executemany("""
+            INSERT INTO roster_import
+                (row_no, email, name, roll_number, enrollment_number, department, academic_year, current_year)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        steps.append(('load rows', len(rows), time.perf_counter() - began))
+        progress(0.2, 'Matching accounts by email')
+
+        # Existing accounts; a blank cell takes the account's current value
+        step('match by email', """
+            UPDATE roster_import AS r SET
+                user_id = u.id,
+                status = CASE WHEN u.is_admin THEN 'admin' ELSE 'same' END,
+                name = COALESCE(r.name, u.name),
+                roll_number = COALESCE(r.roll_number, u.roll_number),
+                enrollment_number = COALESCE(r.enrollment_number, u.enrollment_number),
+                department = COALESCE(r.department, u.department),
+                academic_year = COALESCE(r.academic_year, u.academic_year),
+                current_year = COALESCE(r.current_year, u.current_year)
+            FROM users u
+            WHERE u.email = r.email
+        """)
+        cursor.execute("UPDATE roster_import SET roll_key = upper(trim(roll_number)) WHERE roll_number IS NOT NULL")
+        progress(0.4, 'Checking roll numbers')
+
+        step('roll conflicts in file', """
+            UPDATE roster_import AS r SET status = 'conflict',
+                note = 'roll number ' || r.roll_number || ' is also on row ' || o.row_no
+            FROM roster_import o
+            WHERE r.status IN ('new', 'same') AND r.roll_key IS NOT NULL
+              AND o.roll_key = r.roll_key AND o.department IS r.department AND o.current_year IS r.current_year
+              AND o.row_no < r.row_no AND o.status != 'admin'
+        """)
+        # Students in the file are compared by their new values (above), the rest as they are
+        step('roll conflicts in database', """
+            UPDATE roster_import AS r SET status = 'conflict',
+                note = 'roll number ' || r.roll_number || ' belongs to ' || u.email
+            FROM users u  -- full scan: roll numbers are compared case-insensitively
+            WHERE r.status IN ('new', 'same')
+              AND r.roll_key = upper(trim(u.roll_number))
+              AND u.department IS r.department AND u.current_year IS r.current_year
+              AND u.id IS NOT r.user_id AND NOT u.is_admin
+              AND NOT EXISTS (SELECT 1 FROM roster_import o WHERE o.user_id = u.id)
+        """)
+
+        report = {'created': 0, 'updated': 0, 'unchanged': 0, 'admins': 0, 'conflict_count': 0,
+                  'aborted': False, 'applied': False}
+        cursor.execute("""
+            SELECT row_no, email, note FROM roster_import
+            WHERE status = 'conflict' ORDER BY row_no LIMIT ?
+        """, (MAX_ERRORS,))
+        report['conflicts'] = cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) FROM roster_import WHERE status = 'conflict'")
+        report['conflict_count'] = cursor.fetchone()[0]
+
+        if report['conflict_count'] and on_conflict == 'abort':
+            report['aborted'] = True
+        else:
+            progress(0.6, 'Writing accounts')
+            step('find changes', """
+                UPDATE roster_import AS r SET status = 'changed'
+                FROM users u
+                WHERE r.status = 'same' AND u.id = r.user_id AND (
+                    u.name IS NOT r.name OR u.roll_number IS NOT r.roll_number
+                    OR u.enrollment_number IS NOT r.enrollment_number OR u.department IS NOT r.department
+                    OR u.academic_year IS NOT r.academic_year OR u.current_year IS NOT r.current_year)
+            """)
+            report['updated'] = step('update users', """
+                UPDATE users SET
+                    name = r.name,
+                    roll_number = r.roll_number,
+                    enrollment_number = r.enrollment_number,
+                    department = r.department,
+                    academic_year = r.academic_year,
+                    current_year = r.current_year
+                FROM roster_import r
+                WHERE r.user_id = users.id AND r.status = 'changed'
+            """)
+            report['created'] = step('create users', """
+                INSERT INTO users
+                    (email, name, roll_number, enrollment_number, department, academic_year, current_year, is_admin)
+                SELECT email, name, roll_number, enrollment_number, department, academic_year, current_year, 0
+                FROM roster_import WHERE status = 'new'
+                ORDER BY row_no
+            """)
+
+        cursor.execute("SELECT status, COUNT(*) FROM roster_import GROUP BY status")
+        counts = dict(cursor.fetchall())
+        report['unchanged'] = counts.get('same', 0)
+        report['admins'] = counts.get('admin', 0)
+        cursor.execute("""
+            SELECT row_no, email, name, roll_number, department, current_year, status
+            FROM roster_import WHERE status IN ('new', 'changed')
+            ORDER BY row_no LIMIT ?
+        """, (PREVIEW_ROWS,))
+        report['preview'] = cursor.fetchall()
+
+        cursor.execute("DELETE FROM roster_import")
+        if dry_run or report['aborted']:
+            conn.rollback()
+        else:
+            conn.commit()
+            report['applied'] = True
+    except Exception:
+        conn.rollback()
+        raise
+
+    report['steps'] = steps
+    report['elapsed'] = time.perf_counter() - start
+    progress(1.0, 'Done')
+    return report
+
+
+def check_rules(rules):
+    """Problems with a list of (department or None, from_year, to_year) rules."""
+    problems = []
+    seen = set()
+    for department, from_year, to_year in rules:
+        label = department or 'All departments'
+        if from_year not in YEARS or to_year not in YEARS:
+            problems.append(f"{label}: years must be one of {', '.join(YEARS)}.")
+        elif from_year == to_year:
+            problems.append(f"{label}: {from_year} would be promoted to itself.")
+        elif (department, from_year) in seen:
+            problems.append(f"{label}: two rules promote {from_year}.")
+        seen.add((department, from_year))
+    return problems
+
+
+def promote(conn, rules, dry_run=False):
+    """Move students' current_year by `rules` in one transaction (rolled
+    back when `dry_run`, for the preview).
+
+    Returns the moves as [(department, from_year, to_year, students)], one
+    per department and year that has students to move.
+    """
+    cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS promotion_rules (
+                department TEXT, from_year TEXT NOT NULL, to_year TEXT NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS promotion_moves (
+                user_id INTEGER PRIMARY KEY, to_year TEXT NOT NULL
+            )
+        """)
+        cursor.execute("DELETE FROM promotion_rules")
+        cursor.execute("DELETE FROM promotion_moves")
+        cursor.executemany("INSERT INTO promotion_rules (department, from_year, to_year) VALUES (?, ?, ?)", rules)
+
+        # Each student's target is fixed before anything moves
+        cursor.execute("""
+            INSERT INTO promotion_moves (user_id, to_year)
+            SELECT id, to_year FROM (
+                SELECT u.id,
+                       (SELECT r.to_year FROM promotion_rules r
+                        WHERE r.from_year = u.current_year
+                          AND (r.department = u.department OR r.department IS NULL)
+                        ORDER BY r.department IS NULL LIMIT 1) AS to_year
+                FROM users u
+                WHERE u.current_year IN (SELECT from_year FROM promotion_rules)
+            )
+            WHERE to_year IS NOT NULL
+        """)
+        cursor.execute("""
+            SELECT u.department, u.current_year, m.to_year, COUNT(*)
+            FROM promotion_moves m
+            CROSS JOIN users u ON u.id = m.user_id
+            GROUP BY u.department, u.current_year, m.to_year
+            ORDER BY u.department, u.current_year
+        """)
+        moves = cursor.fetchall()
+
+        cursor.execute("""
+            UPDATE users SET current_year = (SELECT to_year FROM promotion_moves WHERE user_id = users.id)
+            WHERE id IN (SELECT user_id FROM promotion_moves)
+        """)
+        cursor.execute("DELETE FROM promotion_moves")
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return moves
@@ -0,0 +1,123 @@
+"""Reading uploaded spreadsheets (CSV or XLSX) row by row.
+
+Both readers stream: a row is parsed, handed out as a list of strings and
+dropped, so a sheet of thousands of students never sits in memory at once.
+XLSX is read with zipfile + iterparse, the same way reports.py writes it.
+"""
+
+import codecs
+import csv
+import re
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+_SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+
+class SpreadsheetError(Exception):
+    """The file as a whole can't be used (bad format, unusable header)."""
+
+
+def header_key(text):
+    # "CS101 IAT-1" and "cs101 iat1" are the same column
+    return re.sub(r'[^a-z0-9]', '', str(text).lower())
+
+
+def normalize_roll(text):
+    # Spreadsheets often turn roll numbers into floats ("101.0")
+    text = str(text).strip()
+    if re.fullmatch(r'\d+\.0+', text):
+        text = text.split('.')[0]
+    return text.upper()
+
+
+def iter_csv_rows(stream):
+    reader = csv.reader(codecs.getreader('utf-8-sig')(stream))
+    try:
+        yield from reader
+    except UnicodeDecodeError:
+        raise SpreadsheetError('The CSV file is not UTF-8. Save it as "CSV UTF-8" and try again.')
+    except csv.Error as e:
+        raise SpreadsheetError(f'Could not read the CSV file: {e}')
+
+
+def _column_index(ref):
+    # "BC12" -> 54 (0-based)
+    index = 0
+    for ch in ref:
+        if not ch.isalpha():
+            break
+        index = index * 26 + ord(ch.upper()) - 64
+    return index - 1
+
+
+def _first_sheet(book):
+    """Path of the workbook's first worksheet inside the archive."""
+    try:
+        with book.open('xl/workbook.xml') as f:
+            sheet = next(e for _, e in iterparse(f) if e.tag == _SHEET_NS + 'sheet')
+        rel_id = sheet.get(_REL_NS + 'id')
+        with book.open('xl/_rels/workbook.xml.rels') as f:
+            for _, e in iterparse(f):
+                if e.get('Id') == rel_id:
+                    target = e.get('Target')
+                    return target[1:] if target.startswith('/') else 'xl/' + target
+    except (KeyError, StopIteration):
+        pass
+    return 'xl/worksheets/sheet1.xml'
+
+
+def iter_xlsx_rows(stream):
+    """Rows of the first worksheet. The sheet XML is parsed incrementally and
+    each row is dropped once yielded, so memory stays flat however long the
+    class list is."""
+    try:
+        book = zipfile.ZipFile(stream)
+    except zipfile.BadZipFile:
+        raise SpreadsheetError('The file is not a valid .xlsx workbook.')
+
+    with book:
+        shared = []
+        if 'xl/sharedStrings.xml' in book.namelist():
+            with book.open('xl/sharedStrings.xml') as f:
+                for _, elem in iterparse(f):
+                    if elem.tag == _SHEET_NS + 'si':
+                        shared.append(''.join(t.text or '' for t in elem.iter(_SHEET_NS + 't')))
+                        elem.clear()
+
+        try:
+            sheet = book.open(_first_sheet(book))
+        except KeyError:
+            raise SpreadsheetError('The workbook has no worksheet.')
+
+        with sheet:
+            for _, elem in iterparse(sheet):
+                if elem.tag != _SHEET_NS + 'row':
+                    continue
+                row = []
+                for cell in elem.iter(_SHEET_NS + 'c'):
+                    ref = cell.get('r')
+                    col = _column_index(ref) if ref else len(row)
+                    kind = cell.get('t')
+                    if kind == 'inlineStr':
+                        value = ''.join(t.text or '' for t in cell.iter(_SHEET_NS + 't'))
+                    else:
+                        v = cell.find(_SHEET_NS + 'v')
+                        value = v.text if v is not None and v.text else ''
+                        if kind == 's' and value:
+                            value = shared[int(value)]
+                    if col >= len(row):
+                        row.extend([''] * (col + 1 - len(row)))
+                    row[col] = value
+                yield row
+                elem.clear()
+
+
+def read_rows(filename, stream):
+    name = (filename or '').lower()
+    if name.endswith('.xlsx'):
+        return iter_xlsx_rows(stream)
+    if name.endswith('.csv'):
+        return iter_csv_rows(stream)
+    raise SpreadsheetError('Upload a .csv or .xlsx file.')
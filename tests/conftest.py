@@ -0,0 +1,36 @@
+"""Test settings: the app runs against throwaway files in a temp directory.
+
+database.py and the modules around it read their paths from the environment
+at import time, so they are set here, before any test imports them.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORK_DIR = tempfile.mkdtemp(prefix='cgpa-tests-')
+for name, filename in (('DATABASE_PATH', 'database.db'), ('METRICS_PATH', 'metrics.db'),
+                       ('EXPORT_DIR', 'exports'), ('BACKUP_DIR', 'backups')):
+    os.environ[name] = os.path.join(WORK_DIR, filename)
+os.environ.update(ADMIN_EMAILS='admin@example.edu', DEV_MODE='true', SQL_INSTRUMENT='false')
+
+
+@pytest.fixture(scope='session')
+def app():
+    """The app on a small generated dataset, shared by the whole session.
+    Generated once: cache_bus keeps the versions it has seen for the life of
+    the process, so the database must not be replaced underneath it."""
+    import database
+    import generate_dataset
+
+    generate_dataset.generate(generate_dataset.parse_args([
+        database.DB_PATH, '--force', '--departments', '2', '--years', '2', '--divisions', '1',
+        '--students', '12', '--subjects', '3']))
+
+    import app as app_module
+    return app_module.create_app({'TESTING': True})
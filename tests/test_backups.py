@@ -0,0 +1,214 @@
+"""Snapshot store and restores: round trip, chunk dedup, pruning, the
+cache_bus bump after a swap, and older backups migrated on the way in.
+
+Each test gets an empty store of its own. Restores write over the shared
+session database, so every test that changes it restores it before it ends.
+"""
+
+import os
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+import backups
+import cache_bus
+import database
+from migrations import LATEST
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def store(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(backups, 'BACKUP_DIR', str(tmp_path))
+    monkeypatch.setattr(backups, 'CHUNK_DIR', str(tmp_path / 'chunks'))
+    monkeypatch.setattr(backups, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    return tmp_path
+
+
+def _student(conn):
+    return conn.execute("SELECT id, name FROM users WHERE is_admin = 0 ORDER BY id LIMIT 1").fetchone()
+
+
+def _rename(user_id, name):
+    conn = database.open_connection()
+    try:
+        conn.execute("UPDATE users SET name = ? WHERE id = ?", (name, user_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _stored_chunks(store):
+    chunk_dir = store / 'chunks'
+    return {prefix + rest for prefix in os.listdir(chunk_dir) for rest in os.listdir(chunk_dir / prefix)}
+
+
+def test_snapshot_restore_round_trip(app, store):
+    conn = database.open_connection()
+    try:
+        user_id, name = _student(conn)
+        counts = [conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in backups.REQUIRED_TABLES]
+    finally:
+        conn.close()
+
+    snap = backups.snapshot('before_test')
+    _rename(user_id, 'Changed After Snapshot')
+
+    before_restore = backups.restore_snapshot(snap['id'])
+
+    conn = database.open_connection()
+    try:
+        assert _student(conn) == (user_id, name)
+        assert [conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in backups.REQUIRED_TABLES] == counts
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+    finally:
+        conn.close()
+
+    # The database as it was before the restore is kept, with the change
+    assert before_restore in {s['id'] for s in backups.list_snapshots()}
+    with open(store / 'kept.db', 'wb') as out:
+        backups._assemble(backups.get_snapshot(before_restore), out)
+    kept = sqlite3.connect(store / 'kept.db')
+    try:
+        assert kept.execute("SELECT name FROM users WHERE id = ?", (user_id,)).fetchone()[0] == 'Changed After Snapshot'
+    finally:
+        kept.close()
+
+    # Pooled connections were retired: the app reads the restored data
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user'] = {'email': 'admin@example.edu', 'name': 'Test', 'picture': ''}
+    response = client.get(f'/admin/students/edit/{user_id}')
+    assert response.status_code == 200
+    assert name.encode() in response.get_data()
+
+
+def test_unchanged_chunks_are_stored_once(app, store, monkeypatch):
+    # One page per chunk, so a small change touches few of them
+    monkeypatch.setattr(backups, 'CHUNK_PAGES', 1)
+    first = backups.snapshot('first')
+    assert first['new_chunks'] == len(set(first['chunks']))
+
+    again = backups.snapshot('again')
+    assert again['chunks'] == first['chunks']
+    assert (again['new_chunks'], again['stored_bytes']) == (0, 0)
+
+    conn = database.open_connection()
+    try:
+        user_id, name = _student(conn)
+    finally:
+        conn.close()
+    _rename(user_id, 'Changed For Dedup')
+    try:
+        changed = backups.snapshot('changed')
+    finally:
+        _rename(user_id, name)
+
+    assert 0 < changed['new_chunks'] < len(changed['chunks']) // 4
+    assert _stored_chunks(store) == set(first['chunks']) | set(changed['chunks'])
+    assert backups.store_stats()['chunks'] == len(_stored_chunks(store))
+
+
+def test_prune_keeps_chunks_still_referenced(app, store, monkeypatch):
+    monkeypatch.setattr(backups, 'CHUNK_PAGES', 1)
+    monkeypatch.setattr(backups, 'RETENTION', {'last': 1, 'hourly': 0, 'daily': 0, 'semester': 0})
+    conn = database.open_connection()
+    try:
+        user_id, name = _student(conn)
+    finally:
+        conn.close()
+
+    old = backups.snapshot('old')
+    _rename(user_id, 'Changed For Prune')
+    try:
+        new = backups.snapshot('new')
+    finally:
+        _rename(user_id, name)
+
+    # snapshot() pruned the older manifest; its own chunks are still within
+    # the grace period
+    assert [s['id'] for s in backups.list_snapshots()] == [new['id']]
+    only_old = set(old['chunks']) - set(new['chunks'])
+    assert only_old and only_old <= _stored_chunks(store)
+
+    # Once past the grace period, only what no manifest uses goes
+    past = time.time() - backups.CHUNK_GRACE - 60
+    for digest in _stored_chunks(store):
+        os.utime(backups._chunk_path(digest), (past, past))
+    removed, freed = backups.prune()
+    assert removed == 0 and freed > 0
+    assert _stored_chunks(store) == set(new['chunks'])
+
+    # and the snapshot that is left still reassembles
+    with open(store / 'new.db', 'wb') as out:
+        backups._assemble(backups.get_snapshot(new['id']), out)
+    backups.validate(str(store / 'new.db'))
+
+
+def test_swap_moves_every_cache_version_forward(app, store):
+    conn = database.open_connection()
+    try:
+        user_id, name = _student(conn)
+    finally:
+        conn.close()
+    namespace = f'user:{user_id}'
+
+    snap = backups.snapshot('before_change')
+    _rename(user_id, 'Changed For Cache')
+    changed = cache_bus.version(namespace)
+    highest = max(cache_bus._state['versions'].values())
+
+    # The restored file holds older stamps than the ones just handed out;
+    # ALL must still move past them, or workers would keep stale entries
+    backups.restore_snapshot(snap['id'])
+    assert cache_bus.version(namespace) > changed
+    assert cache_bus.version(cache_bus.ALL) > highest
+    assert cache_bus.version('grading_rules') == cache_bus.version(cache_bus.ALL)
+
+
+def test_older_backups_are_migrated_forward(store):
+    old = store / 'old_backup.db'
+    shutil.copy(os.path.join(ROOT, 'migration_tools', 'old_backup.db'), old)
+    conn = sqlite3.connect(old)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] < LATEST
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    finally:
+        conn.close()
+
+    backups.validate(str(old))
+
+    conn = sqlite3.connect(old)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == LATEST
+        assert conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] == LATEST
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == users
+        assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+    finally:
+        conn.close()
+
+
+def test_unusable_files_are_rejected(store):
+    newer = store / 'newer.db'
+    conn = sqlite3.connect(newer)
+    conn.execute(f"PRAGMA user_version = {LATEST + 1}")
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY)")
+    conn.close()
+    with pytest.raises(backups.RestoreError, match='newer'):
+        backups.validate(str(newer))
+
+    foreign = store / 'foreign.db'
+    conn = sqlite3.connect(foreign)
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY)")
+    conn.close()
+    with pytest.raises(backups.RestoreError, match='missing'):
+        backups.validate(str(foreign))
+
+    text = store / 'text.db'
+    text.write_bytes(b'not a database')
+    with pytest.raises(backups.RestoreError):
+        backups.validate(str(text))
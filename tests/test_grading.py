@@ -0,0 +1,163 @@
+"""GradingTable lookups against the linear scan they replaced, and
+regrade_all() on a small database of its own."""
+
+import pytest
+
+import database
+import grading
+import migrations
+
+DEFAULT_RULES = [
+    (90.0, 100.0, 'O', 10),
+    (80.0, 89.99, 'A+', 9),
+    (70.0, 79.99, 'A', 8),
+    (60.0, 69.99, 'B+', 7),
+    (50.0, 59.99, 'B', 6),
+    (40.0, 49.99, 'C', 5),
+    (0.0, 39.99, 'F', 0),
+]
+
+# Overlapping rules (the first in table order wins), a gap between 20 and 30,
+# a single-point rule and rules listed out of order
+ODD_RULES = [
+    (50.0, 60.0, 'B', 6),
+    (55.0, 70.0, 'C', 5),
+    (30.0, 49.5, 'D', 4),
+    (75.0, 75.0, 'X', 7.5),
+    (10.0, 20.0, 'E', 2),
+]
+
+
+def linear_scan(rules, percentage):
+    """The lookup grading used before GradingTable."""
+    for min_p, max_p, grade, point in rules:
+        if min_p <= percentage <= max_p:
+            return grade, point
+    return 'F', 0.0
+
+
+def probes(rules):
+    """Every bound, just either side of it, the middle of every gap and
+    points outside the whole range."""
+    bounds = sorted({b for rule in rules for b in rule[:2]})
+    points = [-5.0, 0.0, 100.0, 100.5, 150.0]
+    for b in bounds:
+        points += [b, b - 0.001, b + 0.001, b - 1e-9, b + 1e-9]
+    points += [(a + b) / 2 for a, b in zip(bounds, bounds[1:])]
+    return points
+
+
+@pytest.mark.parametrize('rules', [DEFAULT_RULES, ODD_RULES, []], ids=['default', 'odd', 'empty'])
+def test_lookup_matches_linear_scan(rules):
+    table = grading.GradingTable(rules)
+    points = probes(rules)
+    expected = [linear_scan(rules, p) for p in points]
+    assert [table.grade(p) for p in points] == expected
+    assert table.grade_many(points) == expected
+
+
+def test_lookup_edges():
+    table = grading.GradingTable(ODD_RULES)
+    assert table.grade(58) == ('B', 6)
+    assert table.grade(60.5) == ('C', 5)
+    assert table.grade(25) == grading.DEFAULT_GRADE
+    assert table.grade(75) == ('X', 7.5)
+    assert table.grade(74.999) == grading.DEFAULT_GRADE
+
+    table = grading.GradingTable(DEFAULT_RULES)
+    # Between 89.99 and 90 no default rule applies
+    assert table.grade(89.995) == grading.DEFAULT_GRADE
+    assert table.grade(39.99) == ('F', 0)
+    assert table.grade(101) == grading.DEFAULT_GRADE
+
+
+def _percentage(obtained, maximum):
+    return obtained / maximum * 100
+
+
+@pytest.fixture
+def results_db(tmp_path):
+    """Two students with two subjects (4 and 2 credits). Student A's first
+    result is stale (graded A at 95%); everything else is graded right,
+    except student B's stored CGPA, which regrade_all should leave alone."""
+    conn = database.open_connection(str(tmp_path / 'grading.db'))
+    migrations.migrate(conn)
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO presets (academic_year, course, year, division, semester) "
+                   "VALUES ('2025-2026', 'BE', 'TE', 'A', '5')")
+    preset_id = cursor.lastrowid
+    subjects = []
+    for name, credits in (('Maths', 4), ('Physics', 2)):
+        cursor.execute("INSERT INTO subjects (preset_id, name, credits) VALUES (?, ?, ?)", (preset_id, name, credits))
+        subjects.append(cursor.lastrowid)
+    users = []
+    for email in ('a@example.edu', 'b@example.edu'):
+        cursor.execute("INSERT INTO users (email, current_year) VALUES (?, 'TE')", (email,))
+        users.append(cursor.lastrowid)
+
+    rows = [
+        (users[0], subjects[0], 95, 'A', 8),
+        (users[0], subjects[1], 55, 'B', 6),
+        (users[1], subjects[0], 72, 'A', 8),
+        (users[1], subjects[1], 45, 'C', 5),
+    ]
+    ids = []
+    for user_id, subject_id, obtained, grade, point in rows:
+        cursor.execute("""
+            INSERT INTO subject_results (user_id, subject_id, total_obtained_marks, total_max_marks,
+                                         percentage, grade, grade_point)
+            VALUES (?, ?, ?, 100, ?, ?, ?)
+        """, (user_id, subject_id, obtained, _percentage(obtained, 100), grade, point))
+        ids.append(cursor.lastrowid)
+    cursor.executemany("INSERT INTO cgpa (user_id, cgpa) VALUES (?, ?)", [(users[0], 7.33), (users[1], 1.23)])
+    conn.commit()
+
+    # Which subject_results rows regrade_all writes
+    cursor.execute("CREATE TEMP TABLE updated (id INTEGER)")
+    cursor.execute("""
+        CREATE TEMP TRIGGER note_update AFTER UPDATE ON main.subject_results
+        BEGIN INSERT INTO updated (id) VALUES (NEW.id); END
+    """)
+    yield conn, users, ids
+    conn.close()
+
+
+def test_regrade_writes_only_changed_rows(results_db):
+    conn, (user_a, user_b), ids = results_db
+    cursor = conn.cursor()
+
+    stats = grading.regrade_all(cursor, grading.GradingTable(DEFAULT_RULES))
+    conn.commit()
+
+    assert (stats['rows_scanned'], stats['rows_changed'], stats['users_updated']) == (4, 1, 1)
+    assert [row[0] for row in cursor.execute("SELECT id FROM updated")] == [ids[0]]
+    assert cursor.execute("SELECT grade, grade_point FROM subject_results WHERE id = ?",
+                          (ids[0],)).fetchone() == ('O', 10)
+
+    cgpa = dict(cursor.execute("SELECT user_id, cgpa FROM cgpa").fetchall())
+    assert cgpa[user_a] == pytest.approx((10 * 4 + 6 * 2) / 6)
+    assert cgpa[user_b] == 1.23
+
+
+def test_regrade_with_new_rules_recomputes_cgpa(results_db):
+    conn, (user_a, user_b), ids = results_db
+    cursor = conn.cursor()
+    grading.regrade_all(cursor, grading.GradingTable(DEFAULT_RULES))
+    cursor.execute("DELETE FROM updated")
+
+    # Pass mark raised to 50: B's 45% now fails
+    stricter = [rule for rule in DEFAULT_RULES if rule[2] != 'C']
+    stats = grading.regrade_all(cursor, grading.GradingTable(stricter))
+    conn.commit()
+
+    assert (stats['rows_changed'], stats['users_updated']) == (1, 1)
+    assert [row[0] for row in cursor.execute("SELECT id FROM updated")] == [ids[3]]
+    assert cursor.execute("SELECT grade, grade_point FROM subject_results WHERE id = ?",
+                          (ids[3],)).fetchone() == ('F', 0)
+    cgpa = dict(cursor.execute("SELECT user_id, cgpa FROM cgpa").fetchall())
+    assert cgpa[user_b] == pytest.approx((8 * 4 + 0 * 2) / 6)
+
+    # Nothing left to change
+    cursor.execute("DELETE FROM updated")
+    assert grading.regrade_all(cursor, grading.GradingTable(stricter))['rows_changed'] == 0
+    assert cursor.execute("SELECT COUNT(*) FROM updated").fetchone()[0] == 0
@@ -0,0 +1,135 @@
+"""Conditional GET: ETags follow the data a page is built from, a current
+copy gets a 304, and pages with messages waiting are always sent."""
+
+import pytest
+
+ADMIN = 'admin@example.edu'
+
+
+def _login(client, email):
+    with client.session_transaction() as session:
+        session['user'] = {'email': email, 'name': 'Test', 'picture': ''}
+
+
+@pytest.fixture
+def student(app):
+    """(user id, email, preset id, subject ids, component ids) of a student with results."""
+    import database
+
+    conn = database.open_connection()
+    try:
+        user_id, email, preset_id = conn.execute("""
+            SELECT u.id, u.email, s.preset_id FROM users u
+            JOIN subject_results sr ON sr.user_id = u.id
+            JOIN subjects s ON s.id = sr.subject_id
+            WHERE u.is_admin = 0 LIMIT 1
+        """).fetchone()
+        subject_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM subjects WHERE preset_id = ? ORDER BY id", (preset_id,))]
+        component_ids = [row[0] for row in conn.execute(
+            "SELECT c.id FROM components c JOIN subjects s ON s.id = c.subject_id WHERE s.preset_id = ?",
+            (preset_id,))]
+    finally:
+        conn.close()
+    return user_id, email, preset_id, subject_ids, component_ids
+
+
+def _etag(client, url, **kwargs):
+    response = client.get(url, **kwargs)
+    assert response.status_code == 200, (url, response.status_code)
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    return response.headers['ETag']
+
+
+def _enter_marks(client, preset_id, subject_ids, component_ids, marks):
+    form = {'action': 'calculate_cgpa', 'preset_id': preset_id, 'subjects': subject_ids}
+    form.update({f'marks_{component_id}': str(marks) for component_id in component_ids})
+    assert client.post('/student', data=form).status_code in (200, 302)
+    # Leave no message pending for the next page
+    client.get('/student')
+
+
+def test_matching_etag_gets_304(app, student):
+    user_id = student[0]
+    client = app.test_client()
+    _login(client, ADMIN)
+    url = f'/admin/students/{user_id}/marks'
+
+    etag = _etag(client, url)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.get_data() == b''
+
+    other = client.get(url, headers={'If-None-Match': 'W/"something-else"'})
+    assert other.status_code == 200
+
+
+def test_etag_changes_after_marks_edit(app, student):
+    user_id, email, preset_id, subject_ids, component_ids = student
+    client = app.test_client()
+    _login(client, email)
+
+    _enter_marks(client, preset_id, subject_ids, component_ids, 3)
+    before = _etag(client, '/result')
+    assert client.get('/result', headers={'If-None-Match': before}).status_code == 304
+
+    _enter_marks(client, preset_id, subject_ids, component_ids, 4)
+    after = _etag(client, '/result')
+    assert after != before
+    assert client.get('/result', headers={'If-None-Match': before}).status_code == 200
+
+
+def test_etag_changes_after_preset_and_credit_edits(app, student):
+    import database
+
+    user_id, _, preset_id, subject_ids, _ = student
+    client = app.test_client()
+    _login(client, ADMIN)
+    url = f'/admin/students/{user_id}/marks'
+
+    conn = database.open_connection()
+    try:
+        preset = conn.execute("SELECT academic_year, course, department, year, division, semester FROM presets "
+                              "WHERE id = ?", (preset_id,)).fetchone()
+        name, code, credits = conn.execute("SELECT name, code, credits FROM subjects WHERE id = ?",
+                                           (subject_ids[0],)).fetchone()
+    finally:
+        conn.close()
+
+    etags = [_etag(client, url)]
+    fields = ('academic_year', 'course', 'department', 'year', 'division', 'semester')
+    response = client.post(f'/admin/presets/edit/{preset_id}',
+                           data=dict(zip(fields, preset[:-1] + ('8' if preset[-1] == '7' else '7',))))
+    assert response.status_code == 302
+    etags.append(_etag(client, url))
+
+    response = client.post(f'/admin/subjects/edit/{subject_ids[0]}?preset_id={preset_id}',
+                           data={'name': name, 'code': code or '', 'credits': str(credits + 1)})
+    assert response.status_code == 302
+    etags.append(_etag(client, url))
+
+    assert len(set(etags)) == 3
+    assert client.get(url, headers={'If-None-Match': etags[0]}).status_code == 200
+
+    # Put the class back as it was for the tests that follow
+    client.post(f'/admin/presets/edit/{preset_id}', data=dict(zip(fields, preset)))
+    client.post(f'/admin/subjects/edit/{subject_ids[0]}?preset_id={preset_id}',
+                data={'name': name, 'code': code or '', 'credits': str(credits)})
+
+
+def test_no_304_while_flashes_pending(app, student):
+    user_id = student[0]
+    client = app.test_client()
+    _login(client, ADMIN)
+    url = f'/admin/students/{user_id}/marks'
+    etag = _etag(client, url)
+
+    with client.session_transaction() as session:
+        session['_flashes'] = [('success', 'Saved.')]
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Saved.' in response.get_data()
+
+    # Shown once; the next request can be answered from the browser's copy
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
@@ -0,0 +1,321 @@
+"""Query plan regression test.
+
+Runs the app's request paths (student and admin pages, exports, imports and
+the background jobs they start) against a generated dataset, records every
+statement they send to SQLite, and plans each distinct one with EXPLAIN
+QUERY PLAN. A statement fails if its plan walks a whole table or a whole
+index (SCAN x, SCAN x USING [COVERING] INDEX ...) instead of searching it,
+unless the table is one that is always read whole (FULL_SCAN_OK), a temp
+table driving a set-based statement, or the SQL says so with a
+`-- full scan: <reason>` comment.
+
+The literal statements in the app sources are planned as well, so queries on
+paths the flows below don't reach are still covered.
+
+    python -m pytest tests/test_query_plans.py
+"""
+
+import ast
+import io
+import os
+import re
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SOURCES = ['app.py', 'auth.py', 'cache_bus.py', 'grading.py', 'jobs.py', 'marks_import.py', 'preset_cache.py',
+           'preset_copy.py', 'reports.py', 'roster.py']
+
+# Small configuration tables that are always read whole
+FULL_SCAN_OK = {'admins', 'grading_rules', 'presets'}
+
+INTENDED_SCAN = '-- full scan:'
+
+TEMP_TABLE_RE = re.compile(r'CREATE\s+TEMP(?:ORARY)?\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(?:temp\.)?(\w+)', re.I)
+
+# "SCAN sr", "SCAN users USING INDEX idx_users_email", "SCAN s USING COVERING INDEX ..."
+SCAN_RE = re.compile(r'^SCAN (\w+)(?: AS (\w+))?(?: USING (?:COVERING )?INDEX \w+)?$')
+
+NOT_PLANNED = ('PRAGMA', 'CREATE', 'DROP', 'BEGIN', 'COMMIT', 'END', 'ROLLBACK', 'SAVEPOINT', 'RELEASE',
+               'ATTACH', 'DETACH', 'EXPLAIN', 'ANALYZE', 'VACUUM', '--')
+
+ADMIN = 'admin@example.edu'
+
+
+def table_aliases(sql):
+    """Map alias -> table for FROM/JOIN clauses ("subject_results sr")."""
+    aliases = {}
+    for table, alias in re.findall(r'(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.I):
+        aliases[table] = table
+        if alias and alias.upper() not in ('WHERE', 'ON', 'JOIN', 'SET', 'ORDER', 'GROUP', 'VALUES', 'LEFT',
+                                           'INNER', 'SELECT', 'USING', 'LIMIT', 'DEFAULT'):
+            aliases[alias] = table
+    return aliases
+
+
+def full_scan(detail, aliases, allowed):
+    """The table a plan line scans from end to end, or None if the line is
+    a search, or a scan of an allowed table."""
+    match = SCAN_RE.match(detail)
+    if not match:
+        return None
+    name = match.group(1)
+    table = aliases.get(name, name)
+    return None if table in allowed else table
+
+
+def plan_problems(cursor, sql, allowed, params=()):
+    """The plan lines of `sql` that scan a whole table or index."""
+    if INTENDED_SCAN in sql:
+        return []
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    aliases = table_aliases(sql)
+    return [row[-1] for row in cursor.fetchall() if full_scan(row[-1], aliases, allowed)]
+
+
+def source_statements(path):
+    """(lineno, sql) for string literals passed to execute/executemany."""
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not node.args:
+            continue
+        func = node.func
+        if not isinstance(func, ast.Attribute) or func.attr not in ('execute', 'executemany'):
+            continue
+        arg = node.args[0]
+        if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+            yield node.lineno, arg.value
+
+
+def _planned(sql):
+    return not sql.lstrip().upper().startswith(NOT_PLANNED)
+
+
+def _create_temp_tables(cursor, statements):
+    """Create the temp tables `statements` use on the checking connection;
+    returns their names. Scanning them is the point of a set-based statement."""
+    names = set()
+    for sql in statements:
+        match = TEMP_TABLE_RE.search(sql)
+        if match:
+            cursor.execute(re.sub(r'TABLE\s+(?!IF\b)', 'TABLE IF NOT EXISTS ', sql, count=1, flags=re.I))
+            names.add(match.group(1))
+    return names
+
+
+def _wait_for_jobs(cursor):
+    for _ in range(200):
+        cursor.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')")
+        if not cursor.fetchone()[0]:
+            return
+        time.sleep(0.05)
+    raise AssertionError('background jobs did not finish')
+
+
+def _login(client, email):
+    with client.session_transaction() as session:
+        session['user'] = {'email': email, 'name': 'Test', 'picture': ''}
+
+
+def _get(client, url, **kwargs):
+    response = client.get(url, **kwargs)
+    assert response.status_code in (200, 302, 304), (url, response.status_code)
+    # Streamed exports run their SQL while the body is read
+    response.get_data()
+    response.close()
+    return response
+
+
+def _post(client, url, data, **kwargs):
+    response = client.post(url, data=data, **kwargs)
+    assert response.status_code in (200, 302), (url, response.status_code)
+    return response
+
+
+def exercise(client, cursor):
+    """Drive the student and admin paths that read or write results."""
+    cursor.execute("""
+        SELECT u.id, u.email, s.preset_id FROM users u
+        JOIN subject_results sr ON sr.user_id = u.id
+        JOIN subjects s ON s.id = sr.subject_id
+        WHERE u.is_admin = 0 LIMIT 1
+    """)
+    student_id, email, preset_id = cursor.fetchone()
+    cursor.execute("SELECT id FROM subjects WHERE preset_id = ? ORDER BY id", (preset_id,))
+    subject_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT c.id FROM components c JOIN subjects s ON s.id = c.subject_id WHERE s.preset_id = ?",
+                   (preset_id,))
+    component_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT academic_year, department, year FROM presets WHERE id = ?", (preset_id,))
+    academic_year, department, year = cursor.fetchone()
+
+    # Student
+    _login(client, email)
+    for url in ('/', '/student', '/view_profile', '/additional_info'):
+        _get(client, url)
+    _post(client, '/student', {'action': 'load_subjects', 'preset_id': preset_id})
+    form = {'action': 'calculate_cgpa', 'preset_id': preset_id, 'subjects': subject_ids}
+    form.update({f'marks_{component_id}': '7' for component_id in component_ids})
+    _post(client, '/student', form)
+    etag = _get(client, '/result').headers.get('ETag')
+    _get(client, '/result', headers={'If-None-Match': etag} if etag else {})
+
+    # Admin pages and downloads
+    _login(client, ADMIN)
+    for url in ('/admin', '/admin/students', f'/admin/subjects/{preset_id}', f'/admin/subjects/edit/{subject_ids[0]}?preset_id={preset_id}',
+                f'/admin/students/{student_id}/marks', f'/admin/students/{student_id}/download_csv',
+                f'/admin/students/edit/{student_id}', '/admin/master_sheet',
+                f'/admin/master_sheet?preset_id={preset_id}',
+                f'/admin/master_sheet/download?preset_id={preset_id}',
+                f'/admin/master_sheet/download?preset_id={preset_id}&format=xlsx',
+                f'/admin/master_sheet/download_all?department={department}',
+                f'/admin/master_sheet/download_all?year={year}',
+                '/admin/grading_rules', '/admin/promote', '/admin/roster', '/admin/rollover', '/admin/jobs',
+                '/admin/admins', '/admin/backups', '/admin/perf', '/metrics', '/admin/db/download'):
+        _get(client, url)
+
+    # Edits
+    _post(client, f'/admin/subjects/edit/{subject_ids[0]}?preset_id={preset_id}',
+          {'name': 'Renamed', 'code': 'R1', 'credits': '3'})
+    _post(client, f'/admin/presets/{preset_id}/subjects/add',
+          {'name': 'Added', 'code': 'A1', 'credits': '2', 'components': ['T1'], 'max_marks_T1': '50'})
+    cursor.execute("SELECT MAX(id) FROM subjects")
+    _get(client, f'/admin/subjects/delete/{cursor.fetchone()[0]}')
+    _post(client, f'/admin/students/edit/{student_id}', {
+        'name': 'Edited', 'roll_number': '42', 'enrollment_number': '', 'department': department,
+        'academic_year': academic_year, 'current_year': year})
+
+    # Marks import from the template
+    template = _get(client, f'/admin/presets/{preset_id}/marks/template').get_data(as_text=True).splitlines()
+    filled = [template[0]] + [line + ',5' * (len(template[0].split(',')) - len(line.split(',')))
+                              for line in template[1:]]
+    filled = [re.sub(r',(?=,|$)', ',5', line) for line in filled]
+    for extra in ({'dry_run': '1'}, {}):
+        _post(client, f'/admin/presets/{preset_id}/marks/import',
+              {'marks_file': (io.BytesIO('\n'.join(filled).encode()), 'marks.csv'), **extra},
+              content_type='multipart/form-data')
+
+    # Background jobs: regrade, export, promotion, roster, rollover, preset copy
+    cursor.execute("SELECT id, min_percentage, max_percentage, grade, grade_point FROM grading_rules")
+    rules = cursor.fetchall()
+    _post(client, '/admin/grading_rules', {
+        'rule_id': [r[0] for r in rules], 'min_percentage': [r[1] for r in rules],
+        'max_percentage': [r[2] for r in rules], 'grade': [r[3] for r in rules], 'grade_point': [r[4] for r in rules],
+    })
+    _post(client, '/admin/master_sheet/export', {'preset_id': preset_id})
+    _post(client, '/admin/promote', {'from_year': year, 'to_year': year, 'action': 'preview'})
+    roster = 'Email,Name,Roll No,Dept,Current Year\nnew1@example.edu,New One,99001,{0},{1}\n{2},Renamed,,,\n'
+    roster = roster.format(department, year, email).encode()
+    for extra in ({'preview': '1'}, {}):
+        _post(client, '/admin/roster', {'roster_file': (io.BytesIO(roster), 'roster.csv'), 'on_conflict': 'skip',
+                                        **extra}, content_type='multipart/form-data')
+    _post(client, '/admin/rollover', {'from_year': academic_year, 'to_year': '2099-2100',
+                                      'departments': [department], 'action': 'preview'})
+    _post(client, '/admin/rollover', {'from_year': academic_year, 'to_year': '2099-2100',
+                                      'departments': [department], 'action': 'apply'})
+    _post(client, f'/admin/presets/duplicate/{preset_id}', {
+        'academic_year': '2098-2099', 'course': 'BE', 'department': department, 'year': year,
+        'division': 'Z', 'semester': '1'})
+    _wait_for_jobs(cursor)
+    cursor.execute("SELECT id FROM jobs ORDER BY id DESC LIMIT 1 -- full scan: newest job")
+    job_id = cursor.fetchone()[0]
+    _get(client, f'/admin/jobs/{job_id}')
+    cursor.execute("SELECT id FROM jobs WHERE kind = 'master_export' AND status = 'done' LIMIT 1")
+    _get(client, f'/admin/jobs/{cursor.fetchone()[0]}/download')
+    _post(client, '/admin/promote', {'from_year': year, 'to_year': 'BE' if year != 'BE' else 'TE'})
+    _wait_for_jobs(cursor)
+
+    # Deletes cascade
+    cursor.execute("SELECT MAX(id) FROM presets")
+    _get(client, f'/admin/presets/delete/{cursor.fetchone()[0]}')
+    _get(client, f'/admin/students/delete/{student_id}')
+
+
+@pytest.fixture(scope='module')
+def executed(app):
+    """Every statement the flows above sent to the database, in order."""
+    import database
+
+    statements = []
+    open_connection = database.open_connection
+
+    def traced(*args, **kwargs):
+        conn = open_connection(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(database, 'open_connection', traced)
+        # Pooled connections opened before the patch would go unrecorded
+        database.invalidate_connections()
+        checker = database.open_connection()
+        try:
+            exercise(app.test_client(), checker.cursor())
+        finally:
+            checker.close()
+        return list(statements)
+
+
+def test_scan_detection():
+    allowed = {'presets', 'ids'}
+    aliases = table_aliases("SELECT * FROM subject_results sr JOIN presets p ON p.id = sr.id JOIN ids ON 1")
+    assert full_scan('SCAN sr', aliases, allowed) == 'subject_results'
+    assert full_scan('SCAN sr USING INDEX idx_subject_results_user', aliases, allowed) == 'subject_results'
+    assert full_scan('SCAN sr USING COVERING INDEX idx_subject_results_user', aliases, allowed) == 'subject_results'
+    assert full_scan('SEARCH sr USING INDEX idx_subject_results_user (user_id=?)', aliases, allowed) is None
+    assert full_scan('SCAN p', aliases, allowed) is None
+    assert full_scan('SCAN ids', aliases, allowed) is None
+    assert full_scan('SCAN CONSTANT ROW', aliases, allowed) is None
+    assert full_scan('USE TEMP B-TREE FOR ORDER BY', aliases, allowed) is None
+
+
+def test_executed_statements_use_indexes(executed):
+    import database
+    from instrumentation import normalize
+
+    conn = database.open_connection()
+    cursor = conn.cursor()
+    allowed = FULL_SCAN_OK | _create_temp_tables(cursor, executed)
+
+    shapes = {}
+    for sql in executed:
+        if _planned(sql):
+            shapes.setdefault(normalize(sql), sql)
+    assert len(shapes) > 100, 'the flows should reach most of the app'
+
+    failures = []
+    for sql in shapes.values():
+        try:
+            problems = plan_problems(cursor, sql, allowed)
+        except Exception as e:
+            problems = [f"could not plan: {e}"]
+        if problems:
+            failures.append(f"{' '.join(sql.split())[:300]}\n   -> " + '\n   -> '.join(problems))
+    conn.close()
+    assert not failures, f"{len(failures)} statement(s) scan a whole table or index:\n" + '\n'.join(failures)
+
+
+def test_source_statements_use_indexes(executed):
+    import database
+
+    statements = [(path, lineno, sql) for path in SOURCES
+                  for lineno, sql in source_statements(os.path.join(ROOT, path))]
+    conn = database.open_connection()
+    cursor = conn.cursor()
+    allowed = FULL_SCAN_OK | _create_temp_tables(cursor, [sql for _, _, sql in statements])
+
+    failures = []
+    for path, lineno, sql in sorted(statements):
+        if not _planned(sql):
+            continue
+        try:
+            problems = plan_problems(cursor, sql, allowed, [None] * sql.count('?'))
+        except Exception as e:
+            problems = [f"could not plan: {e}"]
+        if problems:
+            failures.append(f"{path}:{lineno}: {' '.join(sql.split())[:300]}\n   -> " + '\n   -> '.join(problems))
+    conn.close()
+    assert not failures, f"{len(failures)} statement(s) scan a whole table or index:\n" + '\n'.join(failures)